@@ -1,25 +1,52 @@
+import cProfile
+import csv
+import functools
+import io
 import os
+import signal
 import sqlite3
+import sys
 import asyncio
+import base64
 import socket
 import random
+import select
 import json
-from urllib import request as urlrequest
-from urllib import error as urlerror
+import hashlib
+import hmac
+import pstats
+import re
+import time
+import threading
+import queue
+import tempfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http import client as httpclient
+from urllib.parse import unquote, urlsplit
+from urllib.request import getproxies, proxy_bypass
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from secrets import token_urlsafe
-from flask import Flask, g, redirect, render_template, request, session, url_for
+from flask import Flask, Response, abort, g, jsonify, redirect, render_template, request, send_from_directory, session, url_for
 from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import LimitedStream
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 import socks
 from telethon import TelegramClient
-from telethon.errors import PhoneCodeInvalidError, SessionPasswordNeededError
+from telethon.errors import FloodWaitError, PhoneCodeInvalidError, SessionPasswordNeededError
+from telethon.crypto import AESModeCTR
 from telethon.sessions import StringSession
 
 BASE_DIR = Path(__file__).resolve().parent
 DB_PATH = BASE_DIR / "TgHelper.db"
+LOCAL_SNAPSHOT_DIR = Path(os.environ.get("TGHELPER_SNAPSHOT_DIR") or BASE_DIR / "snapshots")
+# 账号会话（Telethon StringSession）加密后单独存放在 tg_account_secrets；密钥取 TGHELPER_SESSION_KEY，未设置时首次使用自动生成到密钥文件。
+# 云端备份中同样只有密文，换机器恢复时需带上同一个密钥
+SESSION_KEY_FILE = Path(os.environ.get("TGHELPER_SESSION_KEY_FILE") or BASE_DIR / "session.key")
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "change-me")
@@ -30,11 +57,13 @@ app.config["TELEGRAM_API_HASH"] = os.environ.get("TELEGRAM_API_HASH")
 SCHEDULER = BackgroundScheduler(timezone="Asia/Shanghai")
 AUTO_SEND_JOB_ID = "auto_send_tick"
 AUTO_BACKUP_JOB_ID = "auto_backup_daily"
+EVENT_RELAY_JOB_ID = "dispatch_event_relay"
 
 APP_TABLES = [
     "users",
     "sessions",
     "tg_accounts",
+    "tg_account_secrets",
     "tg_dialogs",
     "tg_sign_tasks",
     "tg_auto_send_tasks",
@@ -42,6 +71,161 @@ APP_TABLES = [
     "app_settings",
 ]
 
+# 各表用于增量同步的主键列
+APP_TABLE_KEYS = {
+    "sessions": "token",
+    "tg_account_secrets": "account_id",
+    "app_settings": "key",
+}
+
+CF_API_BASE = os.environ.get("TGHELPER_CF_API_BASE", "https://api.cloudflare.com/client/v4").rstrip("/")
+# D1 单条 SQL 上限为 100KB，这里留出余量；多行 VALUES 每条最多 500 行
+D1_MAX_SQL_BYTES = 90000
+D1_MAX_ROWS_PER_STATEMENT = 500
+CF_MAX_CONNECTIONS = 4
+CF_MAX_RETRIES = 3
+CF_PARALLEL_TABLES = 4
+D1_PULL_PAGE_ROWS = 5000
+# 本地快照按固定大小切块并以内容哈希去重，未变化的数据页不会重复保存
+LOCAL_SNAPSHOT_CHUNK_SIZE = 64 * 1024
+LOCAL_SNAPSHOT_DEFAULT_KEEP = 7
+D1_CHECKSUM_TABLE = "tghelper_checksums"
+D1_CHECKSUM_TABLE_SQL = (
+    f"CREATE TABLE IF NOT EXISTS {D1_CHECKSUM_TABLE} ("
+    "table_name TEXT PRIMARY KEY, checksum TEXT NOT NULL, row_count INTEGER NOT NULL, updated_at TEXT NOT NULL)"
+)
+
+# 生产模式服务参数：固定大小的请求线程池、keep-alive 空闲超时、单请求读取超时、退出时的排空等待
+SERVE_HOST = os.environ.get("TGHELPER_HOST", "0.0.0.0")
+SERVE_PORT = int(os.environ.get("TGHELPER_PORT", "15018"))
+SERVE_THREADS = int(os.environ.get("TGHELPER_THREADS", "16"))
+SERVE_KEEPALIVE_TIMEOUT = float(os.environ.get("TGHELPER_KEEPALIVE_TIMEOUT", "5"))
+SERVE_REQUEST_TIMEOUT = float(os.environ.get("TGHELPER_REQUEST_TIMEOUT", "30"))
+SERVE_SHUTDOWN_TIMEOUT = float(os.environ.get("TGHELPER_SHUTDOWN_TIMEOUT", "60"))
+# 手动触发的发送任务在后台线程池执行，保留最近若干条结果供页面查询
+SEND_WORKERS = int(os.environ.get("TGHELPER_SEND_WORKERS", "4"))
+SEND_JOB_HISTORY = 200
+# 任务状态推送（SSE）：所有页面共享进程内广播；每条连接占用一个请求线程，因此限制连接数并定期断开让浏览器重连
+TASK_EVENT_MAX_CLIENTS = int(os.environ.get("TGHELPER_SSE_CLIENTS", str(max(SERVE_THREADS // 2, 1))))
+TASK_EVENT_HEARTBEAT = 15
+TASK_EVENT_STREAM_SECONDS = 300
+TASK_EVENT_QUEUE_SIZE = 100
+TASK_EVENT_HISTORY = 500
+# 每次发送按阶段计时（connect/resolve/send/wait/reply），每个任务保留最近若干次；总耗时超过阈值（秒，0 为关闭）时记录日志
+SLOW_SEND_SECONDS = float(os.environ.get("TGHELPER_SLOW_SEND_SECONDS", "0"))
+SEND_RUN_HISTORY = 20
+# 发送后等待对方回复的固定秒数
+SEND_REPLY_WAIT = 2
+# 多进程分片：TGHELPER_ROLE=all（默认，网页 + 调度）、web（只提供网页与自动备份）、dispatcher（只运行自动发送调度）。
+# 每个调度进程在 tg_dispatchers 中心跳登记，按 worker_id 排序后的序号 i 与存活进程数 K 负责 account_id % K == i 的账号；
+# 进程加入或心跳超时后下一轮自动重新分配。发送前需持有账号租约（tg_dispatch_leases），保证同一账号同一时间只在一个进程中按顺序发送
+DISPATCH_ROLE = os.environ.get("TGHELPER_ROLE", "all")
+DISPATCH_ROLES = ("all", "web", "dispatcher")
+DISPATCH_WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{token_urlsafe(4)}"
+DISPATCH_HEARTBEAT_TTL = 30
+# 租约时长需覆盖单次发送的最长耗时（含 Telethon 自动等待不超过 60 秒的 FloodWait）
+DISPATCH_LEASE_SECONDS = 300
+DISPATCH_RENEW_SECONDS = 10
+DISPATCH_LEASE_WAIT = 60
+# 调度进程的任务状态事件经 tg_dispatch_events 转给网页进程的 SSE，保留 5 分钟；指标快照每轮写入 tg_dispatchers.metrics
+DISPATCH_EVENT_KEEP_SECONDS = 300
+# /metrics：设置 TGHELPER_METRICS_TOKEN 后凭 Bearer 令牌访问，否则只允许本机或已登录用户
+METRICS_TOKEN = os.environ.get("TGHELPER_METRICS_TOKEN", "")
+METRIC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRIC_DEFINITIONS = {
+    "tghelper_sends_total": ("counter", "自动发送次数（source=scheduled/manual，result=sent/failed）"),
+    "tghelper_send_flood_waits_total": ("counter", "发送时遇到的 FloodWait 次数"),
+    "tghelper_send_seconds": ("histogram", "单次发送（含等待回复）的总耗时"),
+    "tghelper_telegram_phase_seconds": ("histogram", "Telegram 调用各阶段耗时（connect/resolve/send/wait/reply）"),
+    "tghelper_telegram_clients_open": ("gauge", "当前打开的 Telegram 客户端连接数"),
+    "tghelper_dispatch_due_tasks": ("gauge", "最近一轮调度时到期的任务数"),
+    "tghelper_dispatch_tick_seconds": ("gauge", "最近一轮调度的耗时"),
+    "tghelper_dispatch_last_tick_timestamp": ("gauge", "最近一轮调度结束的 Unix 时间"),
+    "tghelper_dispatch_shard": ("gauge", "本进程的调度分片序号"),
+    "tghelper_dispatch_workers": ("gauge", "当前存活的调度进程数"),
+    "tghelper_send_queue_depth": ("gauge", "手动发送队列中排队的任务数"),
+    "tghelper_event_streams": ("gauge", "当前的任务状态推送连接数"),
+    "tghelper_cloudflare_requests_total": ("counter", "Cloudflare API 请求次数（status=HTTP 状态码或 error）"),
+    "tghelper_cloudflare_retries_total": ("counter", "Cloudflare API 重试次数"),
+    "tghelper_cloudflare_request_seconds": ("histogram", "单次 Cloudflare API 请求耗时"),
+    "tghelper_sqlite_statements_total": ("counter", "开启 SQL 跟踪后执行的 SQLite 语句数"),
+    "tghelper_sqlite_lock_retries_total": ("counter", "开启 SQL 跟踪后因数据库被锁而重试的次数"),
+}
+# 按需性能分析：TGHELPER_PROFILE=1 或在“性能分析”页面开启后，按目标、路径前缀与抽样比例选中的请求和调度任务用 cProfile 记录；
+# 耗时不低于阈值的结果写入 PROFILE_DIR，只保留最近 PROFILE_KEEP 份。同一时间只运行一个分析器，忙时直接跳过
+PROFILE_ENV_ENABLED = os.environ.get("TGHELPER_PROFILE", "") == "1"
+PROFILE_DIR = Path(os.environ.get("TGHELPER_PROFILE_DIR") or BASE_DIR / "profiles")
+PROFILE_KEEP = int(os.environ.get("TGHELPER_PROFILE_KEEP", "50"))
+PROFILE_TARGETS = ("requests", "auto_send", "auto_backup")
+PROFILE_TOP = 40
+PROFILE_LOCK = threading.Lock()
+# SQLite 语句跟踪：TGHELPER_SQL_TRACE=1 时 connect_db 返回带计时的连接，统计每类语句（归一化 SQL）的次数与耗时，
+# 超过 TGHELPER_SLOW_SQL_MS 的语句连同调用位置写日志；“database is locked” 改为在 Python 层退避重试并计数，
+# 总等待上限与 sqlite3 默认的 5 秒一致。关闭时直接返回普通连接，没有额外开销
+SQL_TRACE = os.environ.get("TGHELPER_SQL_TRACE", "") == "1"
+SLOW_SQL_MS = float(os.environ.get("TGHELPER_SLOW_SQL_MS", "100"))
+SQL_LOCK_TIMEOUT = 5.0
+SQL_STATS_MAX = 500
+SQL_TOP = 20
+# 批量操作与导入导出使用的任务字段；导入时带 id 且属于当前用户的行会更新原任务，其余新建
+TASK_EXPORT_FIELDS = ["id", "account_id", "dialog_id", "message", "time_of_day", "jitter_seconds", "enabled"]
+TASK_BULK_ACTIONS = ("enable", "disable", "delete", "retime", "edit")
+
+API_DEFAULT_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+# JSON 接口可选字段：字段名 -> SQL 表达式；不包含 session_text 等敏感列
+API_ACCOUNT_FIELDS = {
+    "id": "a.id",
+    "account_name": "a.account_name",
+    "created_at": "a.created_at",
+    "dialog_count": "(SELECT COUNT(1) FROM tg_dialogs d WHERE d.account_id = a.id)",
+    "task_count": "(SELECT COUNT(1) FROM tg_auto_send_tasks t WHERE t.account_id = a.id AND t.owner = a.owner)",
+}
+API_DIALOG_FIELDS = {
+    "id": "d.id",
+    "account_id": "d.account_id",
+    "dialog_id": "d.dialog_id",
+    "title": "d.title",
+    "username": "d.username",
+    "updated_at": "d.updated_at",
+}
+API_TASK_FIELDS = {
+    "id": "t.id",
+    "account_id": "t.account_id",
+    "dialog_id": "t.dialog_id",
+    "dialog_name": (
+        "COALESCE((SELECT COALESCE(d.title, d.username) FROM tg_dialogs d "
+        "WHERE d.account_id = t.account_id AND d.dialog_id = t.dialog_id LIMIT 1), t.dialog_id)"
+    ),
+    "message": "t.message",
+    "interval_seconds": "t.interval_seconds",
+    "jitter_seconds": "t.jitter_seconds",
+    "schedule_type": "t.schedule_type",
+    "time_of_day": "t.time_of_day",
+    "enabled": "t.enabled",
+    "next_run_at": "t.next_run_at",
+    "last_run_at": "t.last_run_at",
+    "last_result": "t.last_result",
+    "last_reply": "t.last_reply",
+    "last_timings": "(SELECT r.timings FROM tg_auto_send_runs r WHERE r.task_id = t.id ORDER BY r.id DESC LIMIT 1)",
+    "created_at": "t.created_at",
+    "updated_at": "t.updated_at",
+}
+API_TASK_RUN_FIELDS = {
+    "id": "r.id",
+    "task_id": "r.task_id",
+    "source": "r.source",
+    "started_at": "r.started_at",
+    "ok": "r.ok",
+    "total_seconds": "r.total_seconds",
+    "timings": "r.timings",
+}
+API_TASK_RESULT_FILTERS = {
+    "sent": "t.last_result LIKE 'sent%'",
+    "failed": "t.last_result LIKE 'failed%'",
+    "none": "t.last_result IS NULL",
+}
+
 UTC_PLUS_8 = timezone(timedelta(hours=8))
 
 
@@ -65,9 +249,313 @@ def append_utc8_timestamp(message: str) -> str:
     return f"{message}\n\n[{utc8_now_text()}]"
 
 
+# 发送内容模板：{date} {time} {weekday} {account} {count} {random:甲|乙}，date/time 可带 strftime 格式如 {date:%m月%d日}，{{ 与 }} 表示大括号本身
+MESSAGE_TEMPLATE_RE = re.compile(r"\{\{|\}\}|\{([^{}]*)\}|[{}]")
+MESSAGE_TEMPLATE_WEEKDAYS = ("星期一", "星期二", "星期三", "星期四", "星期五", "星期六", "星期日")
+MESSAGE_TEMPLATE_VARIABLES = ("date", "time", "weekday", "account", "count", "random")
+
+
+class MessageTemplate:
+    __slots__ = ("parts", "variables", "error")
+
+    def __init__(self, parts: tuple, variables: frozenset, error: str | None = None):
+        # parts 中字符串原样输出，其余为 (now, account_name, count) -> str 的函数；
+        # error 非空表示内容不是合法模板，按原文发送
+        self.parts = parts
+        self.variables = variables
+        self.error = error
+
+    def render(self, account_name: str = "", count: int = 0) -> str:
+        if not self.variables:
+            return self.parts[0] if self.parts else ""
+        now = utc8_now()
+        return "".join(part if part.__class__ is str else part(now, account_name, count) for part in self.parts)
+
+
+def compile_template_variable(name: str, arg: str | None):
+    if name in ("date", "time"):
+        fmt = arg or ("%Y-%m-%d" if name == "date" else "%H:%M")
+        try:
+            utc8_now().strftime(fmt)
+        except ValueError:
+            raise ValueError(f"{{{name}:{arg}}} 的时间格式不正确。")
+        return lambda now, account_name, count: now.strftime(fmt)
+    if arg is not None and name != "random":
+        raise ValueError(f"变量 {{{name}}} 不接受参数。")
+    if name == "weekday":
+        return lambda now, account_name, count: MESSAGE_TEMPLATE_WEEKDAYS[now.weekday()]
+    if name == "account":
+        return lambda now, account_name, count: account_name
+    if name == "count":
+        return lambda now, account_name, count: str(count)
+    choices = tuple(arg.split("|")) if arg else ()
+    if len(choices) < 2:
+        raise ValueError("{random:...} 需要至少两个用 | 分隔的候选内容。")
+    return lambda now, account_name, count: random.choice(choices)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_message_template(text: str) -> MessageTemplate:
+    # 以内容为缓存键：任务内容修改后自然得到新的编译结果，多个任务相同内容时共用。
+    # 解析失败的结果同样缓存（lru_cache 不缓存异常），支持模板之前保存的单个大括号内容不必每次发送都重新解析
+    try:
+        return parse_message_template(text)
+    except ValueError as exc:
+        return MessageTemplate((text,) if text else (), frozenset(), str(exc))
+
+
+def parse_message_template(text: str) -> MessageTemplate:
+    parts = []
+    variables = set()
+    literal = []
+    position = 0
+    for match in MESSAGE_TEMPLATE_RE.finditer(text):
+        literal.append(text[position:match.start()])
+        position = match.end()
+        token = match.group(0)
+        if token in ("{{", "}}"):
+            literal.append(token[0])
+            continue
+        if match.group(1) is None:
+            raise ValueError(f"第 {match.start() + 1} 个字符处的 {token} 没有配对，大括号本身请写成 {{{{ 或 }}}}。")
+        name, _, arg = match.group(1).partition(":")
+        name = name.strip()
+        if name not in MESSAGE_TEMPLATE_VARIABLES:
+            raise ValueError(f"未知变量 {{{name}}}，可用：{'、'.join(MESSAGE_TEMPLATE_VARIABLES)}。")
+        if literal:
+            parts.append("".join(literal))
+            literal = []
+        parts.append(compile_template_variable(name, arg if ":" in match.group(1) else None))
+        variables.add(name)
+    literal.append(text[position:])
+    parts.append("".join(literal))
+    return MessageTemplate(tuple(part for part in parts if part != ""), frozenset(variables))
+
+
+def validate_message_template(text: str, previous: str | None = None) -> None:
+    # 未修改的旧内容（支持模板之前保存、含单个大括号）照常保存，只修改计划时不必重写内容
+    if previous is not None and text == previous:
+        return
+    error = compile_message_template(text).error
+    if error:
+        raise ValueError(f"发送内容模板有误：{error}")
+
+
+def task_message_template(text: str) -> MessageTemplate:
+    return compile_message_template(text)
+
+
+def render_task_message(conn: sqlite3.Connection, task: sqlite3.Row, account_name: str) -> str:
+    template = task_message_template(task["message"])
+    count = 0
+    if "count" in template.variables:
+        row = conn.execute("SELECT sent FROM tg_task_counters WHERE task_id = ?", (task["id"],)).fetchone()
+        count = row[0] if row else 0
+    # {count} 为本次是该任务的第几次成功发送；只有用到 {count} 的任务才读写计数
+    return template.render(account_name, count + 1)
+
+
+def uses_send_counter(text: str) -> bool:
+    return "count" in task_message_template(text).variables
+
+
+SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_PLACEHOLDER_LIST_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql: str) -> str:
+    # 合并空白、字面量替换为 ?、连续占位符折叠，同一类语句归为一条统计
+    text = SQL_LITERAL_RE.sub("?", " ".join(sql.split()))
+    return SQL_PLACEHOLDER_LIST_RE.sub("?, ...", text)[:300]
+
+
+class SqlStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            # 归一化 SQL -> [次数, 总耗时, 最大耗时, 慢语句次数, 锁等待重试次数, 最近一次慢语句的调用位置]
+            self.statements: dict[str, list] = {}
+            self.lock_waits = 0
+            self.lock_retries = 0
+            self.lock_failures = 0
+            self.lock_wait_seconds = 0.0
+            self.since = datetime.now().isoformat(timespec="seconds")
+
+    def record(self, sql: str, seconds: float, executed: bool, slow_caller: str | None, retries: int = 0, wait_seconds: float = 0) -> None:
+        with self.lock:
+            entry = self.statements.get(sql)
+            if entry is None:
+                if len(self.statements) >= SQL_STATS_MAX:
+                    return
+                entry = self.statements[sql] = [0, 0.0, 0.0, 0, 0, None]
+            entry[0] += 1 if executed else 0
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            if slow_caller:
+                entry[3] += 1
+                entry[5] = slow_caller
+            if retries:
+                entry[4] += retries
+                self.lock_waits += 1
+                self.lock_retries += retries
+                self.lock_wait_seconds += wait_seconds
+
+    def record_lock_failure(self) -> None:
+        with self.lock:
+            self.lock_failures += 1
+
+    def top(self, limit: int = SQL_TOP) -> list[dict]:
+        with self.lock:
+            items = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [
+            {
+                "sql": sql,
+                "count": count,
+                "total_ms": round(total * 1000, 1),
+                "avg_ms": round(total * 1000 / count, 2) if count else None,
+                "max_ms": round(longest * 1000, 1),
+                "slow": slow,
+                "lock_retries": retries,
+                "caller": caller,
+            }
+            for sql, (count, total, longest, slow, retries, caller) in items
+        ]
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "since": self.since,
+                "statements": len(self.statements),
+                "lock_waits": self.lock_waits,
+                "lock_retries": self.lock_retries,
+                "lock_failures": self.lock_failures,
+                "lock_wait_seconds": round(self.lock_wait_seconds, 3),
+            }
+
+
+SQL_STATS = SqlStats()
+
+
+def sql_caller() -> str:
+    # 跳过跟踪包装自身的栈帧，返回发起查询的函数与行号
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code in SQL_TRACE_CODES:
+        frame = frame.f_back
+    return f"{frame.f_code.co_name}:{frame.f_lineno}" if frame is not None else "?"
+
+
+def trace_sql(sql: str, operation, *args):
+    normalized = normalize_sql(sql)
+    started = time.perf_counter()
+    retries = 0
+    while True:
+        try:
+            result = operation(*args)
+            break
+        except sqlite3.OperationalError as exc:
+            # 连接以 timeout=0 打开，锁冲突立即返回，在这里按 sqlite3 默认的总时长退避重试
+            message = str(exc)
+            if ("locked" not in message and "busy" not in message) or time.perf_counter() - started >= SQL_LOCK_TIMEOUT:
+                if retries:
+                    SQL_STATS.record_lock_failure()
+                    app.logger.warning("SQL 锁等待超时：重试 %d 次后放弃 %s ← %s", retries, normalized, sql_caller())
+                raise
+            retries += 1
+            time.sleep(min(0.002 * 2**retries, 0.1))
+    elapsed = time.perf_counter() - started
+    slow_caller = None
+    if elapsed * 1000 >= SLOW_SQL_MS:
+        slow_caller = sql_caller()
+        app.logger.warning("SQL 较慢：%.1fms（锁等待重试 %d 次）%s ← %s", elapsed * 1000, retries, normalized, slow_caller)
+    SQL_STATS.record(normalized, elapsed, True, slow_caller, retries, elapsed if retries else 0)
+    METRICS.inc("tghelper_sqlite_statements_total")
+    if retries:
+        METRICS.inc("tghelper_sqlite_lock_retries_total", amount=retries)
+    return result, normalized, elapsed
+
+
+class TracedCursor(sqlite3.Cursor):
+    # 读取结果的耗时也计入上一条语句：SELECT 在 execute 时只取到第一行，其余在 fetch 时才真正执行
+    traced_sql = None
+    traced_seconds = 0.0
+
+    def execute(self, sql, parameters=()):
+        _result, self.traced_sql, self.traced_seconds = trace_sql(sql, super().execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        _result, self.traced_sql, self.traced_seconds = trace_sql(sql, super().executemany, sql, seq_of_parameters)
+        return self
+
+    def _traced_fetch(self, operation, *args):
+        started = time.perf_counter()
+        rows = operation(*args)
+        if self.traced_sql is not None:
+            elapsed = time.perf_counter() - started
+            before = self.traced_seconds
+            self.traced_seconds += elapsed
+            slow_caller = None
+            if before * 1000 < SLOW_SQL_MS <= self.traced_seconds * 1000:
+                slow_caller = sql_caller()
+                app.logger.warning("SQL 较慢：%.1fms（含读取结果）%s ← %s", self.traced_seconds * 1000, self.traced_sql, slow_caller)
+            SQL_STATS.record(self.traced_sql, elapsed, False, slow_caller)
+        return rows
+
+    def fetchone(self):
+        return self._traced_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._traced_fetch(super().fetchmany, size if size is not None else self.arraysize)
+
+    def fetchall(self):
+        return self._traced_fetch(super().fetchall)
+
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        trace_sql("COMMIT", super().commit)
+
+
+SQL_TRACE_CODES = frozenset(
+    function.__code__
+    for function in (
+        sql_caller,
+        trace_sql,
+        TracedCursor.execute,
+        TracedCursor.executemany,
+        TracedCursor._traced_fetch,
+        TracedCursor.fetchone,
+        TracedCursor.fetchmany,
+        TracedCursor.fetchall,
+        TracedConnection.execute,
+        TracedConnection.executemany,
+        TracedConnection.commit,
+    )
+)
+
+
+def connect_db() -> sqlite3.Connection:
+    if not SQL_TRACE:
+        return sqlite3.connect(DB_PATH)
+    return sqlite3.connect(DB_PATH, timeout=0, factory=TracedConnection)
+
+
 def get_db():
     if "db" not in g:
-        g.db = sqlite3.connect(DB_PATH)
+        g.db = connect_db()
         g.db.row_factory = sqlite3.Row
     return g.db
 
@@ -79,8 +567,15 @@ def close_db(_exception):
         db.close()
 
 
+# 表结构版本（PRAGMA user_version）：新增表、触发器或数据迁移时递增。init_db 在每个请求前调用，
+# 版本一致时只读一次文件头，不写库也不申请写锁；从旧快照恢复整库后版本较低，会在下一个请求时补齐
+SCHEMA_VERSION = 5
+
+
 def init_db():
     db = get_db()
+    if db.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
     db.execute(
         """
         CREATE TABLE IF NOT EXISTS users (
@@ -136,6 +631,72 @@ def init_db():
         """
     )
     ensure_auto_send_table(db)
+    # tg_accounts.session_text 已废弃（保留空字符串以兼容旧备份的表结构），会话密文只在发送或刷新会话时按账号读取
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tg_account_secrets (
+            account_id INTEGER PRIMARY KEY,
+            session_blob TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        """
+    )
+    # 调度进程登记与账号租约只在本机多个进程间协调，不在 APP_TABLES 中
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tg_dispatchers (
+            worker_id TEXT PRIMARY KEY,
+            pid INTEGER NOT NULL,
+            started_at TEXT NOT NULL,
+            heartbeat_at REAL NOT NULL,
+            metrics TEXT
+        )
+        """
+    )
+    if "metrics" not in {col[1] for col in db.execute("PRAGMA table_info(tg_dispatchers)").fetchall()}:
+        db.execute("ALTER TABLE tg_dispatchers ADD COLUMN metrics TEXT")
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tg_dispatch_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner TEXT NOT NULL,
+            event TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tg_dispatch_leases (
+            account_id INTEGER PRIMARY KEY,
+            worker_id TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """
+    )
+    # 发送记录与发送计数（模板变量 {count}）只保存在本地，不在 APP_TABLES 中，不参与云端备份
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tg_auto_send_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            ok INTEGER NOT NULL,
+            total_seconds REAL NOT NULL,
+            timings TEXT NOT NULL
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tg_task_counters (
+            task_id INTEGER PRIMARY KEY,
+            sent INTEGER NOT NULL
+        )
+        """
+    )
     db.execute(
         """
         CREATE TABLE IF NOT EXISTS tg_login_flows (
@@ -157,9 +718,135 @@ def init_db():
         )
         """
     )
+    # 列表接口按 account_id 过滤后按 id 倒序分页，索引隐含 rowid，可直接按索引顺序读取
+    db.execute("CREATE INDEX IF NOT EXISTS idx_tg_dialogs_account ON tg_dialogs (account_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_tg_dialogs_account_dialog ON tg_dialogs (account_id, dialog_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_tg_auto_send_tasks_owner_account ON tg_auto_send_tasks (owner, account_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_tg_auto_send_runs_task ON tg_auto_send_runs (task_id, id)")
+    ensure_dialog_search_index(db)
+    ensure_sync_tables(db)
+    migrate_plaintext_sessions(db)
+    db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     db.commit()
 
 
+def session_key_material() -> str:
+    material = os.environ.get("TGHELPER_SESSION_KEY", "")
+    if material:
+        return material
+    # 每次从文件读取（文件很小），在网页上导入密钥后独立的调度进程无需重启
+    try:
+        return SESSION_KEY_FILE.read_text(encoding="ascii").strip()
+    except FileNotFoundError:
+        pass
+    # 先写临时文件再硬链接到目标路径，多个进程同时首次启动时只有一个能创建成功，其余读取已有密钥
+    tmp_path = SESSION_KEY_FILE.with_name(f"{SESSION_KEY_FILE.name}.{token_urlsafe(6)}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w", encoding="ascii") as handle:
+        handle.write(token_urlsafe(32))
+    try:
+        os.link(tmp_path, SESSION_KEY_FILE)
+    except FileExistsError:
+        pass
+    finally:
+        tmp_path.unlink()
+    return SESSION_KEY_FILE.read_text(encoding="ascii").strip()
+
+
+@functools.lru_cache(maxsize=4)
+def derive_session_keys(material: str) -> tuple[bytes, bytes]:
+    seed = material.encode("utf-8")
+    return hashlib.sha256(b"tghelper-session-enc:" + seed).digest(), hashlib.sha256(b"tghelper-session-mac:" + seed).digest()
+
+
+def session_cipher_keys() -> tuple[bytes, bytes]:
+    return derive_session_keys(session_key_material())
+
+
+def is_admin_user(db: sqlite3.Connection, username: str) -> bool:
+    # 第一个注册的用户视为管理员
+    row = db.execute("SELECT username FROM users ORDER BY id LIMIT 1").fetchone()
+    return bool(row) and row[0] == username
+
+
+def session_key_admin_error(db: sqlite3.Connection, username: str, password: str) -> str | None:
+    # 会话密钥能解密所有用户的账号会话，只允许管理员在重新输入密码后导出或导入
+    if not is_admin_user(db, username):
+        return "只有管理员（第一个注册的用户）可以导出或导入会话密钥。"
+    user = db.execute("SELECT password_hash FROM users WHERE username = ?", (username,)).fetchone()
+    if not user or not check_password_hash(user[0], password.strip()):
+        return "密码错误，未导出或导入会话密钥。"
+    return None
+
+
+def import_session_key(db: sqlite3.Connection, material: str) -> str:
+    # 换机器恢复备份时导入原来的密钥；要求能解密现有的账号会话，避免导入错误的密钥
+    material = material.strip()
+    if os.environ.get("TGHELPER_SESSION_KEY"):
+        raise ValueError("当前密钥由环境变量 TGHELPER_SESSION_KEY 提供，请修改环境变量后重启。")
+    if len(material) < 16 or not material.isascii() or any(ch.isspace() for ch in material):
+        raise ValueError("密钥格式不正确。")
+    blobs = [row[0] for row in db.execute("SELECT session_blob FROM tg_account_secrets")]
+    if blobs:
+        enc_key, mac_key = derive_session_keys(material)
+        readable = sum(1 for blob in blobs if session_blob_matches(blob, mac_key))
+        if not readable:
+            raise ValueError("该密钥无法解密任何现有账号会话，未导入。")
+    else:
+        readable = 0
+    tmp_path = SESSION_KEY_FILE.with_name(f"{SESSION_KEY_FILE.name}.{token_urlsafe(6)}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w", encoding="ascii") as handle:
+        handle.write(material)
+    os.replace(tmp_path, SESSION_KEY_FILE)
+    return f"会话密钥已导入，可解密 {readable}/{len(blobs)} 个账号会话。"
+
+
+def session_blob_matches(blob: str, mac_key: bytes) -> bool:
+    try:
+        raw = base64.urlsafe_b64decode(blob.removeprefix("v1:"))
+    except ValueError:
+        return False
+    return blob.startswith("v1:") and len(raw) > 48 and hmac.compare_digest(raw[-32:], hmac.new(mac_key, raw[:-32], hashlib.sha256).digest())
+
+
+def encrypt_session(session_text: str) -> str:
+    # AES-256-CTR 加密后附 HMAC-SHA256 校验
+    enc_key, mac_key = session_cipher_keys()
+    nonce = os.urandom(16)
+    body = nonce + AESModeCTR(enc_key, nonce).encrypt(session_text.encode("utf-8"))
+    return "v1:" + base64.urlsafe_b64encode(body + hmac.new(mac_key, body, hashlib.sha256).digest()).decode("ascii")
+
+
+def decrypt_session(blob: str) -> str:
+    enc_key, mac_key = session_cipher_keys()
+    if not session_blob_matches(blob, mac_key):
+        raise RuntimeError("账号会话无法解密，请在数据库管理页导入原来的会话密钥或重新登录该账号。")
+    body = base64.urlsafe_b64decode(blob.removeprefix("v1:"))[:-32]
+    return AESModeCTR(enc_key, body[:16]).decrypt(body[16:]).decode("utf-8")
+
+
+def save_account_session(db: sqlite3.Connection, account_id: int, session_text: str) -> None:
+    db.execute(
+        "INSERT OR REPLACE INTO tg_account_secrets (account_id, session_blob, updated_at) VALUES (?, ?, ?)",
+        (account_id, encrypt_session(session_text), datetime.utcnow().isoformat()),
+    )
+
+
+def load_account_session(db: sqlite3.Connection, account_id: int) -> str | None:
+    row = db.execute("SELECT session_blob FROM tg_account_secrets WHERE account_id = ?", (account_id,)).fetchone()
+    return decrypt_session(row[0]) if row else None
+
+
+def migrate_plaintext_sessions(db: sqlite3.Connection) -> None:
+    # 旧数据（含从旧备份拉取的数据）中的明文会话移入 tg_account_secrets 并清空原列；进行中的登录流程就地加密
+    for account_id, session_text in db.execute("SELECT id, session_text FROM tg_accounts WHERE session_text != ''").fetchall():
+        save_account_session(db, account_id, session_text)
+        db.execute("UPDATE tg_accounts SET session_text = '' WHERE id = ?", (account_id,))
+    for flow_id, session_text in db.execute("SELECT id, session_text FROM tg_login_flows WHERE session_text NOT LIKE 'v1:%'").fetchall():
+        db.execute("UPDATE tg_login_flows SET session_text = ? WHERE id = ?", (encrypt_session(session_text), flow_id))
+
+
 def has_users() -> bool:
     db = get_db()
     cur = db.execute("SELECT COUNT(1) AS cnt FROM users")
@@ -260,6 +947,515 @@ def ensure_auto_send_table(db: sqlite3.Connection) -> None:
     db.execute("DROP TABLE tg_auto_send_tasks_old")
 
 
+DIALOG_SEARCH_TRIGGERS = {
+    "tg_dialogs_fts_ai": """
+        CREATE TRIGGER IF NOT EXISTS tg_dialogs_fts_ai AFTER INSERT ON tg_dialogs
+        BEGIN
+            INSERT INTO tg_dialogs_fts (rowid, title, username, dialog_id) VALUES (NEW.id, NEW.title, NEW.username, NEW.dialog_id);
+        END
+    """,
+    "tg_dialogs_fts_ad": """
+        CREATE TRIGGER IF NOT EXISTS tg_dialogs_fts_ad AFTER DELETE ON tg_dialogs
+        BEGIN
+            INSERT INTO tg_dialogs_fts (tg_dialogs_fts, rowid, title, username, dialog_id) VALUES ('delete', OLD.id, OLD.title, OLD.username, OLD.dialog_id);
+        END
+    """,
+    "tg_dialogs_fts_au": """
+        CREATE TRIGGER IF NOT EXISTS tg_dialogs_fts_au AFTER UPDATE ON tg_dialogs
+        BEGIN
+            INSERT INTO tg_dialogs_fts (tg_dialogs_fts, rowid, title, username, dialog_id) VALUES ('delete', OLD.id, OLD.title, OLD.username, OLD.dialog_id);
+            INSERT INTO tg_dialogs_fts (rowid, title, username, dialog_id) VALUES (NEW.id, NEW.title, NEW.username, NEW.dialog_id);
+        END
+    """,
+}
+
+
+def ensure_dialog_search_index(db: sqlite3.Connection) -> bool:
+    # 会话搜索索引：trigram 分词的 FTS5 外部内容表，中文标题也能按任意子串匹配；SQLite 未编译 FTS5 时退回 LIKE
+    exists = db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tg_dialogs_fts'").fetchone()
+    try:
+        if not exists:
+            db.execute(
+                "CREATE VIRTUAL TABLE tg_dialogs_fts USING fts5("
+                "title, username, dialog_id, content='tg_dialogs', content_rowid='id', tokenize='trigram')"
+            )
+            db.execute("INSERT INTO tg_dialogs_fts (tg_dialogs_fts) VALUES ('rebuild')")
+        for trigger_sql in DIALOG_SEARCH_TRIGGERS.values():
+            db.execute(trigger_sql)
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def has_dialog_search_index(db: sqlite3.Connection) -> bool:
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tg_dialogs_fts'").fetchone() is not None
+
+
+def ensure_sync_tables(db: sqlite3.Connection) -> None:
+    # sync_changelog 每个 (表, 主键) 只保留最新一条，seq 单调递增；仅在存在同步目标时记录
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_changelog (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_key NOT NULL,
+            UNIQUE(table_name, row_key)
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            target TEXT PRIMARY KEY,
+            watermark INTEGER,
+            synced_at TEXT
+        )
+        """
+    )
+    # 每表一个版本号，任何写入都会递增，用于判断缓存的内容校验和是否仍然有效
+    had_row_checksums = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sync_row_checksums'"
+    ).fetchone() is not None
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_table_versions (
+            table_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            checksum TEXT,
+            checksum_version INTEGER,
+            row_count INTEGER
+        )
+        """
+    )
+    # 表校验和是各行摘要的异或：保存每行摘要，触发器只记下改动过的主键，重算时只处理这些行
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_row_checksums (
+            table_name TEXT NOT NULL,
+            row_key NOT NULL,
+            checksum INTEGER NOT NULL,
+            PRIMARY KEY (table_name, row_key)
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_dirty_rows (
+            table_name TEXT NOT NULL,
+            row_key NOT NULL,
+            PRIMARY KEY (table_name, row_key)
+        )
+        """
+    )
+    # 已同步到各 D1 库的表结构摘要只属于本机，放在 app_settings 会随备份上传并在拉取时被覆盖
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_d1_schemas (
+            db_id TEXT PRIMARY KEY,
+            schema_hash TEXT NOT NULL,
+            checked_at TEXT NOT NULL
+        )
+        """
+    )
+    db.execute("DELETE FROM app_settings WHERE key = 'cf_d1_schema_hash'")
+    if not had_row_checksums:
+        # 旧版本按整表顺序计算的校验和无法增量更新，清空后下次全量重算一次
+        db.execute("UPDATE sync_table_versions SET checksum = NULL, checksum_version = NULL")
+    for table in APP_TABLES:
+        key = APP_TABLE_KEYS.get(table, "id")
+        db.execute("INSERT OR IGNORE INTO sync_table_versions (table_name) VALUES (?)", (table,))
+        # 尚无校验和时会整表计算，无需记录改动行
+        has_checksum = f"(SELECT checksum FROM sync_table_versions WHERE table_name = '{table}') IS NOT NULL"
+        db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS sync_{table}_hi AFTER INSERT ON {table}
+            WHEN {has_checksum}
+            BEGIN
+                INSERT OR IGNORE INTO sync_dirty_rows (table_name, row_key) VALUES ('{table}', NEW.{key});
+            END
+            """
+        )
+        db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS sync_{table}_hu AFTER UPDATE ON {table}
+            WHEN {has_checksum}
+            BEGIN
+                INSERT OR IGNORE INTO sync_dirty_rows (table_name, row_key) VALUES ('{table}', OLD.{key});
+                INSERT OR IGNORE INTO sync_dirty_rows (table_name, row_key) VALUES ('{table}', NEW.{key});
+            END
+            """
+        )
+        db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS sync_{table}_hd AFTER DELETE ON {table}
+            WHEN {has_checksum}
+            BEGIN
+                INSERT OR IGNORE INTO sync_dirty_rows (table_name, row_key) VALUES ('{table}', OLD.{key});
+            END
+            """
+        )
+        for suffix, event in (("vi", "INSERT"), ("vu", "UPDATE"), ("vd", "DELETE")):
+            db.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS sync_{table}_{suffix} AFTER {event} ON {table}
+                BEGIN
+                    UPDATE sync_table_versions SET version = version + 1 WHERE table_name = '{table}';
+                END
+                """
+            )
+        db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS sync_{table}_ai AFTER INSERT ON {table}
+            WHEN EXISTS (SELECT 1 FROM sync_state)
+            BEGIN
+                INSERT OR REPLACE INTO sync_changelog (table_name, row_key) VALUES ('{table}', NEW.{key});
+            END
+            """
+        )
+        db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS sync_{table}_au AFTER UPDATE ON {table}
+            WHEN EXISTS (SELECT 1 FROM sync_state)
+            BEGIN
+                INSERT OR REPLACE INTO sync_changelog (table_name, row_key) SELECT '{table}', OLD.{key} WHERE OLD.{key} IS NOT NEW.{key};
+                INSERT OR REPLACE INTO sync_changelog (table_name, row_key) VALUES ('{table}', NEW.{key});
+            END
+            """
+        )
+        db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS sync_{table}_ad AFTER DELETE ON {table}
+            WHEN EXISTS (SELECT 1 FROM sync_state)
+            BEGIN
+                INSERT OR REPLACE INTO sync_changelog (table_name, row_key) VALUES ('{table}', OLD.{key});
+            END
+            """
+        )
+
+
+def get_sync_watermark(db: sqlite3.Connection, target: str) -> int | None:
+    row = db.execute("SELECT watermark FROM sync_state WHERE target = ?", (target,)).fetchone()
+    return row[0] if row else None
+
+
+def get_sync_changelog_head(db: sqlite3.Connection) -> int:
+    row = db.execute("SELECT COALESCE(MAX(seq), 0) FROM sync_changelog").fetchone()
+    return row[0]
+
+
+def begin_sync_tracking(db: sqlite3.Connection, target: str) -> int:
+    # 先登记同步目标以开启触发器记录，再取当前位置，避免全量上传期间的改动丢失
+    db.execute("INSERT OR IGNORE INTO sync_state (target, watermark, synced_at) VALUES (?, NULL, NULL)", (target,))
+    db.commit()
+    return get_sync_changelog_head(db)
+
+
+def set_sync_watermark(db: sqlite3.Connection, target: str, watermark: int) -> None:
+    db.execute(
+        "INSERT OR REPLACE INTO sync_state (target, watermark, synced_at) VALUES (?, ?, ?)",
+        (target, watermark, datetime.now().isoformat()),
+    )
+    db.execute(
+        "DELETE FROM sync_changelog WHERE seq <= (SELECT COALESCE(MIN(COALESCE(watermark, 0)), 0) FROM sync_state)"
+    )
+    db.commit()
+
+
+# 备份流程自己写回的记录，不计入校验和，否则 app_settings 每次备份后都会变化而无法跳过
+CHECKSUM_EXCLUDED_KEYS = {"app_settings": ("db_auto_backup_last_date", "db_auto_backup_last_result")}
+CHECKSUM_MASK = (1 << 64) - 1
+
+
+def row_checksum(table: str, row) -> int:
+    # row 的第一列是主键，其后为整行内容；返回有符号 64 位整数以便存入 SQLite
+    if row is None or row[0] in CHECKSUM_EXCLUDED_KEYS.get(table, ()):
+        return 0
+    digest = hashlib.sha256(json.dumps(list(row)[1:], ensure_ascii=False, default=str).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+def compute_table_checksum(db: sqlite3.Connection, table: str) -> tuple[str, int]:
+    cached = db.execute(
+        "SELECT version, checksum, checksum_version, row_count FROM sync_table_versions WHERE table_name = ?",
+        (table,),
+    ).fetchone()
+    if cached and cached[1] and cached[2] == cached[0]:
+        return cached[1], cached[3]
+
+    key = APP_TABLE_KEYS.get(table, "id")
+    # 持写锁重算，避免处理改动行期间其他连接再次改动同一行而丢失标记
+    if not db.in_transaction:
+        db.execute("BEGIN IMMEDIATE")
+    version = db.execute("SELECT version FROM sync_table_versions WHERE table_name = ?", (table,)).fetchone()
+    if cached and cached[1]:
+        combined = int(cached[1], 16)
+        row_count = cached[3]
+        dirty_keys = [row[0] for row in db.execute("SELECT row_key FROM sync_dirty_rows WHERE table_name = ?", (table,))]
+        for row_key in dirty_keys:
+            stored = db.execute(
+                "SELECT checksum FROM sync_row_checksums WHERE table_name = ? AND row_key = ?",
+                (table, row_key),
+            ).fetchone()
+            row = db.execute(f"SELECT {key}, * FROM {table} WHERE {key} = ?", (row_key,)).fetchone()
+            if stored:
+                combined ^= stored[0] & CHECKSUM_MASK
+                row_count -= 1
+            if row is None:
+                db.execute("DELETE FROM sync_row_checksums WHERE table_name = ? AND row_key = ?", (table, row_key))
+                continue
+            value = row_checksum(table, row)
+            combined ^= value & CHECKSUM_MASK
+            row_count += 1
+            db.execute(
+                "INSERT OR REPLACE INTO sync_row_checksums (table_name, row_key, checksum) VALUES (?, ?, ?)",
+                (table, row_key, value),
+            )
+    else:
+        combined = 0
+        row_count = 0
+        db.execute("DELETE FROM sync_row_checksums WHERE table_name = ?", (table,))
+        rows = []
+        for row in db.execute(f"SELECT {key}, * FROM {table}"):
+            value = row_checksum(table, row)
+            combined ^= value & CHECKSUM_MASK
+            row_count += 1
+            rows.append((table, row[0], value))
+        db.executemany("INSERT INTO sync_row_checksums (table_name, row_key, checksum) VALUES (?, ?, ?)", rows)
+    db.execute("DELETE FROM sync_dirty_rows WHERE table_name = ?", (table,))
+    checksum = f"{combined:016x}"
+    if version:
+        db.execute(
+            "UPDATE sync_table_versions SET checksum = ?, checksum_version = ?, row_count = ? WHERE table_name = ?",
+            (checksum, version[0], row_count, table),
+        )
+    db.commit()
+    return checksum, row_count
+
+
+def refresh_table_checksums(db: sqlite3.Connection) -> None:
+    # 在本地库上增量更新后再做快照，快照里的校验和直接可用，本地也不必再整表重算
+    for table in APP_TABLES:
+        compute_table_checksum(db, table)
+
+
+class Metrics:
+    # 每个线程写自己的分片，热路径不加锁；抓取时把各分片的快照相加
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: list[dict] = []
+        self._lock = threading.Lock()
+        self._gauges: dict[tuple, float] = {}
+        self._callbacks: dict[str, object] = {}
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = {}
+            with self._lock:
+                self._shards.append(values)
+            self._local.values = values
+            return values
+
+    def inc(self, name: str, labels: tuple = (), amount: float = 1) -> None:
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, labels: tuple = ()) -> None:
+        shard = self._shard()
+        key = (name, labels)
+        bucket = shard.get(key)
+        if bucket is None:
+            bucket = shard[key] = [0] * (len(METRIC_BUCKETS) + 2)
+        for index, bound in enumerate(METRIC_BUCKETS):
+            if value <= bound:
+                bucket[index] += 1
+                break
+        else:
+            bucket[len(METRIC_BUCKETS)] += 1
+        bucket[-1] += value
+
+    def set_gauge(self, name: str, value: float, labels: tuple = ()) -> None:
+        self._gauges[(name, labels)] = value
+
+    def gauge_callback(self, name: str, callback) -> None:
+        self._callbacks[name] = callback
+
+    def collect(self) -> dict[tuple, object]:
+        with self._lock:
+            shards = list(self._shards)
+        merged: dict[tuple, object] = {}
+        for shard in shards:
+            for key, value in shard.copy().items():
+                if isinstance(value, list):
+                    total = merged.setdefault(key, [0] * len(value))
+                    for index, item in enumerate(list(value)):
+                        total[index] += item
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        merged.update(self._gauges)
+        for name, callback in list(self._callbacks.items()):
+            merged[(name, ())] = callback()
+        return merged
+
+    def render(self, extra: dict[tuple, object] | None = None) -> str:
+        merged = self.collect()
+        if extra:
+            merged.update(extra)
+        lines = []
+        for name, (kind, help_text) in METRIC_DEFINITIONS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            series = sorted((labels, value) for (metric, labels), value in merged.items() if metric == name)
+            for labels, value in series:
+                if kind != "histogram":
+                    lines.append(f"{name}{format_metric_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip([f"{bound:g}" for bound in METRIC_BUCKETS] + ["+Inf"], value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{format_metric_labels(labels)} {value[-1]:.6f}")
+                lines.append(f"{name}_count{format_metric_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def format_metric_labels(labels: tuple) -> str:
+    # 标签值都来自代码中的固定取值（阶段名、状态码等），不需要转义
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+METRICS = Metrics()
+
+
+def observe_phase(phase: str, started: float, timings: dict | None = None) -> float:
+    now = time.perf_counter()
+    METRICS.observe("tghelper_telegram_phase_seconds", now - started, (("phase", phase),))
+    if timings is not None:
+        timings[phase] = round(now - started, 3)
+    return now
+
+
+def record_send_result(source: str, ok: bool, started: float, exc: Exception | None = None, timings: dict | None = None) -> None:
+    elapsed = time.perf_counter() - started
+    METRICS.inc("tghelper_sends_total", (("source", source), ("result", "sent" if ok else "failed")))
+    METRICS.observe("tghelper_send_seconds", elapsed, (("source", source),))
+    if isinstance(exc, FloodWaitError):
+        METRICS.inc("tghelper_send_flood_waits_total")
+    if timings is not None:
+        timings["total"] = round(elapsed, 3)
+
+
+def record_send_run(conn: sqlite3.Connection, task_id: int, source: str, ok: bool, timings: dict, counted: bool = False) -> None:
+    # 与任务状态的更新在同一次提交中写入，并只保留该任务最近 SEND_RUN_HISTORY 条
+    conn.execute(
+        "INSERT INTO tg_auto_send_runs (task_id, source, started_at, ok, total_seconds, timings) VALUES (?, ?, ?, ?, ?, ?)",
+        (task_id, source, datetime.now().isoformat(), 1 if ok else 0, timings.get("total", 0), json.dumps(timings)),
+    )
+    conn.execute(
+        """
+        DELETE FROM tg_auto_send_runs
+        WHERE task_id = ? AND id <= (SELECT id FROM tg_auto_send_runs WHERE task_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)
+        """,
+        (task_id, task_id, SEND_RUN_HISTORY),
+    )
+    if ok and counted:
+        conn.execute(
+            "INSERT INTO tg_task_counters (task_id, sent) VALUES (?, 1) ON CONFLICT(task_id) DO UPDATE SET sent = sent + 1",
+            (task_id,),
+        )
+    if SLOW_SEND_SECONDS and timings.get("total", 0) >= SLOW_SEND_SECONDS:
+        breakdown = ", ".join(f"{phase}={seconds:.3f}s" for phase, seconds in timings.items())
+        app.logger.warning("发送较慢：任务 %s（%s，%s）%s", task_id, source, "成功" if ok else "失败", breakdown)
+
+
+def parse_profile_int(value: str | None, default: int) -> int:
+    try:
+        return max(int(value), 0) if value else default
+    except ValueError:
+        return default
+
+
+def profile_selected(target: str, path: str | None = None) -> bool:
+    if not app.config.get("PROFILE_ENABLED") or target not in app.config.get("PROFILE_TARGETS", PROFILE_TARGETS):
+        return False
+    if path is not None and not path.startswith(app.config.get("PROFILE_PATH_PREFIX") or "/"):
+        return False
+    sample = app.config.get("PROFILE_SAMPLE") or 1
+    return sample <= 1 or random.randrange(sample) == 0
+
+
+def start_profile() -> cProfile.Profile | None:
+    # cProfile 在同一进程内不能同时运行多个，正在分析其他请求或任务时不阻塞，直接放弃本次
+    if not PROFILE_LOCK.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        PROFILE_LOCK.release()
+        return None
+    return profiler
+
+
+def finish_profile(profiler: cProfile.Profile, target: str, name: str, started: float) -> None:
+    profiler.disable()
+    PROFILE_LOCK.release()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms < (app.config.get("PROFILE_MIN_MS") or 0):
+        return
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_")[:60] or "root"
+    path = PROFILE_DIR / f"{datetime.now():%Y%m%d-%H%M%S-%f}-{target}-{slug}-{int(elapsed_ms)}ms.prof"
+    try:
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(path)
+        for old in list_profile_dumps()[PROFILE_KEEP:]:
+            old.unlink(missing_ok=True)
+    except OSError as exc:
+        app.logger.warning("保存性能分析结果失败：%s", exc)
+
+
+def run_profiled(target: str, name: str, func, *args):
+    profiler = start_profile() if profile_selected(target) else None
+    if profiler is None:
+        return func(*args)
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        finish_profile(profiler, target, name, started)
+
+
+def list_profile_dumps() -> list[Path]:
+    # 文件名以时间开头，按名称倒序即最新在前
+    if not PROFILE_DIR.is_dir():
+        return []
+    return sorted(PROFILE_DIR.glob("*.prof"), key=lambda path: path.name, reverse=True)
+
+
+def profile_hotspots(paths: list[Path], sort_key: str, limit: int = PROFILE_TOP) -> tuple[list[dict], float]:
+    stats = pstats.Stats(str(paths[0]))
+    for path in paths[1:]:
+        stats.add(str(path))
+    rows = []
+    for (filename, line, function), (primitive_calls, calls, own_seconds, cumulative_seconds, _callers) in stats.stats.items():
+        location = "" if filename == "~" else f"{Path(filename).parent.name}/{Path(filename).name}:{line}"
+        rows.append(
+            {
+                "function": function,
+                "location": location,
+                "calls": calls if calls == primitive_calls else f"{calls}/{primitive_calls}",
+                "tottime": own_seconds,
+                "cumtime": cumulative_seconds,
+            }
+        )
+    rows.sort(key=lambda row: row[sort_key], reverse=True)
+    return rows[:limit], stats.total_tt
+
+
 async def send_tg_login_code(phone: str) -> tuple[bool, str | None, str | None, str | None]:
     api_id = app.config.get("TELEGRAM_API_ID")
     api_hash = app.config.get("TELEGRAM_API_HASH")
@@ -340,6 +1536,7 @@ async def fetch_recent_dialogs(session_text: str, limit: int = 30) -> list[dict]
         retry_delay=1,
     )
     dialogs = []
+    METRICS.inc("tghelper_telegram_clients_open")
     try:
         await client.connect()
         async for dialog in client.iter_dialogs(limit=limit):
@@ -353,10 +1550,11 @@ async def fetch_recent_dialogs(session_text: str, limit: int = 30) -> list[dict]
             )
     finally:
         await client.disconnect()
+        METRICS.inc("tghelper_telegram_clients_open", amount=-1)
     return dialogs
 
 
-async def send_message_to_dialog(session_text: str, dialog_id: str, message: str) -> None:
+async def send_message_to_dialog(session_text: str, dialog_id: str, message: str, timings: dict | None = None) -> None:
     api_id = app.config.get("TELEGRAM_API_ID")
     api_hash = app.config.get("TELEGRAM_API_HASH")
     if not api_id or not api_hash:
@@ -370,15 +1568,21 @@ async def send_message_to_dialog(session_text: str, dialog_id: str, message: str
         connection_retries=1,
         retry_delay=1,
     )
+    METRICS.inc("tghelper_telegram_clients_open")
     try:
+        started = time.perf_counter()
         await client.connect()
+        started = observe_phase("connect", started, timings)
         target = await resolve_dialog_target(client, dialog_id)
+        started = observe_phase("resolve", started, timings)
         await client.send_message(target, append_utc8_timestamp(message))
+        observe_phase("send", started, timings)
     finally:
         await client.disconnect()
+        METRICS.inc("tghelper_telegram_clients_open", amount=-1)
 
 
-async def send_and_fetch_reply(session_text: str, dialog_id: str, message: str) -> str | None:
+async def send_and_fetch_reply(session_text: str, dialog_id: str, message: str, timings: dict | None = None) -> str | None:
     api_id = app.config.get("TELEGRAM_API_ID")
     api_hash = app.config.get("TELEGRAM_API_HASH")
     if not api_id or not api_hash:
@@ -392,12 +1596,19 @@ async def send_and_fetch_reply(session_text: str, dialog_id: str, message: str)
         connection_retries=1,
         retry_delay=1,
     )
+    METRICS.inc("tghelper_telegram_clients_open")
     try:
+        started = time.perf_counter()
         await client.connect()
+        started = observe_phase("connect", started, timings)
         target = await resolve_dialog_target(client, dialog_id)
+        started = observe_phase("resolve", started, timings)
         await client.send_message(target, append_utc8_timestamp(message))
-        await asyncio.sleep(2)
+        started = observe_phase("send", started, timings)
+        await asyncio.sleep(SEND_REPLY_WAIT)
+        started = observe_phase("wait", started, timings)
         messages = await client.get_messages(target, limit=5)
+        observe_phase("reply", started, timings)
         for msg in messages:
             if not msg.out:
                 reply_text = msg.message or ""
@@ -405,6 +1616,7 @@ async def send_and_fetch_reply(session_text: str, dialog_id: str, message: str)
         return None
     finally:
         await client.disconnect()
+        METRICS.inc("tghelper_telegram_clients_open", amount=-1)
 
 
 async def resolve_dialog_target(client: TelegramClient, dialog_id: str):
@@ -492,7 +1704,7 @@ def test_proxy_connection() -> tuple[bool, str]:
 def load_api_config():
     db = get_db()
     rows = db.execute(
-        "SELECT key, value FROM app_settings WHERE key IN ('telegram_api_id', 'telegram_api_hash', 'proxy_host', 'proxy_port', 'proxy_username', 'proxy_password', 'cf_api_token', 'cf_account_id', 'cf_d1_database_name', 'cf_d1_database_id', 'cf_use_d1', 'db_auto_backup_enabled', 'db_auto_backup_time', 'db_auto_backup_last_date', 'db_auto_backup_last_result')"
+        "SELECT key, value FROM app_settings WHERE key IN ('telegram_api_id', 'telegram_api_hash', 'proxy_host', 'proxy_port', 'proxy_username', 'proxy_password', 'cf_api_token', 'cf_account_id', 'cf_d1_database_name', 'cf_d1_database_id', 'cf_use_d1', 'db_auto_backup_enabled', 'db_auto_backup_time', 'db_auto_backup_last_date', 'db_auto_backup_last_result', 'db_auto_backup_target', 'db_local_snapshot_keep', 'profile_enabled', 'profile_targets', 'profile_path_prefix', 'profile_sample', 'profile_min_ms')"
     ).fetchall()
     data = {row["key"]: row["value"] for row in rows}
     app.config["TELEGRAM_API_ID"] = os.environ.get("TELEGRAM_API_ID") or data.get("telegram_api_id")
@@ -510,12 +1722,22 @@ def load_api_config():
     app.config["DB_AUTO_BACKUP_TIME"] = data.get("db_auto_backup_time") or "03:30"
     app.config["DB_AUTO_BACKUP_LAST_DATE"] = data.get("db_auto_backup_last_date") or ""
     app.config["DB_AUTO_BACKUP_LAST_RESULT"] = data.get("db_auto_backup_last_result") or ""
+    app.config["DB_AUTO_BACKUP_TARGET"] = data.get("db_auto_backup_target") or "d1"
+    app.config["DB_LOCAL_SNAPSHOT_KEEP"] = parse_snapshot_keep(data.get("db_local_snapshot_keep"))
+    app.config["PROFILE_ENABLED"] = PROFILE_ENV_ENABLED or data.get("profile_enabled") == "1"
+    app.config["PROFILE_TARGETS"] = [item for item in (data.get("profile_targets") or ",".join(PROFILE_TARGETS)).split(",") if item in PROFILE_TARGETS]
+    app.config["PROFILE_PATH_PREFIX"] = data.get("profile_path_prefix") or ""
+    app.config["PROFILE_SAMPLE"] = parse_profile_int(data.get("profile_sample"), 1)
+    app.config["PROFILE_MIN_MS"] = parse_profile_int(data.get("profile_min_ms"), 0)
 
 
 def run_async(coro):
+    # 只在当前线程没有运行中的事件循环时用 asyncio.run；协程自身抛出的 RuntimeError 要原样传出
     try:
-        return asyncio.run(coro)
+        asyncio.get_running_loop()
     except RuntimeError:
+        return asyncio.run(coro)
+    else:
         loop = asyncio.new_event_loop()
         try:
             asyncio.set_event_loop(loop)
@@ -524,28 +1746,150 @@ def run_async(coro):
             loop.close()
 
 
-def cloudflare_request(api_token: str, method: str, url: str, payload: dict | None = None) -> dict:
-    headers = {
-        "Authorization": f"Bearer {api_token}",
-        "Content-Type": "application/json",
-    }
-    data = json.dumps(payload).encode("utf-8") if payload is not None else None
-    req = urlrequest.Request(url=url, data=data, method=method, headers=headers)
-    try:
-        with urlrequest.urlopen(req, timeout=15) as resp:
-            return json.loads(resp.read().decode("utf-8"))
-    except urlerror.HTTPError as exc:
-        raw = exc.read().decode("utf-8", errors="ignore")
+class CloudflareClient:
+    # 复用 keep-alive 连接的 Cloudflare API 客户端，429/5xx 与网络错误按指数退避重试；与 urlopen 一样读取 HTTPS_PROXY/HTTP_PROXY/NO_PROXY
+    def __init__(self, max_connections: int = CF_MAX_CONNECTIONS, timeout: float = 15, max_retries: int = CF_MAX_RETRIES):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._idle: dict[tuple[str, str, str | None], list] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _proxy_for(scheme: str, netloc: str) -> str | None:
+        proxy = getproxies().get(scheme)
+        if not proxy or proxy_bypass(urlsplit(f"{scheme}://{netloc}").hostname or netloc):
+            return None
+        return proxy if "://" in proxy else f"http://{proxy}"
+
+    @staticmethod
+    def _proxy_headers(proxy: str) -> dict:
+        parts = urlsplit(proxy)
+        if not parts.username:
+            return {}
+        credentials = f"{unquote(parts.username)}:{unquote(parts.password or '')}".encode("utf-8")
+        return {"Proxy-Authorization": "Basic " + base64.b64encode(credentials).decode("ascii")}
+
+    @staticmethod
+    def _dropped(conn: httpclient.HTTPConnection) -> bool:
+        # 空闲连接上出现可读数据（通常是服务端关闭时的 EOF）说明连接已失效，发请求前就丢弃
+        if conn.sock is None:
+            return True
         try:
-            return json.loads(raw)
-        except Exception:
-            return {"success": False, "errors": [{"message": raw or str(exc)}]}
-    except Exception as exc:
-        return {"success": False, "errors": [{"message": str(exc)}]}
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def _checkout(self, scheme: str, netloc: str, proxy: str | None) -> tuple[httpclient.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get((scheme, netloc, proxy))
+            while idle:
+                conn = idle.pop()
+                if not self._dropped(conn):
+                    return conn, True
+                conn.close()
+        conn_cls = httpclient.HTTPSConnection if scheme == "https" else httpclient.HTTPConnection
+        if not proxy:
+            return conn_cls(netloc, timeout=self.timeout), False
+        proxy_parts = urlsplit(proxy)
+        if scheme == "https":
+            # 经代理 CONNECT 建立隧道后再做 TLS 握手
+            conn = conn_cls(proxy_parts.hostname, proxy_parts.port or 8080, timeout=self.timeout)
+            conn.set_tunnel(netloc, headers=self._proxy_headers(proxy))
+            return conn, False
+        return httpclient.HTTPConnection(proxy_parts.hostname, proxy_parts.port or 8080, timeout=self.timeout), False
+
+    def _checkin(self, scheme: str, netloc: str, proxy: str | None, conn: httpclient.HTTPConnection) -> None:
+        with self._lock:
+            self._idle.setdefault((scheme, netloc, proxy), []).append(conn)
+
+    def close(self) -> None:
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _backoff(self, attempt: int, retry_after: str | None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), 30.0)
+            except ValueError:
+                pass
+        return min(0.5 * (2 ** (attempt - 1)), 8.0) + random.uniform(0, 0.25)
+
+    def request(self, api_token: str, method: str, url: str, payload: dict | None = None, idempotent: bool | None = None) -> dict:
+        parts = urlsplit(url)
+        proxy = self._proxy_for(parts.scheme, parts.netloc)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        headers = {
+            "Authorization": f"Bearer {api_token}",
+            "Content-Type": "application/json",
+        }
+        if proxy and parts.scheme != "https":
+            # 明文 HTTP 经代理转发时请求行使用完整 URL
+            path = url
+            headers.update(self._proxy_headers(proxy))
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        # 请求写出后才失败时服务端可能已经执行（如建库、批量写入），只重发 GET 与调用方标明只读的请求
+        if idempotent is None:
+            idempotent = method == "GET"
+        attempt = 0
+        while True:
+            retry_after = None
+            with self._slots:
+                conn, reused = self._checkout(parts.scheme, parts.netloc, proxy)
+                started = time.perf_counter()
+                sent = False
+                try:
+                    conn.request(method, path, body=body, headers=headers)
+                    sent = True
+                    resp = conn.getresponse()
+                    raw = resp.read().decode("utf-8", errors="ignore")
+                    status = resp.status
+                    retry_after = resp.getheader("Retry-After")
+                except (httpclient.HTTPException, OSError) as exc:
+                    conn.close()
+                    METRICS.inc("tghelper_cloudflare_requests_total", (("status", "error"),))
+                    # 请求还没写完就失败的复用连接是服务端已关闭的空闲连接，直接换新连接，不计入重试次数
+                    if reused and not sent:
+                        continue
+                    if attempt >= self.max_retries or (sent and not idempotent):
+                        detail = str(exc) or exc.__class__.__name__
+                        if sent and not idempotent:
+                            detail = f"请求已发出但未收到响应（{detail}），为避免重复执行未自动重试"
+                        return {"success": False, "errors": [{"message": detail}]}
+                    status = None
+                else:
+                    METRICS.inc("tghelper_cloudflare_requests_total", (("status", str(status)),))
+                    METRICS.observe("tghelper_cloudflare_request_seconds", time.perf_counter() - started)
+                    if resp.will_close:
+                        conn.close()
+                    else:
+                        self._checkin(parts.scheme, parts.netloc, proxy, conn)
+
+            # 退避等待放在释放连接名额之后，不占用其他请求的并发额度
+            if (status is None or status == 429 or status >= 500) and attempt < self.max_retries:
+                attempt += 1
+                METRICS.inc("tghelper_cloudflare_retries_total")
+                time.sleep(self._backoff(attempt, retry_after))
+                continue
+            try:
+                return json.loads(raw)
+            except Exception:
+                return {"success": False, "errors": [{"message": raw or f"HTTP {status}"}]}
+
+
+CLOUDFLARE_CLIENT = CloudflareClient()
+
+
+def cloudflare_request(api_token: str, method: str, url: str, payload: dict | None = None, idempotent: bool | None = None) -> dict:
+    return CLOUDFLARE_CLIENT.request(api_token, method, url, payload, idempotent)
 
 
 def cloudflare_create_d1(api_token: str, account_id: str, db_name: str) -> tuple[bool, str, str | None]:
-    url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/d1/database"
+    url = f"{CF_API_BASE}/accounts/{account_id}/d1/database"
     result = cloudflare_request(api_token, "POST", url, {"name": db_name})
     if result.get("success") and result.get("result"):
         db_id = result["result"].get("uuid") or result["result"].get("id")
@@ -556,7 +1900,7 @@ def cloudflare_create_d1(api_token: str, account_id: str, db_name: str) -> tuple
 
 
 def cloudflare_get_first_account(api_token: str) -> tuple[bool, str, str | None]:
-    url = "https://api.cloudflare.com/client/v4/accounts?page=1&per_page=1"
+    url = f"{CF_API_BASE}/accounts?page=1&per_page=1"
     result = cloudflare_request(api_token, "GET", url)
     if result.get("success") and isinstance(result.get("result"), list) and result["result"]:
         account_id = result["result"][0].get("id")
@@ -571,7 +1915,7 @@ def cloudflare_test_token(api_token: str) -> tuple[bool, str, str | None]:
     ok, msg, account_id = cloudflare_get_first_account(api_token)
     if not ok or not account_id:
         return False, msg, None
-    url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/d1/database"
+    url = f"{CF_API_BASE}/accounts/{account_id}/d1/database"
     result = cloudflare_request(api_token, "GET", url)
     if result.get("success"):
         return True, "Cloudflare API 可用。", account_id
@@ -581,7 +1925,7 @@ def cloudflare_test_token(api_token: str) -> tuple[bool, str, str | None]:
 
 
 def cloudflare_find_d1_by_name(api_token: str, account_id: str, db_name: str) -> tuple[bool, str, str | None]:
-    url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/d1/database"
+    url = f"{CF_API_BASE}/accounts/{account_id}/d1/database"
     result = cloudflare_request(api_token, "GET", url)
     if result.get("success") and isinstance(result.get("result"), list):
         for item in result["result"]:
@@ -595,12 +1939,17 @@ def cloudflare_find_d1_by_name(api_token: str, account_id: str, db_name: str) ->
     return False, f"查询失败：{msg}", None
 
 
-def cloudflare_d1_query(api_token: str, account_id: str, db_id: str, sql: str, params: list | None = None) -> tuple[bool, list, str]:
-    url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/d1/database/{db_id}/query"
+def cloudflare_d1_query(
+    api_token: str, account_id: str, db_id: str, sql: str, params: list | None = None, idempotent: bool | None = None
+) -> tuple[bool, list, str]:
+    url = f"{CF_API_BASE}/accounts/{account_id}/d1/database/{db_id}/query"
     payload = {"sql": sql}
     if params is not None:
         payload["params"] = params
-    result = cloudflare_request(api_token, "POST", url, payload)
+    # D1 的查询接口都是 POST；只读语句重发无副作用，写语句由调用方声明是否可安全重发
+    if idempotent is None:
+        idempotent = sql.lstrip()[:6].upper() in ("SELECT", "PRAGMA")
+    result = cloudflare_request(api_token, "POST", url, payload, idempotent=idempotent)
     if result.get("success"):
         statements = result.get("result") or []
         rows = []
@@ -613,126 +1962,940 @@ def cloudflare_d1_query(api_token: str, account_id: str, db_id: str, sql: str, p
         return True, rows, "ok"
     errors = result.get("errors") or []
     msg = errors[0].get("message") if errors else "query failed"
+    if errors and errors[0].get("code"):
+        msg = f"{msg} (code {errors[0]['code']})"
     return False, [], msg
 
 
 def ensure_cloud_d1_schema(api_token: str, account_id: str, db_id: str, local_db: sqlite3.Connection) -> tuple[bool, str]:
+    schemas = []
     for table in APP_TABLES:
         row = local_db.execute(
             "SELECT sql FROM sqlite_master WHERE type='table' AND name = ?",
             (table,),
         ).fetchone()
-        if not row or not row[0]:
-            continue
-        ok, _, msg = cloudflare_d1_query(api_token, account_id, db_id, row[0])
+        if row and row[0]:
+            schemas.append((table, row[0]))
+    schemas.append((D1_CHECKSUM_TABLE, D1_CHECKSUM_TABLE_SQL))
+
+    # 本地表结构与上次同步到该 D1 库时一致则跳过建表请求
+    schema_hash = hashlib.sha256("\n".join(sql for _, sql in schemas).encode("utf-8")).hexdigest()
+    stored = local_db.execute("SELECT schema_hash FROM sync_d1_schemas WHERE db_id = ?", (db_id,)).fetchone()
+    if stored and stored[0] == schema_hash:
+        return True, "ok"
+
+    for table, sql in schemas:
+        # 重发的建表语句最多得到 already exists，按已存在处理
+        ok, _, msg = cloudflare_d1_query(api_token, account_id, db_id, sql, idempotent=True)
         if not ok:
             lower_msg = (msg or "").lower()
             if "already exists" in lower_msg:
-                continue
+                ok, msg = add_missing_d1_columns(api_token, account_id, db_id, local_db, table)
+                if ok:
+                    continue
             return False, f"创建云端表失败({table})：{msg}"
+
+    local_db.execute(
+        "INSERT OR REPLACE INTO sync_d1_schemas (db_id, schema_hash, checked_at) VALUES (?, ?, ?)",
+        (db_id, schema_hash, datetime.now().isoformat()),
+    )
+    local_db.commit()
     return True, "ok"
 
 
-def backup_local_to_d1(api_token: str, account_id: str, db_id: str, local_db: sqlite3.Connection) -> tuple[bool, str]:
+def add_missing_d1_columns(api_token: str, account_id: str, db_id: str, local_db: sqlite3.Connection, table: str) -> tuple[bool, str]:
+    # 云端表已存在时 CREATE 不会更新表结构，本地新增的列需要逐个 ALTER 补上
+    if table == D1_CHECKSUM_TABLE:
+        return True, "ok"
+    ok, rows, msg = cloudflare_d1_query(api_token, account_id, db_id, f"PRAGMA table_info({table})")
+    if not ok:
+        return False, msg
+    remote_columns = {row.get("name") for row in rows}
+    for col in local_db.execute(f"PRAGMA main.table_info({table})").fetchall():
+        name, col_type, default = col[1], col[2], col[4]
+        if name in remote_columns:
+            continue
+        # ADD COLUMN 不能带 NOT NULL（无默认值时）或主键约束，云端只作存储，按列类型与默认值补齐即可
+        sql = f"ALTER TABLE {table} ADD COLUMN {name} {col_type}".rstrip()
+        if default is not None:
+            sql += f" DEFAULT {default}"
+        ok, _, msg = cloudflare_d1_query(api_token, account_id, db_id, sql, idempotent=False)
+        if not ok and "duplicate column" not in (msg or "").lower():
+            return False, msg
+    return True, "ok"
+
+
+def invalidate_cloud_d1_schema(local_db: sqlite3.Connection) -> None:
+    local_db.execute("DELETE FROM sync_d1_schemas")
+    local_db.commit()
+
+
+def d1_token_fingerprint(api_token: str) -> str:
+    return hashlib.sha256(api_token.encode("utf-8")).hexdigest()[:16]
+
+
+# 数据库不存在（7404）或令牌无效/无权限时才说明保存的账号与数据库 ID 已失效
+D1_TARGET_ERROR_MARKERS = ("code 7404", "database not found", "code 10000", "code 9109", "could not be found", "authentication error", "unauthorized", "http 401", "http 403", "http 404")
+
+
+def is_d1_target_error(msg: str) -> bool:
+    lower_msg = (msg or "").lower()
+    return any(marker in lower_msg for marker in D1_TARGET_ERROR_MARKERS)
+
+
+def resolve_d1_target(api_token: str, account_id: str, db_id: str, trusted: bool) -> tuple[bool, str, str, str, bool]:
+    # 用同一令牌校验过的账号与数据库 ID 直接使用，只有调用因目标失效而失败后才重新向 Cloudflare 校验
+    if trusted and account_id and db_id:
+        return True, "ok", account_id, db_id, True
+
+    ok, msg, resolved_account_id = cloudflare_test_token(api_token)
+    if not ok or not resolved_account_id:
+        return False, msg, account_id, db_id, False
+    ok_find, _, found_db_id = cloudflare_find_d1_by_name(api_token, resolved_account_id, "TgHelper")
+    if not ok_find or not found_db_id:
+        return False, "未找到云端数据库 TgHelper，请先创建。", resolved_account_id, db_id, False
+    return True, "ok", resolved_account_id, found_db_id, False
+
+
+def run_d1_operation(
+    api_token: str, account_id: str, db_id: str, local_db: sqlite3.Connection, operation, job: "DbJob | None" = None
+) -> tuple[bool, str, str, str]:
+    stored = local_db.execute("SELECT value FROM app_settings WHERE key = 'cf_d1_target_token'").fetchone()
+    trusted = bool(stored) and stored[0] == d1_token_fingerprint(api_token)
+    ok, msg, account_id, db_id, cached = resolve_d1_target(api_token, account_id, db_id, trusted)
+    if not ok:
+        return False, msg, account_id, db_id
+
+    ok, msg = operation(account_id, db_id)
+    # 取消、写入中途失败或本地出错时不重来，避免整个任务从头再跑一遍
+    if ok or not cached or (job and job.cancelled) or not is_d1_target_error(msg):
+        return ok, msg, account_id, db_id
+
+    invalidate_cloud_d1_schema(local_db)
+    ok_resolve, resolve_msg, account_id, db_id, _ = resolve_d1_target(api_token, account_id, db_id, False)
+    if not ok_resolve:
+        return False, resolve_msg, account_id, db_id
+    ok, msg = operation(account_id, db_id)
+    return ok, msg, account_id, db_id
+
+
+def sql_literal(value) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"X'{bytes(value).hex()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def build_batched_inserts(table: str, columns: list[str], rows: list, verb: str = "INSERT") -> list[tuple[str, int]]:
+    # 将多行打包为 INSERT ... VALUES (...),(...)，值直接内联，避开 D1 每条 100 个绑定参数的限制
+    prefix = f"{verb} INTO {table} ({','.join(columns)}) VALUES "
+    prefix_size = len(prefix.encode("utf-8"))
+    statements = []
+    chunk = []
+    size = prefix_size
+    for row in rows:
+        values = "(" + ",".join(sql_literal(row[col]) for col in columns) + ")"
+        values_size = len(values.encode("utf-8")) + 1
+        if chunk and (size + values_size > D1_MAX_SQL_BYTES or len(chunk) >= D1_MAX_ROWS_PER_STATEMENT):
+            statements.append((prefix + ",".join(chunk), len(chunk)))
+            chunk = []
+            size = prefix_size
+        chunk.append(values)
+        size += values_size
+    if chunk:
+        statements.append((prefix + ",".join(chunk), len(chunk)))
+    return statements
+
+
+def build_batched_deletes(table: str, key: str, keys: list) -> list[tuple[str, int]]:
+    prefix = f"DELETE FROM {table} WHERE {key} IN ("
+    statements = []
+    chunk = []
+    size = len(prefix)
+    for value in keys:
+        literal = sql_literal(value)
+        if chunk and (size + len(literal) + 2 > D1_MAX_SQL_BYTES or len(chunk) >= D1_MAX_ROWS_PER_STATEMENT):
+            statements.append((prefix + ",".join(chunk) + ")", len(chunk)))
+            chunk = []
+            size = len(prefix)
+        chunk.append(literal)
+        size += len(literal) + 1
+    if chunk:
+        statements.append((prefix + ",".join(chunk) + ")", len(chunk)))
+    return statements
+
+
+def d1_sync_target(db_id: str) -> str:
+    return f"d1:{db_id}"
+
+
+def snapshot_local_db(local_db: sqlite3.Connection) -> tuple[sqlite3.Connection, str]:
+    # 用 SQLite 在线备份 API 一次性复制到临时文件，只在复制期间短暂持有读锁
+    fd, path = tempfile.mkstemp(prefix="TgHelper-snapshot-", suffix=".db")
+    os.close(fd)
+    snapshot = sqlite3.connect(path)
+    snapshot.row_factory = sqlite3.Row
+    try:
+        local_db.commit()
+        local_db.backup(snapshot)
+    except Exception:
+        snapshot.close()
+        os.remove(path)
+        raise
+    return snapshot, path
+
+
+def fetch_d1_checksums(api_token: str, account_id: str, db_id: str) -> dict[str, tuple[str, int]]:
+    ok, rows, _ = cloudflare_d1_query(api_token, account_id, db_id, f"SELECT table_name, checksum, row_count FROM {D1_CHECKSUM_TABLE}")
+    if not ok:
+        return {}
+    return {row.get("table_name"): (row.get("checksum"), row.get("row_count") or 0) for row in rows}
+
+
+def format_skipped_tables(skipped: list[str]) -> str:
+    return f"跳过未变化的表：{', '.join(skipped)}。" if skipped else ""
+
+
+def backup_local_to_d1(
+    api_token: str,
+    account_id: str,
+    db_id: str,
+    local_db: sqlite3.Connection,
+    full: bool = False,
+    job: "DbJob | None" = None,
+) -> tuple[bool, str]:
+    job = job or DbJob("full_backup" if full else "backup")
     ok, msg = ensure_cloud_d1_schema(api_token, account_id, db_id, local_db)
     if not ok:
         return False, msg
 
-    for table in APP_TABLES:
-        local_rows = local_db.execute(f"SELECT * FROM {table}").fetchall()
-        ok, _, emsg = cloudflare_d1_query(api_token, account_id, db_id, f"DELETE FROM {table}")
+    target = d1_sync_target(db_id)
+    # 手动全量同步时不信任云端校验和，所有表都重新上传
+    use_checksums = not full
+    if not full and get_sync_watermark(local_db, target) is None:
+        full = True
+    if full:
+        local_db.execute("DELETE FROM sync_state WHERE target LIKE 'd1:%' AND target <> ?", (target,))
+        begin_sync_tracking(local_db, target)
+
+    # 从一致性快照上传，上传期间不再占用线上数据库
+    refresh_table_checksums(local_db)
+    snapshot, snapshot_path = snapshot_local_db(local_db)
+    try:
+        if full:
+            remote_checksums = fetch_d1_checksums(api_token, account_id, db_id) if use_checksums else {}
+            ok, msg = full_backup_local_to_d1(api_token, account_id, db_id, snapshot, remote_checksums, job)
+        else:
+            ok, msg = incremental_backup_local_to_d1(api_token, account_id, db_id, snapshot, job)
+        if ok:
+            set_sync_watermark(local_db, target, get_sync_changelog_head(snapshot))
+    finally:
+        snapshot.close()
+        os.remove(snapshot_path)
+    return ok, msg
+
+
+def sync_table_to_d1(
+    api_token: str,
+    account_id: str,
+    db_id: str,
+    table: str,
+    clear: bool,
+    deletes: list[tuple[str, int]],
+    upserts: list[tuple[str, int]],
+    checksum: tuple[str, int],
+    job: "DbJob",
+) -> tuple[bool, str]:
+    if job.cancelled:
+        return False, "任务已取消。"
+    # 这里的语句都按主键 INSERT OR REPLACE 或 DELETE，连接在请求发出后断开时可以安全重发
+    # 上传前先作废云端校验和，中途失败时不会被误判为未变化
+    ok, _, emsg = cloudflare_d1_query(
+        api_token, account_id, db_id, f"DELETE FROM {D1_CHECKSUM_TABLE} WHERE table_name = ?", [table], idempotent=True
+    )
+    if not ok:
+        return False, f"更新云端校验和失败({table})：{emsg}"
+    if clear:
+        ok, _, emsg = cloudflare_d1_query(api_token, account_id, db_id, f"DELETE FROM {table}", idempotent=True)
         if not ok:
             return False, f"清空云端表失败({table})：{emsg}"
+    for sql, row_count in deletes:
+        if job.cancelled:
+            return False, "任务已取消。"
+        ok, _, emsg = cloudflare_d1_query(api_token, account_id, db_id, sql, idempotent=True)
+        if not ok:
+            return False, f"删除云端数据失败({table})：{emsg}"
+        job.add_rows(row_count)
+    for sql, row_count in upserts:
+        if job.cancelled:
+            return False, "任务已取消。"
+        ok, _, emsg = cloudflare_d1_query(api_token, account_id, db_id, sql, idempotent=True)
+        if not ok:
+            return False, f"写入云端失败({table})：{emsg}"
+        job.add_rows(row_count)
+    ok, _, emsg = cloudflare_d1_query(
+        api_token,
+        account_id,
+        db_id,
+        f"INSERT OR REPLACE INTO {D1_CHECKSUM_TABLE} (table_name, checksum, row_count, updated_at) VALUES (?, ?, ?, ?)",
+        [table, checksum[0], checksum[1], datetime.now().isoformat()],
+        idempotent=True,
+    )
+    if not ok:
+        return False, f"更新云端校验和失败({table})：{emsg}"
+    job.finish_table()
+    return True, "ok"
+
+
+def run_table_syncs(jobs: list[tuple], job: "DbJob") -> tuple[bool, str]:
+    job.set_totals(len(jobs), sum(row_count for item in jobs for _, row_count in item[5] + item[6]))
+    # 各表相互独立，按表并行上传；本地读取已在调用方线程完成
+    with ThreadPoolExecutor(max_workers=CF_PARALLEL_TABLES) as pool:
+        futures = [pool.submit(sync_table_to_d1, *item, job) for item in jobs]
+        results = [future.result() for future in futures]
+    if job.cancelled:
+        return False, "任务已取消。"
+    for ok, msg in results:
+        if not ok:
+            return False, msg
+    return True, "ok"
+
 
-        if not local_rows:
+def full_backup_local_to_d1(
+    api_token: str,
+    account_id: str,
+    db_id: str,
+    snapshot: sqlite3.Connection,
+    remote_checksums: dict[str, tuple[str, int]],
+    job: "DbJob",
+) -> tuple[bool, str]:
+    started = time.perf_counter()
+    total_rows = 0
+    jobs = []
+    skipped = []
+    for table in APP_TABLES:
+        checksum = compute_table_checksum(snapshot, table)
+        if table in remote_checksums and remote_checksums[table][0] == checksum[0]:
+            skipped.append(table)
             continue
+        local_rows = snapshot.execute(f"SELECT * FROM {table}").fetchall()
+        upserts = []
+        if local_rows:
+            # 用 INSERT OR REPLACE 保证请求被重试时依然幂等
+            upserts = build_batched_inserts(table, list(local_rows[0].keys()), local_rows, verb="INSERT OR REPLACE")
+        jobs.append((api_token, account_id, db_id, table, True, [], upserts, checksum))
+        total_rows += len(local_rows)
+
+    ok, msg = run_table_syncs(jobs, job)
+    if not ok:
+        return False, msg
 
-        columns = local_rows[0].keys()
-        placeholders = ",".join(["?"] * len(columns))
-        sql = f"INSERT INTO {table} ({','.join(columns)}) VALUES ({placeholders})"
-        for row in local_rows:
-            params = [row[col] for col in columns]
-            ok, _, emsg = cloudflare_d1_query(api_token, account_id, db_id, sql, params)
-            if not ok:
-                return False, f"写入云端失败({table})：{emsg}"
+    elapsed = max(time.perf_counter() - started, 0.001)
+    return True, f"本地数据库已全量备份到云端 D1（{total_rows} 行，耗时 {elapsed:.1f} 秒，{total_rows / elapsed:.0f} 行/秒）。{format_skipped_tables(skipped)}"
 
-    return True, "本地数据库已备份到云端 D1。"
 
+def incremental_backup_local_to_d1(api_token: str, account_id: str, db_id: str, snapshot: sqlite3.Connection, job: "DbJob") -> tuple[bool, str]:
+    watermark = get_sync_watermark(snapshot, d1_sync_target(db_id)) or 0
+    head = get_sync_changelog_head(snapshot)
+    changes = snapshot.execute(
+        "SELECT table_name, row_key FROM sync_changelog WHERE seq > ? AND seq <= ? ORDER BY seq",
+        (watermark, head),
+    ).fetchall()
+    if not changes:
+        return True, "本地数据库无变更，云端 D1 已是最新。"
+
+    changed_keys: dict[str, list] = {}
+    for change in changes:
+        changed_keys.setdefault(change[0], []).append(change[1])
+
+    started = time.perf_counter()
+    remote_checksums = fetch_d1_checksums(api_token, account_id, db_id)
+    upserted = 0
+    deleted = 0
+    jobs = []
+    skipped = []
+    for table in APP_TABLES:
+        keys = changed_keys.get(table)
+        if not keys:
+            skipped.append(table)
+            continue
+        checksum = compute_table_checksum(snapshot, table)
+        if table in remote_checksums and remote_checksums[table][0] == checksum[0]:
+            skipped.append(table)
+            continue
+        key = APP_TABLE_KEYS.get(table, "id")
+        local_rows = []
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join(["?"] * len(chunk))
+            local_rows.extend(snapshot.execute(f"SELECT * FROM {table} WHERE {key} IN ({placeholders})", chunk).fetchall())
+
+        present = {row[key] for row in local_rows}
+        missing = [value for value in keys if value not in present]
+        upserts = []
+        if local_rows:
+            upserts = build_batched_inserts(table, list(local_rows[0].keys()), local_rows, verb="INSERT OR REPLACE")
+        jobs.append((api_token, account_id, db_id, table, False, build_batched_deletes(table, key, missing), upserts, checksum))
+        deleted += len(missing)
+        upserted += len(local_rows)
+
+    ok, msg = run_table_syncs(jobs, job)
+    if not ok:
+        return False, msg
+
+    elapsed = max(time.perf_counter() - started, 0.001)
+    return True, f"本地数据库已增量备份到云端 D1（写入 {upserted} 行，删除 {deleted} 行，耗时 {elapsed:.1f} 秒）。{format_skipped_tables(skipped)}"
+
+
+def fetch_d1_table_pages(api_token: str, account_id: str, db_id: str, table: str, pages: queue.Queue, cancelled: threading.Event) -> None:
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    # 按 rowid 键集分页读取，避免单次响应过大
+    last_rowid = None
+    # 读取线程出现任何异常都要放入错误标记，否则拉取循环会一直等待该表结束
+    try:
+        while not cancelled.is_set():
+            if last_rowid is None:
+                ok, rows, emsg = cloudflare_d1_query(
+                    api_token, account_id, db_id, f"SELECT rowid AS __rowid__, * FROM {table} ORDER BY rowid LIMIT {D1_PULL_PAGE_ROWS}"
+                )
+            else:
+                ok, rows, emsg = cloudflare_d1_query(
+                    api_token,
+                    account_id,
+                    db_id,
+                    f"SELECT rowid AS __rowid__, * FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT {D1_PULL_PAGE_ROWS}",
+                    [last_rowid],
+                )
+            if not ok:
+                put((table, None, f"读取云端失败({table})：{emsg}"))
+                return
+            if rows:
+                put((table, rows, None))
+            if len(rows) < D1_PULL_PAGE_ROWS:
+                break
+            last_rowid = rows[-1]["__rowid__"]
+    except Exception as exc:
+        put((table, None, f"读取云端失败({table})：{exc}"))
+        return
+    put((table, None, None))
 
-def pull_d1_to_local(api_token: str, account_id: str, db_id: str, local_db: sqlite3.Connection) -> tuple[bool, str]:
+
+def pull_d1_to_local(api_token: str, account_id: str, db_id: str, local_db: sqlite3.Connection, job: "DbJob | None" = None) -> tuple[bool, str]:
+    job = job or DbJob("pull")
     ok, msg = ensure_cloud_d1_schema(api_token, account_id, db_id, local_db)
     if not ok:
         return False, msg
 
+    started = time.perf_counter()
+    # 校验和一致的表无需下载
+    remote_checksums = fetch_d1_checksums(api_token, account_id, db_id)
+    tables = []
+    skipped = []
     for table in APP_TABLES:
-        ok, rows, emsg = cloudflare_d1_query(api_token, account_id, db_id, f"SELECT * FROM {table}")
-        if not ok:
-            return False, f"读取云端失败({table})：{emsg}"
+        if table in remote_checksums and remote_checksums[table][0] == compute_table_checksum(local_db, table)[0]:
+            skipped.append(table)
+        else:
+            tables.append(table)
+    if not tables:
+        return True, f"云端 D1 与本地数据一致，无需拉取。{format_skipped_tables(skipped)}"
+    job.set_totals(len(tables), sum(remote_checksums[table][1] for table in tables if table in remote_checksums))
+
+    local_db.commit()
+    columns_by_table = {}
+    for table in tables:
+        columns_by_table[table] = [col[1] for col in local_db.execute(f"PRAGMA main.table_info({table})").fetchall()]
+        local_db.execute(f"DROP TABLE IF EXISTS temp.stage_{table}")
+        local_db.execute(f"CREATE TEMP TABLE stage_{table} AS SELECT * FROM main.{table} WHERE 0")
+
+    # 先把云端数据分页装入临时表（不占用主库写锁），再在一个短事务内整体替换
+    pages: queue.Queue = queue.Queue(maxsize=8)
+    cancelled = threading.Event()
+    pending = set(tables)
+    total_rows = 0
+    error = None
+    try:
+        with ThreadPoolExecutor(max_workers=CF_PARALLEL_TABLES) as pool:
+            for table in tables:
+                pool.submit(fetch_d1_table_pages, api_token, account_id, db_id, table, pages, cancelled)
+            try:
+                while pending:
+                    if job.cancelled:
+                        error = "任务已取消。"
+                        break
+                    try:
+                        table, rows, emsg = pages.get(timeout=0.5)
+                    except queue.Empty:
+                        continue
+                    if emsg:
+                        error = emsg
+                        break
+                    if rows is None:
+                        pending.discard(table)
+                        job.finish_table()
+                        continue
+                    columns = [col for col in columns_by_table[table] if col in rows[0]]
+                    placeholders = ",".join(["?"] * len(columns))
+                    local_db.executemany(
+                        f"INSERT INTO temp.stage_{table} ({','.join(columns)}) VALUES ({placeholders})",
+                        ([row.get(col) for col in columns] for row in rows),
+                    )
+                    total_rows += len(rows)
+                    job.add_rows(len(rows))
+            finally:
+                cancelled.set()
+        local_db.commit()
+        if error:
+            return False, error
+
+        swap_started = time.perf_counter()
+        try:
+            local_db.execute("BEGIN IMMEDIATE")
+            table_names = ",".join(sql_literal(table) for table in tables)
+            indexes = local_db.execute(
+                f"SELECT name, sql FROM main.sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({table_names})"
+            ).fetchall()
+            for index in indexes:
+                local_db.execute(f"DROP INDEX main.{index[0]}")
+            # 会话搜索索引整表重建比逐行触发器快得多
+            rebuild_dialog_search = "tg_dialogs" in tables and has_dialog_search_index(local_db)
+            if rebuild_dialog_search:
+                for trigger_name in DIALOG_SEARCH_TRIGGERS:
+                    local_db.execute(f"DROP TRIGGER IF EXISTS main.{trigger_name}")
+            # 整表替换的数据在下次备份时重新计算校验和，先清掉旧的行摘要，替换期间也不必记录改动行
+            for table in tables:
+                local_db.execute(
+                    "UPDATE sync_table_versions SET checksum = NULL, checksum_version = NULL WHERE table_name = ?",
+                    (table,),
+                )
+                local_db.execute("DELETE FROM sync_row_checksums WHERE table_name = ?", (table,))
+                local_db.execute("DELETE FROM sync_dirty_rows WHERE table_name = ?", (table,))
+            # 拉取后本地与云端一致：清空变更记录并把水位线置于当前位置，拉取的数据不会再被增量上传
+            local_db.execute("DELETE FROM sync_state")
+            local_db.execute("DELETE FROM sync_changelog")
+            # 任务 ID 可能与云端不同，旧的发送记录与发送计数不再对应
+            if "tg_auto_send_tasks" in tables:
+                local_db.execute("DELETE FROM main.tg_auto_send_runs")
+                local_db.execute("DELETE FROM main.tg_task_counters")
+            for table in tables:
+                columns = ",".join(columns_by_table[table])
+                local_db.execute(f"DELETE FROM main.{table}")
+                local_db.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM temp.stage_{table}")
+            # 旧版本备份中的账号与登录流程可能仍带明文会话
+            if "tg_accounts" in tables or "tg_login_flows" in tables:
+                migrate_plaintext_sessions(local_db)
+            for index in indexes:
+                local_db.execute(index[1])
+            if rebuild_dialog_search:
+                local_db.execute("INSERT INTO tg_dialogs_fts (tg_dialogs_fts) VALUES ('rebuild')")
+                for trigger_sql in DIALOG_SEARCH_TRIGGERS.values():
+                    local_db.execute(trigger_sql)
+            local_db.execute(
+                "INSERT INTO sync_state (target, watermark, synced_at) VALUES (?, 0, ?)",
+                (d1_sync_target(db_id), datetime.now().isoformat()),
+            )
+            local_db.commit()
+        except sqlite3.Error as exc:
+            local_db.rollback()
+            return False, f"写入本地失败：{exc}"
+        swap_ms = (time.perf_counter() - swap_started) * 1000
+    finally:
+        for table in tables:
+            local_db.execute(f"DROP TABLE IF EXISTS temp.stage_{table}")
+        local_db.commit()
+
+    elapsed = max(time.perf_counter() - started, 0.001)
+    return True, f"云端 D1 数据已拉取到本地（{total_rows} 行，耗时 {elapsed:.1f} 秒，{total_rows / elapsed:.0f} 行/秒，本地切换 {swap_ms:.0f} 毫秒）。{format_skipped_tables(skipped)}"
+
+
+DB_JOB_LABELS = {
+    "backup": "增量备份",
+    "full_backup": "全量同步",
+    "pull": "拉取云端",
+    "auto_backup": "自动备份",
+    "local_snapshot": "本地快照",
+    "local_restore": "恢复本地快照",
+}
+
+
+class DbJob:
+    # 备份/拉取后台任务的进度与取消状态，多个上传线程会并发更新
+    def __init__(self, kind: str, unit: str = "行"):
+        self.id = token_urlsafe(8)
+        self.kind = kind
+        self.unit = unit
+        self.status = "running"
+        self.message = ""
+        self.tables_total = 0
+        self.tables_done = 0
+        self.rows_total = 0
+        self.rows_done = 0
+        self.started_at = time.time()
+        self.finished_at: float | None = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def label(self) -> str:
+        return DB_JOB_LABELS.get(self.kind, self.kind)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def set_totals(self, tables_total: int, rows_total: int) -> None:
+        with self._lock:
+            self.tables_total = tables_total
+            self.rows_total = rows_total
+
+    def add_rows(self, count: int) -> None:
+        with self._lock:
+            self.rows_done += count
+
+    def finish_table(self) -> None:
+        with self._lock:
+            self.tables_done += 1
+
+    def finish(self, ok: bool, message: str) -> None:
+        with self._lock:
+            if self.cancelled and not ok:
+                self.status = "cancelled"
+            else:
+                self.status = "succeeded" if ok else "failed"
+            self.message = message
+            self.finished_at = time.time()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+            rate = self.rows_done / elapsed if elapsed > 0 else 0.0
+            eta = None
+            if self.status == "running" and rate > 0 and self.rows_total > self.rows_done:
+                eta = (self.rows_total - self.rows_done) / rate
+            return {
+                "id": self.id,
+                "kind": self.kind,
+                "label": self.label,
+                "unit": self.unit,
+                "status": self.status,
+                "message": self.message,
+                "tables_total": self.tables_total,
+                "tables_done": self.tables_done,
+                "rows_total": self.rows_total,
+                "rows_done": self.rows_done,
+                "elapsed_seconds": round(elapsed, 1),
+                "rows_per_second": round(rate, 1),
+                "eta_seconds": round(eta, 1) if eta is not None else None,
+                "cancel_requested": self.cancelled,
+            }
+
+
+DB_JOB_LOCK = threading.Lock()
+DB_JOB_STATE: dict[str, DbJob | None] = {"job": None}
+
+
+def get_db_job() -> DbJob | None:
+    return DB_JOB_STATE["job"]
+
+
+def start_db_job(kind: str, runner, unit: str = "行") -> tuple[DbJob | None, str]:
+    # 同一时间只允许一个备份/拉取任务
+    with DB_JOB_LOCK:
+        current = DB_JOB_STATE["job"]
+        if current and current.status == "running":
+            return None, f"已有{current.label}任务在运行，请等待完成或先取消。"
+        job = DbJob(kind, unit)
+        DB_JOB_STATE["job"] = job
+    threading.Thread(target=run_db_job, args=(job, runner), name=f"db-job-{job.id}", daemon=True).start()
+    return job, f"{job.label}任务已在后台开始。"
+
+
+def run_db_job(job: DbJob, runner) -> None:
+    conn = connect_db()
+    conn.row_factory = sqlite3.Row
+    try:
+        ok, message = runner(job, conn)
+    except Exception as exc:
+        detail = f"{exc.__class__.__name__}: {exc}" if str(exc) else exc.__class__.__name__
+        ok, message = False, f"{job.label}失败：{detail}"
+    finally:
+        conn.close()
+    job.finish(ok, message)
+
+
+def parse_snapshot_keep(value: str | None) -> int:
+    try:
+        keep = int(value) if value else LOCAL_SNAPSHOT_DEFAULT_KEEP
+    except ValueError:
+        return LOCAL_SNAPSHOT_DEFAULT_KEEP
+    return max(keep, 1)
+
+
+def local_snapshot_chunk_path(digest: str) -> Path:
+    return LOCAL_SNAPSHOT_DIR / "chunks" / digest[:2] / f"{digest}.z"
+
 
-        local_db.execute(f"DELETE FROM {table}")
-        if not rows:
+def write_file_atomic(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{token_urlsafe(6)}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def list_local_snapshots() -> list[dict]:
+    manifest_dir = LOCAL_SNAPSHOT_DIR / "manifests"
+    if not manifest_dir.is_dir():
+        return []
+    snapshots = []
+    for path in sorted(manifest_dir.glob("*.json"), reverse=True):
+        try:
+            snapshots.append(json.loads(path.read_text(encoding="utf-8")))
+        except (OSError, ValueError):
             continue
+    return snapshots
+
+
+def prune_local_snapshots(keep: int) -> tuple[int, int]:
+    manifests = list_local_snapshots()
+    removed_manifests = 0
+    for manifest in manifests[keep:]:
+        (LOCAL_SNAPSHOT_DIR / "manifests" / f"{manifest['id']}.json").unlink(missing_ok=True)
+        removed_manifests += 1
+
+    # 清理不再被任何保留快照引用的数据块
+    referenced = {digest for manifest in manifests[:keep] for digest in manifest["chunks"]}
+    removed_chunks = 0
+    chunk_root = LOCAL_SNAPSHOT_DIR / "chunks"
+    if chunk_root.is_dir():
+        for path in chunk_root.glob("*/*.z"):
+            if path.stem not in referenced:
+                path.unlink(missing_ok=True)
+                removed_chunks += 1
+    return removed_manifests, removed_chunks
+
+
+def create_local_snapshot(local_db: sqlite3.Connection, keep: int, job: DbJob | None = None) -> tuple[bool, str]:
+    job = job or DbJob("local_snapshot", "块")
+    started = time.perf_counter()
+    snapshot, snapshot_path = snapshot_local_db(local_db)
+    try:
+        page_size = snapshot.execute("PRAGMA page_size").fetchone()[0]
+        snapshot.close()
+        size = os.path.getsize(snapshot_path)
+        job.set_totals(1, (size + LOCAL_SNAPSHOT_CHUNK_SIZE - 1) // LOCAL_SNAPSHOT_CHUNK_SIZE)
+        whole = hashlib.sha256()
+        chunks = []
+        new_chunks = 0
+        stored_bytes = 0
+        with open(snapshot_path, "rb") as fh:
+            while True:
+                if job.cancelled:
+                    return False, "任务已取消。"
+                data = fh.read(LOCAL_SNAPSHOT_CHUNK_SIZE)
+                if not data:
+                    break
+                whole.update(data)
+                digest = hashlib.sha256(data).hexdigest()
+                chunk_path = local_snapshot_chunk_path(digest)
+                if not chunk_path.exists():
+                    compressed = zlib.compress(data, 6)
+                    write_file_atomic(chunk_path, compressed)
+                    new_chunks += 1
+                    stored_bytes += len(compressed)
+                chunks.append(digest)
+                job.add_rows(1)
+    finally:
+        snapshot.close()
+        os.remove(snapshot_path)
+
+    created = datetime.now()
+    snapshot_id = created.strftime("%Y%m%d-%H%M%S-%f")
+    manifest = {
+        "id": snapshot_id,
+        "created_at": created.isoformat(timespec="seconds"),
+        "size": size,
+        "page_size": page_size,
+        "chunk_size": LOCAL_SNAPSHOT_CHUNK_SIZE,
+        "chunks": chunks,
+        "new_chunks": new_chunks,
+        "stored_bytes": stored_bytes,
+        "sha256": whole.hexdigest(),
+    }
+    write_file_atomic(
+        LOCAL_SNAPSHOT_DIR / "manifests" / f"{snapshot_id}.json",
+        json.dumps(manifest, ensure_ascii=False).encode("utf-8"),
+    )
+    job.finish_table()
+    removed_manifests, _ = prune_local_snapshots(keep)
+    elapsed = time.perf_counter() - started
+    return True, (
+        f"本地快照 {snapshot_id} 已创建（{size // 1024} KB，共 {len(chunks)} 块，新增 {new_chunks} 块 {stored_bytes // 1024} KB，"
+        f"耗时 {elapsed:.1f} 秒，清理旧快照 {removed_manifests} 个）。"
+    )
 
-        columns = list(rows[0].keys())
-        placeholders = ",".join(["?"] * len(columns))
-        sql = f"INSERT INTO {table} ({','.join(columns)}) VALUES ({placeholders})"
-        for row in rows:
-            local_db.execute(sql, [row.get(col) for col in columns])
 
-    local_db.commit()
-    return True, "云端 D1 数据已拉取到本地。"
+def restore_local_snapshot(snapshot_id: str, local_db: sqlite3.Connection, job: DbJob | None = None) -> tuple[bool, str]:
+    job = job or DbJob("local_restore", "块")
+    manifest_path = LOCAL_SNAPSHOT_DIR / "manifests" / f"{snapshot_id}.json"
+    if "/" in snapshot_id or "\\" in snapshot_id or not manifest_path.is_file():
+        return False, "快照不存在。"
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    job.set_totals(1, len(manifest["chunks"]))
 
+    started = time.perf_counter()
+    fd, restore_path = tempfile.mkstemp(prefix="TgHelper-restore-", suffix=".db")
+    try:
+        whole = hashlib.sha256()
+        with os.fdopen(fd, "wb") as fh:
+            for digest in manifest["chunks"]:
+                if job.cancelled:
+                    return False, "任务已取消。"
+                try:
+                    data = zlib.decompress(local_snapshot_chunk_path(digest).read_bytes())
+                except (OSError, zlib.error) as exc:
+                    return False, f"快照数据块损坏或缺失：{digest[:12]}（{exc.__class__.__name__}）"
+                whole.update(data)
+                fh.write(data)
+                job.add_rows(1)
+        if whole.hexdigest() != manifest["sha256"]:
+            return False, "快照校验失败，未恢复。"
+
+        # 用在线备份 API 整库覆盖，期间其他连接只会短暂等待锁
+        source = sqlite3.connect(restore_path)
+        try:
+            local_db.commit()
+            source.backup(local_db)
+        finally:
+            source.close()
+        # 快照时的同步水位线与云端已不对应，下次备份到 D1 时走全量
+        local_db.execute("DELETE FROM sync_state")
+        local_db.execute("DELETE FROM sync_changelog")
+        # 快照中的调度进程心跳、账号租约与待转发事件都已过时：存活的调度进程下一轮会重新登记，
+        # 否则旧租约会挡住发送直到过期。旧快照可能还没有这些表，由下一个请求的 init_db 补建
+        existing = {row[0] for row in local_db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for table in ("tg_dispatch_leases", "tg_dispatchers", "tg_dispatch_events"):
+            if table in existing:
+                local_db.execute(f"DELETE FROM {table}")
+        # 发送记录与计数随快照一起恢复；恢复后不再存在的任务 ID 可能被新任务复用，先清掉这些记录
+        for table in ("tg_auto_send_runs", "tg_task_counters"):
+            if table in existing:
+                local_db.execute(f"DELETE FROM {table} WHERE task_id NOT IN (SELECT id FROM tg_auto_send_tasks)")
+        local_db.commit()
+        DISPATCH_EVENT_CURSOR["id"] = None
+    finally:
+        if os.path.exists(restore_path):
+            os.remove(restore_path)
 
-def process_daily_cloud_backup(conn: sqlite3.Connection) -> None:
+    job.finish_table()
+    elapsed = time.perf_counter() - started
+    return True, f"已从本地快照 {snapshot_id} 恢复（{manifest['size'] // 1024} KB，耗时 {elapsed:.1f} 秒）。"
+
+
+def save_d1_target(conn: sqlite3.Connection, account_id: str, db_id: str, use_d1: bool, api_token: str) -> None:
+    conn.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_account_id', ?)", (account_id,))
+    conn.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_d1_database_id', ?)", (db_id,))
+    conn.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_use_d1', ?)", ("1" if use_d1 else "0",))
+    # 记下校验这组 ID 时使用的令牌，换令牌后下次任务会重新校验
+    if use_d1:
+        conn.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_d1_target_token', ?)", (d1_token_fingerprint(api_token),))
+    conn.commit()
+
+
+def start_cloud_db_job(action: str, api_token: str, account_id: str, db_id: str) -> tuple[DbJob | None, str]:
+    def runner(job: DbJob, conn: sqlite3.Connection) -> tuple[bool, str]:
+        if action == "pull":
+            operation = lambda acc_id, d1_id: pull_d1_to_local(api_token, acc_id, d1_id, conn, job=job)
+        else:
+            operation = lambda acc_id, d1_id: backup_local_to_d1(api_token, acc_id, d1_id, conn, full=action == "full_backup", job=job)
+        ok, message, resolved_account_id, resolved_db_id = run_d1_operation(api_token, account_id, db_id, conn, operation, job)
+        save_d1_target(conn, resolved_account_id, resolved_db_id, ok, api_token)
+        return ok, message
+
+    return start_db_job(action, runner)
+
+
+def load_auto_backup_settings(conn: sqlite3.Connection) -> dict:
     settings_rows = conn.execute(
-        "SELECT key, value FROM app_settings WHERE key IN ('db_auto_backup_enabled', 'db_auto_backup_time', 'db_auto_backup_last_date', 'cf_api_token', 'cf_account_id', 'cf_d1_database_id')"
+        "SELECT key, value FROM app_settings WHERE key IN ('db_auto_backup_enabled', 'db_auto_backup_time', 'db_auto_backup_last_date', 'db_auto_backup_target', 'db_local_snapshot_keep', 'cf_api_token', 'cf_account_id', 'cf_d1_database_id')"
     ).fetchall()
-    settings = {row["key"]: row["value"] for row in settings_rows}
+    return {row[0]: row[1] for row in settings_rows}
 
+
+def auto_backup_skip_reason(settings: dict, now: datetime) -> str | None:
+    # 返回 None 表示已到备份时间且今日尚未备份；时间格式不正确时抛出 ValueError
     if settings.get("db_auto_backup_enabled") != "1":
-        return
+        return "自动备份未启用。"
+    if settings.get("db_auto_backup_last_date") == now.strftime("%Y-%m-%d"):
+        return "今日已自动备份。"
+    try:
+        hh, mm = (settings.get("db_auto_backup_time") or "03:30").split(":")
+        target = now.replace(hour=int(hh), minute=int(mm), second=0, microsecond=0)
+    except ValueError:
+        raise ValueError("自动备份时间格式不正确。")
+    if now < target:
+        return "未到自动备份时间。"
+    return None
 
-    backup_time = settings.get("db_auto_backup_time") or "03:30"
-    if ":" not in backup_time:
-        return
 
+def process_daily_cloud_backup(conn: sqlite3.Connection, job: "DbJob | None" = None) -> tuple[bool, str]:
+    settings = load_auto_backup_settings(conn)
     now = datetime.now()
     today = now.strftime("%Y-%m-%d")
-    if settings.get("db_auto_backup_last_date") == today:
-        return
-
     try:
-        hh, mm = backup_time.split(":")
-        target = now.replace(hour=int(hh), minute=int(mm), second=0, microsecond=0)
-    except ValueError:
-        return
-
-    if now < target:
-        return
+        reason = auto_backup_skip_reason(settings, now)
+    except ValueError as exc:
+        return False, str(exc)
+    if reason:
+        return True, reason
 
+    backup_target = settings.get("db_auto_backup_target") or "d1"
     api_token = settings.get("cf_api_token") or ""
     account_id = settings.get("cf_account_id") or ""
     db_id = settings.get("cf_d1_database_id") or ""
-    if not api_token or not account_id or not db_id:
+    if backup_target != "local" and (not api_token or not account_id or not db_id):
         conn.execute(
             "INSERT OR REPLACE INTO app_settings (key, value) VALUES ('db_auto_backup_last_result', ?)",
             (f"{datetime.now().isoformat()} 自动备份失败：Cloudflare 配置不完整",),
         )
         conn.commit()
-        return
-
-    ok, message = backup_local_to_d1(api_token, account_id, db_id, conn)
+        return False, "自动备份失败：Cloudflare 配置不完整"
+
+    results = []
+    if backup_target in ("local", "both"):
+        results.append(create_local_snapshot(conn, parse_snapshot_keep(settings.get("db_local_snapshot_keep")), job=job))
+    if backup_target in ("d1", "both") and not (job and job.cancelled):
+        results.append(backup_local_to_d1(api_token, account_id, db_id, conn, job=job))
+    ok = all(item[0] for item in results)
+    message = " ".join(item[1] for item in results)
     conn.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('db_auto_backup_last_date', ?)", (today,))
     conn.execute(
         "INSERT OR REPLACE INTO app_settings (key, value) VALUES ('db_auto_backup_last_result', ?)",
         (f"{datetime.now().isoformat()} {message}",),
     )
     conn.commit()
+    return ok, message
 
 
-def refresh_dialogs_for_account(account_id: int, session_text: str) -> None:
-    dialogs = run_async(fetch_recent_dialogs(session_text))
+def refresh_dialogs_for_account(account_id: int) -> None:
     db = get_db()
+    session_text = load_account_session(db, account_id)
+    if session_text is None:
+        return
+    dialogs = run_async(fetch_recent_dialogs(session_text))
     db.execute("DELETE FROM tg_dialogs WHERE account_id = ?", (account_id,))
     for item in dialogs:
         db.execute(
@@ -759,100 +2922,536 @@ def schedule_next_run(interval_seconds: int, jitter_seconds: int, schedule_type:
     return (now + timedelta(seconds=interval_seconds + jitter)).isoformat()
 
 
-def process_auto_send_due_tasks() -> None:
-    conn = sqlite3.connect(DB_PATH)
+class TaskEventBroker:
+    # 每个订阅者一个有界队列；发布时按 owner 分发，并保留最近的事件供断线重连时按 Last-Event-ID 补发
+    def __init__(self, max_clients: int):
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.subscribers: dict[queue.Queue, str] = {}
+        self.history: deque = deque(maxlen=TASK_EVENT_HISTORY)
+        self.last_id = 0
+        self.closed = False
+
+    def subscribe(self, owner: str, last_event_id: int | None = None) -> queue.Queue | None:
+        with self.lock:
+            if self.closed or len(self.subscribers) >= self.max_clients:
+                return None
+            events = queue.Queue(TASK_EVENT_QUEUE_SIZE)
+            if last_event_id is not None:
+                # 服务重启（编号回退）或积压已被挤出历史时无法补发，通知页面重新加载
+                if last_event_id > self.last_id or (self.history and last_event_id < self.history[0][0] - 1):
+                    events.put((self.last_id, "resync", {}))
+                else:
+                    for item in self.history:
+                        if item[0] > last_event_id and item[1] == owner and not events.full():
+                            events.put((item[0], item[2], item[3]))
+            self.subscribers[events] = owner
+            return events
+
+    def unsubscribe(self, events: queue.Queue) -> None:
+        with self.lock:
+            self.subscribers.pop(events, None)
+
+    def publish(self, owner: str, event: str, data: dict) -> None:
+        with self.lock:
+            self.last_id += 1
+            self.history.append((self.last_id, owner, event, data))
+            for events, subscriber in self.subscribers.items():
+                if subscriber != owner:
+                    continue
+                try:
+                    events.put_nowait((self.last_id, event, data))
+                except queue.Full:
+                    # 客户端读得太慢：丢弃积压，让页面重新加载列表
+                    self._reset_queue(events, (self.last_id, "resync", {}))
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            for events in self.subscribers:
+                self._reset_queue(events, None)
+
+    @staticmethod
+    def _reset_queue(events: queue.Queue, item) -> None:
+        while True:
+            try:
+                events.get_nowait()
+            except queue.Empty:
+                break
+        events.put_nowait(item)
+
+
+TASK_EVENTS = TaskEventBroker(TASK_EVENT_MAX_CLIENTS)
+
+
+def publish_task_status(
+    owner: str,
+    task_id: int,
+    account_id: int,
+    last_run_at: str,
+    last_result: str,
+    last_reply: str | None = None,
+    next_run_at: str | None = None,
+    timings: dict | None = None,
+    conn: sqlite3.Connection | None = None,
+) -> None:
+    data = {"task_id": task_id, "account_id": account_id, "last_run_at": last_run_at, "last_result": last_result, "timings": timings}
+    if last_reply is not None:
+        data["last_reply"] = last_reply
+    if next_run_at is not None:
+        data["next_run_at"] = next_run_at
+    if DISPATCH_ROLE == "dispatcher" and conn is not None:
+        # 独立调度进程没有 SSE 连接：与任务状态在同一事务中写入，由网页进程转发
+        conn.execute(
+            "INSERT INTO tg_dispatch_events (owner, event, data, created_at) VALUES (?, 'task', ?, ?)",
+            (owner, json.dumps(data, ensure_ascii=False), time.time()),
+        )
+        return
+    TASK_EVENTS.publish(owner, "task", data)
+
+
+DISPATCH_EVENT_CURSOR = {"id": None}
+
+
+def relay_dispatch_events() -> None:
+    # 网页进程（TGHELPER_ROLE=web）每秒把调度进程写入的事件转发给本进程的 SSE 订阅者
+    conn = connect_db()
+    try:
+        if DISPATCH_EVENT_CURSOR["id"] is None:
+            DISPATCH_EVENT_CURSOR["id"] = conn.execute("SELECT COALESCE(MAX(id), 0) FROM tg_dispatch_events").fetchone()[0]
+        rows = conn.execute(
+            "SELECT id, owner, event, data FROM tg_dispatch_events WHERE id > ? ORDER BY id",
+            (DISPATCH_EVENT_CURSOR["id"],),
+        ).fetchall()
+    finally:
+        conn.close()
+    for event_id, owner, event, data in rows:
+        TASK_EVENTS.publish(owner, event, json.loads(data))
+        DISPATCH_EVENT_CURSOR["id"] = event_id
+
+
+def dispatcher_metric_series(conn: sqlite3.Connection) -> dict[tuple, object]:
+    # 其他存活调度进程最近一轮的指标快照，加上 worker 标签与本进程的序列区分
+    series: dict[tuple, object] = {}
+    rows = conn.execute(
+        "SELECT worker_id, metrics FROM tg_dispatchers WHERE worker_id != ? AND metrics IS NOT NULL AND heartbeat_at >= ?",
+        (DISPATCH_WORKER_ID, time.time() - DISPATCH_HEARTBEAT_TTL),
+    ).fetchall()
+    for worker_id, snapshot in rows:
+        for name, labels, value in json.loads(snapshot):
+            series[(name, tuple(tuple(pair) for pair in labels) + (("worker", worker_id),))] = value
+    return series
+
+
+def format_task_event(event_id: int, event: str, data: dict) -> str:
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class SendJob:
+    def __init__(self, task_id: int, owner: str):
+        self.id = token_urlsafe(8)
+        self.task_id = task_id
+        self.owner = owner
+        self.status = "queued"
+        self.message = ""
+        self.last_result = None
+        self.last_reply = None
+        self.timings = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self) -> None:
+        self.status = "running"
+        self.started_at = time.time()
+        TASK_EVENTS.publish(self.owner, "job", self.to_dict())
+
+    def finish(self, ok: bool, message: str, last_result: str | None = None, last_reply: str | None = None, timings: dict | None = None) -> None:
+        self.status = "succeeded" if ok else "failed"
+        self.message = message
+        self.last_result = last_result
+        self.last_reply = last_reply
+        self.timings = timings
+        self.finished_at = time.time()
+        TASK_EVENTS.publish(self.owner, "job", self.to_dict())
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "task_id": self.task_id,
+            "status": self.status,
+            "message": self.message,
+            "last_result": self.last_result,
+            "last_reply": self.last_reply,
+            "timings": self.timings,
+            "queued_seconds": round((self.started_at or self.finished_at or time.time()) - self.created_at, 1),
+            "elapsed_seconds": round((self.finished_at or time.time()) - self.started_at, 1) if self.started_at else None,
+        }
+
+
+SEND_JOBS: dict[str, SendJob] = {}
+SEND_JOBS_LOCK = threading.Lock()
+SEND_EXECUTOR = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix="send")
+# 同一账号的会话不并发使用，避免同一 StringSession 同时建立多条连接
+ACCOUNT_SEND_LOCKS: dict[int, threading.Lock] = {}
+
+
+METRICS.gauge_callback("tghelper_send_queue_depth", lambda: sum(1 for job in list(SEND_JOBS.values()) if job.status == "queued"))
+METRICS.gauge_callback("tghelper_event_streams", lambda: len(TASK_EVENTS.subscribers))
+
+
+def account_send_lock(account_id: int) -> threading.Lock:
+    with SEND_JOBS_LOCK:
+        return ACCOUNT_SEND_LOCKS.setdefault(int(account_id), threading.Lock())
+
+
+def register_dispatcher(conn: sqlite3.Connection) -> tuple[int, int]:
+    # 心跳并清理超时进程，返回 (本进程分片序号, 存活进程数)
+    now = time.time()
+    conn.execute(
+        """
+        INSERT INTO tg_dispatchers (worker_id, pid, started_at, heartbeat_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(worker_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at
+        """,
+        (DISPATCH_WORKER_ID, os.getpid(), datetime.now().isoformat(), now),
+    )
+    conn.execute("DELETE FROM tg_dispatchers WHERE heartbeat_at < ?", (now - DISPATCH_HEARTBEAT_TTL,))
+    if DISPATCH_ROLE == "dispatcher":
+        conn.execute("DELETE FROM tg_dispatch_events WHERE created_at < ?", (now - DISPATCH_EVENT_KEEP_SECONDS,))
+    workers = [row[0] for row in conn.execute("SELECT worker_id FROM tg_dispatchers ORDER BY worker_id").fetchall()]
+    conn.commit()
+    shard = workers.index(DISPATCH_WORKER_ID)
+    METRICS.set_gauge("tghelper_dispatch_shard", shard)
+    METRICS.set_gauge("tghelper_dispatch_workers", len(workers))
+    return shard, len(workers)
+
+
+def unregister_dispatcher() -> None:
+    conn = connect_db()
+    try:
+        conn.execute("DELETE FROM tg_dispatch_leases WHERE worker_id = ?", (DISPATCH_WORKER_ID,))
+        conn.execute("DELETE FROM tg_dispatchers WHERE worker_id = ?", (DISPATCH_WORKER_ID,))
+        conn.commit()
+    except sqlite3.Error as exc:
+        app.logger.warning("注销调度进程失败：%s", exc)
+    finally:
+        conn.close()
+
+
+def acquire_account_lease(conn: sqlite3.Connection, account_id: int) -> bool:
+    # 租约空闲、已过期或本就属于本进程时获得（续期）；同时刷新心跳，长时间发送期间不会被判定为离线
+    now = time.time()
+    cur = conn.execute(
+        """
+        INSERT INTO tg_dispatch_leases (account_id, worker_id, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(account_id) DO UPDATE SET worker_id = excluded.worker_id, expires_at = excluded.expires_at
+        WHERE tg_dispatch_leases.worker_id = excluded.worker_id OR tg_dispatch_leases.expires_at < ?
+        """,
+        (account_id, DISPATCH_WORKER_ID, now + DISPATCH_LEASE_SECONDS, now),
+    )
+    conn.execute("UPDATE tg_dispatchers SET heartbeat_at = ? WHERE worker_id = ?", (now, DISPATCH_WORKER_ID))
+    conn.commit()
+    return cur.rowcount == 1
+
+
+def wait_account_lease(conn: sqlite3.Connection, account_id: int, timeout: float = DISPATCH_LEASE_WAIT) -> bool:
+    deadline = time.monotonic() + timeout
+    while not acquire_account_lease(conn, account_id):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.5)
+    return True
+
+
+def release_account_lease(conn: sqlite3.Connection, account_id: int) -> None:
+    conn.execute("DELETE FROM tg_dispatch_leases WHERE account_id = ? AND worker_id = ?", (account_id, DISPATCH_WORKER_ID))
+    conn.commit()
+
+
+def get_send_job(job_id: str, owner: str) -> SendJob | None:
+    job = SEND_JOBS.get(job_id)
+    return job if job and job.owner == owner else None
+
+
+def enqueue_send_job(task_id: int, owner: str) -> SendJob:
+    with SEND_JOBS_LOCK:
+        # 同一任务已在排队或执行时直接返回原任务，不重复发送
+        for job in SEND_JOBS.values():
+            if job.task_id == task_id and job.status in ("queued", "running"):
+                return job
+        job = SendJob(task_id, owner)
+        SEND_JOBS[job.id] = job
+        TASK_EVENTS.publish(owner, "job", job.to_dict())
+        finished = [key for key, item in SEND_JOBS.items() if item.status not in ("queued", "running")]
+        for key in finished[: max(len(SEND_JOBS) - SEND_JOB_HISTORY, 0)]:
+            del SEND_JOBS[key]
+    SEND_EXECUTOR.submit(run_send_job, job)
+    return job
+
+
+def run_send_job(job: SendJob) -> None:
+    conn = connect_db()
     conn.row_factory = sqlite3.Row
     try:
-        now = datetime.now().isoformat()
-        tasks = conn.execute(
+        task = conn.execute(
             """
-            SELECT t.id, t.owner, t.account_id, t.dialog_id, t.message, t.interval_seconds, t.jitter_seconds,
-                   t.schedule_type, t.time_of_day, t.next_run_at, a.session_text
+            SELECT t.id, t.account_id, t.dialog_id, t.message, a.account_name
             FROM tg_auto_send_tasks t
             JOIN tg_accounts a ON a.id = t.account_id
-            WHERE t.enabled = 1 AND t.next_run_at <= ?
+            WHERE t.id = ? AND t.owner = ?
             """,
-            (now,),
-        ).fetchall()
-
-        for task in tasks:
+            (job.task_id, job.owner),
+        ).fetchone()
+        if not task:
+            job.finish(False, "任务不存在。")
+            return
+        # 等待账号锁与租约期间保持排队状态，取得后才计入运行耗时
+        with account_send_lock(task["account_id"]):
+            if not wait_account_lease(conn, task["account_id"]):
+                job.finish(False, "该账号正在其他调度进程中发送，请稍后重试。")
+                return
+            job.start()
+            started = time.perf_counter()
+            timings = {}
             try:
-                reply = run_async(send_and_fetch_reply(task["session_text"], task["dialog_id"], task["message"]))
-                next_run = schedule_next_run(
-                    task["interval_seconds"],
-                    task["jitter_seconds"],
-                    task["schedule_type"],
-                    task["time_of_day"],
-                )
-                conn.execute(
-                    "UPDATE tg_auto_send_tasks SET next_run_at = ?, last_run_at = ?, last_result = ?, last_reply = ?, updated_at = ? WHERE id = ?",
-                    (
-                        next_run,
-                        datetime.now().isoformat(),
-                        f"sent [{utc8_now_text()}]",
-                        reply,
-                        datetime.now().isoformat(),
-                        task["id"],
-                    ),
-                )
-                conn.commit()
+                session_text = load_account_session(conn, task["account_id"])
+                if session_text is None:
+                    raise RuntimeError("账号会话不存在，请重新登录该账号。")
+                message_text = render_task_message(conn, task, task["account_name"] or "")
+                reply = run_async(send_and_fetch_reply(session_text, task["dialog_id"], message_text, timings))
             except Exception as exc:
-                next_run = schedule_next_run(
-                    task["interval_seconds"],
-                    task["jitter_seconds"],
-                    task["schedule_type"],
-                    task["time_of_day"],
-                )
+                record_send_result("manual", False, started, exc, timings)
                 detail = f"{exc.__class__.__name__}: {exc}" if str(exc) else exc.__class__.__name__
+                last_result = f"failed [{utc8_now_text()}]: {detail}"
+                last_run_at = datetime.now().isoformat()
+                record_send_run(conn, task["id"], "manual", False, timings)
                 conn.execute(
-                    "UPDATE tg_auto_send_tasks SET next_run_at = ?, last_run_at = ?, last_result = ?, updated_at = ? WHERE id = ?",
-                    (
-                        next_run,
-                        datetime.now().isoformat(),
-                        f"failed [{utc8_now_text()}]: {detail}",
-                        datetime.now().isoformat(),
-                        task["id"],
-                    ),
+                    "UPDATE tg_auto_send_tasks SET last_run_at = ?, last_result = ?, updated_at = ? WHERE id = ?",
+                    (last_run_at, last_result, datetime.now().isoformat(), task["id"]),
                 )
                 conn.commit()
+                publish_task_status(job.owner, task["id"], task["account_id"], last_run_at, last_result, timings=timings)
+                job.finish(False, "发送失败。", last_result, timings=timings)
+                return
+            finally:
+                release_account_lease(conn, task["account_id"])
+        record_send_result("manual", True, started, timings=timings)
+        last_result = f"sent [{utc8_now_text()}]"
+        last_run_at = datetime.now().isoformat()
+        record_send_run(conn, task["id"], "manual", True, timings, uses_send_counter(task["message"]))
+        conn.execute(
+            "UPDATE tg_auto_send_tasks SET last_run_at = ?, last_result = ?, last_reply = ?, updated_at = ? WHERE id = ?",
+            (last_run_at, last_result, reply, datetime.now().isoformat(), task["id"]),
+        )
+        conn.commit()
+        publish_task_status(job.owner, task["id"], task["account_id"], last_run_at, last_result, reply, timings=timings)
+        job.finish(True, "已发送。", last_result, reply, timings)
+    except Exception as exc:
+        job.finish(False, f"发送失败：{exc.__class__.__name__}")
+    finally:
+        conn.close()
+
+
+def send_scheduled_task(conn: sqlite3.Connection, task: sqlite3.Row, session_text: str, account_name: str) -> None:
+    # 调用方已持有该账号的进程内锁与租约
+    started = time.perf_counter()
+    timings = {}
+    try:
+        message_text = render_task_message(conn, task, account_name)
+        reply = run_async(send_and_fetch_reply(session_text, task["dialog_id"], message_text, timings))
+        record_send_result("scheduled", True, started, timings=timings)
+        next_run = schedule_next_run(
+            task["interval_seconds"],
+            task["jitter_seconds"],
+            task["schedule_type"],
+            task["time_of_day"],
+        )
+        last_run_at = datetime.now().isoformat()
+        last_result = f"sent [{utc8_now_text()}]"
+        record_send_run(conn, task["id"], "scheduled", True, timings, uses_send_counter(task["message"]))
+        conn.execute(
+            "UPDATE tg_auto_send_tasks SET next_run_at = ?, last_run_at = ?, last_result = ?, last_reply = ?, updated_at = ? WHERE id = ?",
+            (
+                next_run,
+                last_run_at,
+                last_result,
+                reply,
+                datetime.now().isoformat(),
+                task["id"],
+            ),
+        )
+        publish_task_status(task["owner"], task["id"], task["account_id"], last_run_at, last_result, reply, next_run, timings, conn)
+        conn.commit()
+    except Exception as exc:
+        fail_scheduled_task(conn, task, exc, started, timings)
+
+
+def fail_scheduled_task(conn: sqlite3.Connection, task: sqlite3.Row, exc: Exception, started: float, timings: dict) -> None:
+    record_send_result("scheduled", False, started, exc, timings)
+    next_run = schedule_next_run(
+        task["interval_seconds"],
+        task["jitter_seconds"],
+        task["schedule_type"],
+        task["time_of_day"],
+    )
+    detail = f"{exc.__class__.__name__}: {exc}" if str(exc) else exc.__class__.__name__
+    last_run_at = datetime.now().isoformat()
+    last_result = f"failed [{utc8_now_text()}]: {detail}"
+    record_send_run(conn, task["id"], "scheduled", False, timings)
+    conn.execute(
+        "UPDATE tg_auto_send_tasks SET next_run_at = ?, last_run_at = ?, last_result = ?, updated_at = ? WHERE id = ?",
+        (
+            next_run,
+            last_run_at,
+            last_result,
+            datetime.now().isoformat(),
+            task["id"],
+        ),
+    )
+    publish_task_status(task["owner"], task["id"], task["account_id"], last_run_at, last_result, None, next_run, timings, conn)
+    conn.commit()
+
+
+def process_auto_send_due_tasks() -> None:
+    conn = connect_db()
+    conn.row_factory = sqlite3.Row
+    tick_started = time.perf_counter()
+    try:
+        shard, shards = register_dispatcher(conn)
+        now = datetime.now().isoformat()
+        due_accounts = conn.execute(
+            """
+            SELECT account_id, COUNT(1) AS due FROM tg_auto_send_tasks
+            WHERE enabled = 1 AND next_run_at <= ? AND account_id % ? = ?
+            GROUP BY account_id
+            """,
+            (now, shards, shard),
+        ).fetchall()
+        METRICS.set_gauge("tghelper_dispatch_due_tasks", sum(row["due"] for row in due_accounts))
+
+        for account in due_accounts:
+            account_id = account["account_id"]
+            with account_send_lock(account_id):
+                # 租约被其他进程持有（分片交接中或正在手动发送）时跳过，下一轮再处理
+                if not acquire_account_lease(conn, account_id):
+                    continue
+                try:
+                    # 拿到租约后重新查询：上一个持有者已发送并提交的任务不会再次发送；同一账号按到期时间顺序发送
+                    tasks = conn.execute(
+                        """
+                        SELECT t.id, t.owner, t.account_id, t.dialog_id, t.message, t.interval_seconds, t.jitter_seconds,
+                               t.schedule_type, t.time_of_day, t.next_run_at
+                        FROM tg_auto_send_tasks t
+                        WHERE t.account_id = ? AND t.enabled = 1 AND t.next_run_at <= ?
+                        ORDER BY t.next_run_at, t.id
+                        """,
+                        (account_id, now),
+                    ).fetchall()
+                    # 会话每个账号每轮只读取并解密一次；账号已删除时跳过其任务
+                    try:
+                        session_text = load_account_session(conn, account_id) if tasks else None
+                    except RuntimeError as exc:
+                        # 会话无法解密（如换了密钥后恢复备份）时把该账号本轮到期的任务记为失败，继续处理其他账号
+                        started = time.perf_counter()
+                        for task in tasks:
+                            fail_scheduled_task(conn, task, exc, started, {})
+                        continue
+                    if session_text is None:
+                        continue
+                    account_name = conn.execute("SELECT account_name FROM tg_accounts WHERE id = ?", (account_id,)).fetchone()[0] or ""
+                    # 连续发送期间定期续约（同时刷新心跳），不必每条都写库
+                    leased_at = time.monotonic()
+                    for task in tasks:
+                        if time.monotonic() - leased_at >= DISPATCH_RENEW_SECONDS:
+                            if not acquire_account_lease(conn, account_id):
+                                break
+                            leased_at = time.monotonic()
+                        send_scheduled_task(conn, task, session_text, account_name)
+                finally:
+                    release_account_lease(conn, account_id)
     finally:
+        METRICS.set_gauge("tghelper_dispatch_tick_seconds", time.perf_counter() - tick_started)
+        METRICS.set_gauge("tghelper_dispatch_last_tick_timestamp", time.time())
+        if DISPATCH_ROLE == "dispatcher":
+            save_dispatcher_metrics(conn)
         conn.close()
 
 
+def save_dispatcher_metrics(conn: sqlite3.Connection) -> None:
+    # 独立调度进程不监听端口，每轮把指标快照写入 tg_dispatchers，由网页进程的 /metrics 一并输出
+    snapshot = [[name, labels, value] for (name, labels), value in METRICS.collect().items()]
+    try:
+        conn.execute("UPDATE tg_dispatchers SET metrics = ? WHERE worker_id = ?", (json.dumps(snapshot), DISPATCH_WORKER_ID))
+        conn.commit()
+    except sqlite3.Error as exc:
+        conn.rollback()
+        app.logger.warning("保存调度进程指标失败：%s", exc)
+
+
 def run_auto_send_job():
     try:
-        process_auto_send_due_tasks()
+        if DISPATCH_ROLE == "dispatcher":
+            # 独立调度进程没有网页请求刷新配置，每轮从数据库读取一次
+            with app.app_context():
+                load_api_config()
+        run_profiled("auto_send", "tick", process_auto_send_due_tasks)
     except Exception:
         pass
 
 
+def run_event_relay_job():
+    try:
+        relay_dispatch_events()
+    except sqlite3.Error as exc:
+        app.logger.warning("转发调度进程事件失败：%s", exc)
+
+
 def run_auto_backup_job():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    # 每分钟检查一次：未启用、未到时间或今日已备份时不创建后台任务，页面上的最近任务状态保持不变；
+    # 只负责投递后台任务，不占用调度线程
+    conn = connect_db()
     try:
-        process_daily_cloud_backup(conn)
+        reason = auto_backup_skip_reason(load_auto_backup_settings(conn), datetime.now())
+    except ValueError:
+        return
     finally:
         conn.close()
+    if reason:
+        return
+    job, message = start_db_job("auto_backup", lambda job, conn: run_profiled("auto_backup", "daily", process_daily_cloud_backup, conn, job))
+    if not job:
+        # 不记录日期，手动任务结束后下一分钟再试
+        app.logger.info("自动备份等待中：%s", message)
 
 
 def configure_scheduler_jobs():
-    if SCHEDULER.get_job(AUTO_SEND_JOB_ID) is None:
+    if DISPATCH_ROLE in ("all", "dispatcher") and SCHEDULER.get_job(AUTO_SEND_JOB_ID) is None:
         SCHEDULER.add_job(run_auto_send_job, CronTrigger(second="*/5"), id=AUTO_SEND_JOB_ID, replace_existing=True)
+    if DISPATCH_ROLE == "web" and SCHEDULER.get_job(EVENT_RELAY_JOB_ID) is None:
+        SCHEDULER.add_job(run_event_relay_job, CronTrigger(second="*"), id=EVENT_RELAY_JOB_ID, replace_existing=True)
+    if DISPATCH_ROLE == "dispatcher":
+        return
 
-    backup_time = app.config.get("DB_AUTO_BACKUP_TIME") or "03:30"
-    hour = 3
-    minute = 30
-    if ":" in backup_time:
-        try:
-            hh, mm = backup_time.split(":")
-            hour = int(hh)
-            minute = int(mm)
-        except ValueError:
-            hour, minute = 3, 30
+    # 备份时间与是否启用每次从数据库读取，修改设置后无需重新排程
+    if SCHEDULER.get_job(AUTO_BACKUP_JOB_ID) is None:
+        SCHEDULER.add_job(run_auto_backup_job, CronTrigger(second=0), id=AUTO_BACKUP_JOB_ID, replace_existing=True)
+
+
+@app.before_request
+def start_request_profile():
+    # 先于其他钩子注册，init_db/load_api_config 的耗时也计入；性能分析页面本身不分析
+    if request.endpoint in ("profiling_settings", "profiling_download") or not profile_selected("requests", request.path):
+        return
+    profiler = start_profile()
+    if profiler is not None:
+        g.profile = (profiler, time.perf_counter())
 
-    if SCHEDULER.get_job(AUTO_BACKUP_JOB_ID):
-        SCHEDULER.remove_job(AUTO_BACKUP_JOB_ID)
-    SCHEDULER.add_job(run_auto_backup_job, CronTrigger(hour=hour, minute=minute), id=AUTO_BACKUP_JOB_ID, replace_existing=True)
+
+@app.teardown_request
+def finish_request_profile(_exception):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        finish_profile(profile[0], "requests", f"{request.method} {request.path}", profile[1])
 
 
 @app.before_request
@@ -955,7 +3554,9 @@ def delete_account(account_id: int):
 
     token = request.form.get("token")
     db = get_db()
-    db.execute("DELETE FROM tg_accounts WHERE id = ? AND owner = ?", (account_id, username))
+    cur = db.execute("DELETE FROM tg_accounts WHERE id = ? AND owner = ?", (account_id, username))
+    if cur.rowcount:
+        db.execute("DELETE FROM tg_account_secrets WHERE account_id = ?", (account_id,))
     db.commit()
     return redirect(url_for("accounts", token=token) if token else url_for("accounts"))
 
@@ -971,20 +3572,15 @@ def accounts():
 
     db = get_db()
     accounts_list = db.execute(
-        "SELECT id, account_name, session_text, created_at FROM tg_accounts WHERE owner = ? ORDER BY id DESC",
+        "SELECT id, account_name, created_at FROM tg_accounts WHERE owner = ? ORDER BY id DESC",
         (username,),
     ).fetchall()
 
     if not selected_account_id and accounts_list:
         selected_account_id = str(accounts_list[0]["id"])
 
-    dialogs = []
     sign_task = None
     if selected_account_id:
-        dialogs = db.execute(
-            "SELECT dialog_id, title, username FROM tg_dialogs WHERE account_id = ? ORDER BY id DESC",
-            (selected_account_id,),
-        ).fetchall()
         sign_task = db.execute(
             "SELECT dialog_id, message FROM tg_sign_tasks WHERE owner = ? AND account_id = ?",
             (username, selected_account_id),
@@ -997,7 +3593,6 @@ def accounts():
         accounts=accounts_list,
         error=error,
         selected_account_id=selected_account_id,
-        dialogs=dialogs,
         sign_task=sign_task,
     )
 
@@ -1083,7 +3678,7 @@ def database_settings():
     if not username:
         return redirect(url_for("login"))
 
-    message = None
+    message = request.args.get("message")
     db = get_db()
     if request.method == "POST":
         action = request.form.get("action", "save")
@@ -1092,6 +3687,7 @@ def database_settings():
         db_name = "TgHelper"
         db_id = app.config.get("CF_D1_DATABASE_ID") or ""
         use_d1 = app.config.get("CF_USE_D1") or False
+        target_verified = False
 
         if action == "create":
             if not api_token:
@@ -1105,54 +3701,49 @@ def database_settings():
                         db_id = found_db_id
                         message = "已找到云端数据库 TgHelper。"
                         use_d1 = True
+                        target_verified = True
                     else:
                         ok_create, msg, created_id = cloudflare_create_d1(api_token, account_id, db_name)
                         message = msg
                         if ok_create and created_id:
                             db_id = created_id
                             use_d1 = True
-        elif action == "backup":
-            if not api_token:
-                message = "请先填写 API Token。"
-            else:
-                ok, msg, resolved_account_id = cloudflare_test_token(api_token)
-                if not ok or not resolved_account_id:
-                    message = msg
-                else:
-                    account_id = resolved_account_id
-                    ok_find, _, found_db_id = cloudflare_find_d1_by_name(api_token, account_id, db_name)
-                    if not ok_find or not found_db_id:
-                        message = "未找到云端数据库 TgHelper，请先创建。"
-                    else:
-                        db_id = found_db_id
-                        ok_bak, msg_bak = backup_local_to_d1(api_token, account_id, db_id, db)
-                        message = msg_bak
-                        use_d1 = ok_bak
-        elif action == "pull":
+                            target_verified = True
+        elif action in ("backup", "full_backup", "pull"):
             if not api_token:
                 message = "请先填写 API Token。"
+        elif action == "local_snapshot":
+            keep = app.config.get("DB_LOCAL_SNAPSHOT_KEEP") or LOCAL_SNAPSHOT_DEFAULT_KEEP
+            _, message = start_db_job("local_snapshot", lambda job, conn: create_local_snapshot(conn, keep, job=job), unit="块")
+        elif action == "local_restore":
+            snapshot_id = request.form.get("snapshot_id", "").strip()
+            if not snapshot_id:
+                message = "请选择要恢复的快照。"
             else:
-                ok, msg, resolved_account_id = cloudflare_test_token(api_token)
-                if not ok or not resolved_account_id:
-                    message = msg
-                else:
-                    account_id = resolved_account_id
-                    ok_find, _, found_db_id = cloudflare_find_d1_by_name(api_token, account_id, db_name)
-                    if not ok_find or not found_db_id:
-                        message = "未找到云端数据库 TgHelper，请先创建。"
-                    else:
-                        db_id = found_db_id
-                        ok_pull, msg_pull = pull_d1_to_local(api_token, account_id, db_id, db)
-                        message = msg_pull
-                        use_d1 = ok_pull
+                _, message = start_db_job(
+                    "local_restore", lambda job, conn: restore_local_snapshot(snapshot_id, conn, job=job), unit="块"
+                )
+        elif action == "session_key_import":
+            message = session_key_admin_error(db, username, request.form.get("password", ""))
+            if not message:
+                try:
+                    message = import_session_key(db, request.form.get("session_key", ""))
+                except ValueError as exc:
+                    message = str(exc)
         elif action == "auto_backup":
             auto_enabled = request.form.get("db_auto_backup_enabled") == "on"
             auto_time = request.form.get("db_auto_backup_time", "03:30").strip()
+            auto_target = request.form.get("db_auto_backup_target", "d1")
+            snapshot_keep = parse_snapshot_keep(request.form.get("db_local_snapshot_keep", "").strip())
             if ":" not in auto_time:
                 message = "自动备份时间格式不正确，应为 HH:MM。"
+            elif auto_target not in ("d1", "local", "both"):
+                message = "自动备份目标不正确。"
             else:
                 db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('db_auto_backup_enabled', ?)", ("1" if auto_enabled else "0",))
                 db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('db_auto_backup_time', ?)", (auto_time,))
+                db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('db_auto_backup_target', ?)", (auto_target,))
+                db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('db_local_snapshot_keep', ?)", (str(snapshot_keep),))
                 db.commit()
                 load_api_config()
                 if SCHEDULER.running:
@@ -1164,16 +3755,23 @@ def database_settings():
             else:
                 message = "已保存。"
 
-        if api_token:
+        if api_token and action not in ("local_snapshot", "local_restore", "session_key_import"):
             db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_api_token', ?)", (api_token,))
-            db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_account_id', ?)", (account_id,))
             db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_d1_database_name', ?)", (db_name,))
-            db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_d1_database_id', ?)", (db_id,))
-            db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_use_d1', ?)", ("1" if use_d1 else "0",))
+            if action not in ("backup", "full_backup", "pull"):
+                db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_account_id', ?)", (account_id,))
+                db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_d1_database_id', ?)", (db_id,))
+                db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_use_d1', ?)", ("1" if use_d1 else "0",))
+            if target_verified:
+                db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES ('cf_d1_target_token', ?)", (d1_token_fingerprint(api_token),))
             db.commit()
             load_api_config()
+            # 备份/拉取在后台线程执行，账号与数据库 ID 由任务完成后写回
+            if action in ("backup", "full_backup", "pull"):
+                _, message = start_cloud_db_job(action, api_token, account_id, db_id)
 
     load_api_config()
+    db_job = get_db_job()
 
     return render_template(
         "database_settings.html",
@@ -1186,9 +3784,136 @@ def database_settings():
         db_auto_backup_enabled=app.config.get("DB_AUTO_BACKUP_ENABLED") or False,
         db_auto_backup_time=app.config.get("DB_AUTO_BACKUP_TIME") or "03:30",
         db_auto_backup_last_result=app.config.get("DB_AUTO_BACKUP_LAST_RESULT") or "",
+        db_auto_backup_target=app.config.get("DB_AUTO_BACKUP_TARGET") or "d1",
+        db_local_snapshot_keep=app.config.get("DB_LOCAL_SNAPSHOT_KEEP") or LOCAL_SNAPSHOT_DEFAULT_KEEP,
+        local_snapshots=list_local_snapshots(),
+        db_job=db_job.to_dict() if db_job else None,
+        session_key_from_env=bool(os.environ.get("TGHELPER_SESSION_KEY")),
+        session_key_admin=is_admin_user(db, username),
+        session_key_file=str(SESSION_KEY_FILE),
+    )
+
+
+@app.route("/settings/database/session-key", methods=["POST"])
+def download_session_key():
+    username = require_login()
+    if not username:
+        return redirect(url_for("login"))
+    token = request.form.get("token")
+    error = session_key_admin_error(get_db(), username, request.form.get("password", ""))
+    if error:
+        return redirect(url_for("database_settings", token=token, message=error) if token else url_for("database_settings", message=error))
+    return Response(
+        session_key_material() + "\n",
+        mimetype="text/plain",
+        headers={"Content-Disposition": "attachment; filename=tghelper-session.key", "Cache-Control": "no-store"},
+    )
+
+
+@app.route("/settings/database/job")
+def database_job_status():
+    username = require_login()
+    if not username:
+        return jsonify({"error": "unauthorized"}), 401
+    db_job = get_db_job()
+    return jsonify({"job": db_job.to_dict() if db_job else None})
+
+
+@app.route("/settings/database/job/cancel", methods=["POST"])
+def database_job_cancel():
+    username = require_login()
+    if not username:
+        return jsonify({"error": "unauthorized"}), 401
+    db_job = get_db_job()
+    if db_job and db_job.status == "running":
+        db_job.cancel()
+    return jsonify({"job": db_job.to_dict() if db_job else None})
+
+
+@app.route("/settings/profiling", methods=["GET", "POST"])
+def profiling_settings():
+    token = request.args.get("token") or request.form.get("token")
+    username = require_login()
+    if not username:
+        return redirect(url_for("login"))
+
+    message = None
+    if request.method == "POST":
+        action = request.form.get("action", "save")
+        if action == "clear":
+            for path in list_profile_dumps():
+                path.unlink(missing_ok=True)
+            message = "已清空性能分析结果。"
+        elif action == "sql_reset":
+            SQL_STATS.reset()
+            message = "已重置 SQL 统计。"
+        else:
+            targets = [item for item in request.form.getlist("profile_targets") if item in PROFILE_TARGETS]
+            path_prefix = request.form.get("profile_path_prefix", "").strip()
+            if path_prefix and not path_prefix.startswith("/"):
+                message = "路径前缀需以 / 开头。"
+            else:
+                db = get_db()
+                settings = {
+                    "profile_enabled": "1" if request.form.get("profile_enabled") == "on" else "0",
+                    "profile_targets": ",".join(targets),
+                    "profile_path_prefix": path_prefix,
+                    "profile_sample": str(max(parse_profile_int(request.form.get("profile_sample", "").strip(), 1), 1)),
+                    "profile_min_ms": str(parse_profile_int(request.form.get("profile_min_ms", "").strip(), 0)),
+                }
+                for key, value in settings.items():
+                    db.execute("INSERT OR REPLACE INTO app_settings (key, value) VALUES (?, ?)", (key, value))
+                db.commit()
+                load_api_config()
+                message = "已保存。"
+
+    # 默认汇总全部保存的结果；指定 file 时只看单份
+    dumps = list_profile_dumps()
+    selected = request.args.get("file", "")
+    sort_key = request.args.get("sort") if request.args.get("sort") in ("tottime", "cumtime") else "tottime"
+    paths = [path for path in dumps if path.name == selected] if selected else dumps
+    hotspots, total_seconds = [], 0.0
+    if paths:
+        try:
+            hotspots, total_seconds = profile_hotspots(paths, sort_key)
+        except Exception as exc:
+            message = f"读取性能分析结果失败：{exc.__class__.__name__}"
+
+    return render_template(
+        "profiling_settings.html",
+        token=token,
+        message=message,
+        env_enabled=PROFILE_ENV_ENABLED,
+        profile_enabled=app.config.get("PROFILE_ENABLED"),
+        profile_targets=app.config.get("PROFILE_TARGETS", PROFILE_TARGETS),
+        all_targets=PROFILE_TARGETS,
+        profile_path_prefix=app.config.get("PROFILE_PATH_PREFIX") or "",
+        profile_sample=app.config.get("PROFILE_SAMPLE") or 1,
+        profile_min_ms=app.config.get("PROFILE_MIN_MS") or 0,
+        profile_dir=str(PROFILE_DIR),
+        dumps=[{"name": path.name, "size": path.stat().st_size} for path in dumps],
+        selected=selected,
+        sort_key=sort_key,
+        hotspots=hotspots,
+        total_seconds=total_seconds,
+        sql_trace=SQL_TRACE,
+        slow_sql_ms=SLOW_SQL_MS,
+        sql_summary=SQL_STATS.summary(),
+        sql_top=SQL_STATS.top(),
     )
 
 
+@app.route("/settings/profiling/<name>")
+def profiling_download(name: str):
+    # 原始 .prof 文件，可用 snakeviz 或 python -m pstats 打开
+    username = require_login()
+    if not username:
+        return redirect(url_for("login"))
+    if not name.endswith(".prof") or name not in {path.name for path in list_profile_dumps()}:
+        abort(404)
+    return send_from_directory(PROFILE_DIR, name, as_attachment=True)
+
+
 @app.route("/auto/send")
 def auto_send():
     token = request.args.get("token")
@@ -1224,19 +3949,12 @@ def auto_send_new():
     if not selected_account_id and accounts_list:
         selected_account_id = str(accounts_list[0]["id"])
 
-    dialogs = []
-    if selected_account_id:
-        dialogs = db.execute(
-            "SELECT dialog_id, title, username FROM tg_dialogs WHERE account_id = ? ORDER BY id DESC",
-            (selected_account_id,),
-        ).fetchall()
-
+    # 会话列表由页面通过 /api/dialogs 分页加载
     return render_template(
         "auto_send_new.html",
         token=token,
         accounts=accounts_list,
         selected_account_id=selected_account_id,
-        dialogs=dialogs,
         error=request.args.get("error"),
     )
 
@@ -1258,32 +3976,184 @@ def auto_send_manage():
     if not selected_account_id and accounts_list:
         selected_account_id = str(accounts_list[0]["id"])
 
-    tasks = []
-    if selected_account_id:
-        tasks = db.execute(
-            """
-             SELECT t.id, t.dialog_id, t.message, t.interval_seconds, t.jitter_seconds, t.schedule_type, t.time_of_day,
-                 t.enabled, t.last_run_at, t.last_result, t.last_reply,
-                 COALESCE(d.title, d.username, t.dialog_id) AS dialog_name
-             FROM tg_auto_send_tasks t
-             LEFT JOIN tg_dialogs d ON d.account_id = t.account_id AND d.dialog_id = t.dialog_id
-             WHERE t.owner = ? AND t.account_id = ?
-                 ORDER BY t.id DESC
-            """,
-            (username, selected_account_id),
-        ).fetchall()
-
+    # 任务列表由页面通过 /api/tasks 分页加载
     return render_template(
         "auto_send_manage.html",
         token=token,
         accounts=accounts_list,
         selected_account_id=selected_account_id,
-        tasks=tasks,
         error=request.args.get("error"),
         message=request.args.get("message"),
     )
 
 
+def parse_api_int(name: str, default: int | None = None) -> int | None:
+    value = request.args.get(name, "").strip()
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"参数 {name} 必须是整数。")
+
+
+def fetch_api_page(source_sql: str, fields_map: dict[str, str], default_fields: list[str], where: list[str], params: list) -> dict:
+    # 按 id 倒序的 keyset 分页：after 为上一页最后一条的 id，翻页代价与页码无关
+    fields_text = request.args.get("fields", "").strip()
+    fields = [item.strip() for item in fields_text.split(",") if item.strip()] if fields_text else default_fields
+    unknown = [item for item in fields if item not in fields_map]
+    if unknown:
+        raise ValueError(f"未知字段：{', '.join(unknown)}")
+
+    limit = min(max(parse_api_int("limit", API_DEFAULT_PAGE_SIZE), 1), API_MAX_PAGE_SIZE)
+    after = parse_api_int("after")
+    id_column = fields_map["id"]
+    if after is not None:
+        where = where + [f"{id_column} < ?"]
+        params = params + [after]
+
+    columns = ", ".join(f"{fields_map[item]} AS {item}" for item in fields)
+    rows = get_db().execute(
+        f"SELECT {id_column} AS _cursor, {columns} FROM {source_sql} WHERE {' AND '.join(where)} ORDER BY {id_column} DESC LIMIT ?",
+        params + [limit + 1],
+    ).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "items": [{item: row[item] for item in fields} for row in rows],
+        "next_cursor": rows[-1]["_cursor"] if has_more and rows else None,
+    }
+
+
+def api_list_response(build_query):
+    username = require_login()
+    if not username:
+        return jsonify({"error": "unauthorized"}), 401
+    try:
+        return jsonify(build_query(username))
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+
+@app.route("/api/accounts")
+def api_accounts():
+    def build_query(username: str) -> dict:
+        return fetch_api_page("tg_accounts a", API_ACCOUNT_FIELDS, ["id", "account_name", "created_at"], ["a.owner = ?"], [username])
+
+    return api_list_response(build_query)
+
+
+def dialog_search_match_query(keyword: str) -> str | None:
+    # trigram 至少需要 3 个字符；每个词按短语加引号，词之间为 AND
+    terms = keyword.split()
+    if not terms or any(len(term) < 3 for term in terms):
+        return None
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def dialog_search_condition(db: sqlite3.Connection, keyword: str) -> tuple[str, list]:
+    match_query = dialog_search_match_query(keyword)
+    if match_query and has_dialog_search_index(db):
+        return "d.id IN (SELECT rowid FROM tg_dialogs_fts WHERE tg_dialogs_fts MATCH ?)", [match_query]
+    return "(d.title LIKE ? OR d.username LIKE ? OR d.dialog_id LIKE ?)", [f"%{keyword}%"] * 3
+
+
+@app.route("/api/dialogs/search")
+def api_dialogs_search():
+    # 输入联想：按最新顺序返回前若干条，不分页；按 rowid 倒序可以在取够条数后提前结束，不必为全部命中计算相关度
+    def build_query(username: str) -> dict:
+        account_id = parse_api_int("account_id")
+        if account_id is None:
+            raise ValueError("缺少参数 account_id。")
+        keyword = request.args.get("q", "").strip()
+        limit = min(max(parse_api_int("limit", 20), 1), API_MAX_PAGE_SIZE)
+        if not keyword:
+            return {"items": []}
+        db = get_db()
+        owner_clause = "d.account_id = ? AND d.account_id IN (SELECT id FROM tg_accounts WHERE owner = ?)"
+        match_query = dialog_search_match_query(keyword)
+        if match_query and has_dialog_search_index(db):
+            rows = db.execute(
+                f"""
+                SELECT d.id, d.dialog_id, d.title, d.username
+                FROM tg_dialogs_fts f
+                JOIN tg_dialogs d ON d.id = f.rowid
+                WHERE tg_dialogs_fts MATCH ? AND {owner_clause}
+                ORDER BY f.rowid DESC
+                LIMIT ?
+                """,
+                (match_query, account_id, username, limit),
+            ).fetchall()
+        else:
+            # 短关键字无法走 trigram 索引，沿 account_id 索引倒序扫描，取够条数即停止
+            rows = db.execute(
+                f"""
+                SELECT d.id, d.dialog_id, d.title, d.username
+                FROM tg_dialogs d
+                WHERE {owner_clause} AND (d.title LIKE ? OR d.username LIKE ? OR d.dialog_id LIKE ?)
+                ORDER BY d.id DESC
+                LIMIT ?
+                """,
+                (account_id, username, *[f"%{keyword}%"] * 3, limit),
+            ).fetchall()
+        return {"items": [dict(row) for row in rows]}
+
+    return api_list_response(build_query)
+
+
+@app.route("/api/dialogs")
+def api_dialogs():
+    def build_query(username: str) -> dict:
+        account_id = parse_api_int("account_id")
+        if account_id is None:
+            raise ValueError("缺少参数 account_id。")
+        where = ["d.account_id = ?", "d.account_id IN (SELECT id FROM tg_accounts WHERE owner = ?)"]
+        params: list = [account_id, username]
+        keyword = request.args.get("q", "").strip()
+        if keyword:
+            condition, condition_params = dialog_search_condition(get_db(), keyword)
+            where.append(condition)
+            params.extend(condition_params)
+        return fetch_api_page("tg_dialogs d", API_DIALOG_FIELDS, ["id", "dialog_id", "title", "username"], where, params)
+
+    return api_list_response(build_query)
+
+
+@app.route("/api/tasks")
+def api_tasks():
+    def build_query(username: str) -> dict:
+        where = ["t.owner = ?"]
+        params: list = [username]
+        account_id = parse_api_int("account_id")
+        if account_id is not None:
+            where.append("t.account_id = ?")
+            params.append(account_id)
+        enabled = request.args.get("enabled", "").strip()
+        if enabled:
+            if enabled not in ("0", "1"):
+                raise ValueError("参数 enabled 只能是 0 或 1。")
+            where.append("t.enabled = ?")
+            params.append(int(enabled))
+        last_result = request.args.get("last_result", "").strip()
+        if last_result:
+            if last_result not in API_TASK_RESULT_FILTERS:
+                raise ValueError("参数 last_result 只能是 sent、failed 或 none。")
+            where.append(API_TASK_RESULT_FILTERS[last_result])
+        default_fields = ["id", "dialog_id", "dialog_name", "message", "time_of_day", "jitter_seconds", "enabled", "last_run_at", "last_result", "last_reply", "last_timings"]
+        return fetch_api_page("tg_auto_send_tasks t", API_TASK_FIELDS, default_fields, where, params)
+
+    return api_list_response(build_query)
+
+
+@app.route("/api/tasks/<int:task_id>/runs")
+def api_task_runs(task_id: int):
+    def build_query(username: str) -> dict:
+        where = ["r.task_id = ?", "EXISTS (SELECT 1 FROM tg_auto_send_tasks t WHERE t.id = r.task_id AND t.owner = ?)"]
+        return fetch_api_page("tg_auto_send_runs r", API_TASK_RUN_FIELDS, list(API_TASK_RUN_FIELDS), where, [task_id, username])
+
+    return api_list_response(build_query)
+
+
 @app.route("/auto/send/refresh", methods=["POST"])
 def auto_send_refresh_dialogs():
     username = require_login()
@@ -1297,13 +4167,13 @@ def auto_send_refresh_dialogs():
 
     db = get_db()
     account = db.execute(
-        "SELECT id, session_text FROM tg_accounts WHERE id = ? AND owner = ?",
+        "SELECT id FROM tg_accounts WHERE id = ? AND owner = ?",
         (account_id, username),
     ).fetchone()
     if not account:
         return redirect(url_for("auto_send_new", token=token, error="账号不存在。") if token else url_for("auto_send_new", error="账号不存在。"))
 
-    refresh_dialogs_for_account(account["id"], account["session_text"])
+    refresh_dialogs_for_account(account["id"])
     return redirect(
         url_for("auto_send_new", token=token, account_id=account_id)
         if token
@@ -1329,6 +4199,11 @@ def auto_send_save():
     if not account_id or not dialog_id or not message_text:
         return redirect(url_for("auto_send_new", token=token, error="请选择账号与会话，并填写内容。") if token else url_for("auto_send_new", error="请选择账号与会话，并填写内容。"))
 
+    try:
+        validate_message_template(message_text)
+    except ValueError as exc:
+        return redirect(url_for("auto_send_new", token=token, error=str(exc)) if token else url_for("auto_send_new", error=str(exc)))
+
     try:
         jitter_value = int(jitter_seconds) if jitter_seconds else 0
         if jitter_value < 0:
@@ -1381,7 +4256,9 @@ def auto_send_delete(task_id: int):
     token = request.form.get("token")
     account_id = request.form.get("account_id")
     db = get_db()
-    db.execute("DELETE FROM tg_auto_send_tasks WHERE id = ? AND owner = ?", (task_id, username))
+    if db.execute("DELETE FROM tg_auto_send_tasks WHERE id = ? AND owner = ?", (task_id, username)).rowcount:
+        db.execute("DELETE FROM tg_auto_send_runs WHERE task_id = ?", (task_id,))
+        db.execute("DELETE FROM tg_task_counters WHERE task_id = ?", (task_id,))
     db.commit()
     return redirect(
         url_for("auto_send_manage", token=token, account_id=account_id)
@@ -1408,6 +4285,18 @@ def auto_send_update(task_id: int):
             else url_for("auto_send_manage", account_id=account_id, error="发送内容不能为空。")
         )
 
+    current = get_db().execute(
+        "SELECT message FROM tg_auto_send_tasks WHERE id = ? AND owner = ?", (task_id, username)
+    ).fetchone()
+    try:
+        validate_message_template(message_text, current["message"] if current else None)
+    except ValueError as exc:
+        return redirect(
+            url_for("auto_send_manage", token=token, account_id=account_id, error=str(exc))
+            if token
+            else url_for("auto_send_manage", account_id=account_id, error=str(exc))
+        )
+
     if not time_of_day or ":" not in time_of_day:
         return redirect(
             url_for("auto_send_manage", token=token, account_id=account_id, error="时间格式不正确，应为 HH:MM。")
@@ -1447,6 +4336,254 @@ def auto_send_update(task_id: int):
     )
 
 
+def parse_task_schedule(time_of_day: str, jitter_seconds) -> tuple[str, int]:
+    time_of_day = (time_of_day or "").strip()
+    try:
+        hh, mm = time_of_day.split(":")
+        hh_value = int(hh)
+        mm_value = int(mm)
+        if hh_value < 0 or hh_value > 23 or mm_value < 0 or mm_value > 59:
+            raise ValueError
+        jitter_value = int(jitter_seconds) if str(jitter_seconds or "").strip() else 0
+        if jitter_value < 0:
+            raise ValueError
+    except ValueError:
+        raise ValueError(f"时间或随机延时填写不正确：{time_of_day or '空'} / {jitter_seconds}")
+    return f"{hh_value:02d}:{mm_value:02d}", jitter_value
+
+
+def apply_bulk_task_action(db: sqlite3.Connection, username: str, action: str, task_ids: list[int], payload: dict) -> int:
+    # 所有改动在同一事务里用 executemany 写入，只提交一次
+    placeholders = ",".join("?" * len(task_ids))
+    tasks = db.execute(
+        f"SELECT id, time_of_day, jitter_seconds, interval_seconds, schedule_type FROM tg_auto_send_tasks WHERE owner = ? AND id IN ({placeholders})",
+        [username, *task_ids],
+    ).fetchall()
+    if not tasks:
+        return 0
+    now_str = datetime.now().isoformat()
+
+    if action == "delete":
+        db.executemany("DELETE FROM tg_auto_send_tasks WHERE id = ? AND owner = ?", [(task["id"], username) for task in tasks])
+        db.executemany("DELETE FROM tg_auto_send_runs WHERE task_id = ?", [(task["id"],) for task in tasks])
+        db.executemany("DELETE FROM tg_task_counters WHERE task_id = ?", [(task["id"],) for task in tasks])
+    elif action in ("enable", "disable"):
+        # 重新启用时按计划重算下次运行时间，避免停用期间过期的时间点被立即触发
+        db.executemany(
+            "UPDATE tg_auto_send_tasks SET enabled = ?, next_run_at = ?, updated_at = ? WHERE id = ? AND owner = ?",
+            [
+                (
+                    1 if action == "enable" else 0,
+                    schedule_next_run(task["interval_seconds"], task["jitter_seconds"], task["schedule_type"], task["time_of_day"]),
+                    now_str,
+                    task["id"],
+                    username,
+                )
+                for task in tasks
+            ],
+        )
+    elif action == "retime":
+        time_of_day, jitter_value = parse_task_schedule(payload.get("time_of_day"), payload.get("jitter_seconds"))
+        db.executemany(
+            "UPDATE tg_auto_send_tasks SET time_of_day = ?, jitter_seconds = ?, interval_seconds = 86400, schedule_type = 'daily', next_run_at = ?, updated_at = ? WHERE id = ? AND owner = ?",
+            [
+                (time_of_day, jitter_value, schedule_next_run(86400, jitter_value, "daily", time_of_day), now_str, task["id"], username)
+                for task in tasks
+            ],
+        )
+    elif action == "edit":
+        message_text = (payload.get("message") or "").strip()
+        if not message_text:
+            raise ValueError("发送内容不能为空。")
+        validate_message_template(message_text)
+        db.executemany(
+            "UPDATE tg_auto_send_tasks SET message = ?, updated_at = ? WHERE id = ? AND owner = ?",
+            [(message_text, now_str, task["id"], username) for task in tasks],
+        )
+    else:
+        raise ValueError("不支持的批量操作。")
+    return len(tasks)
+
+
+@app.route("/auto/send/bulk", methods=["POST"])
+def auto_send_bulk():
+    username = require_login()
+    if not username:
+        return jsonify({"error": "unauthorized"}), 401
+
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = request.form.to_dict()
+        payload["task_ids"] = request.form.getlist("task_ids")
+    action = payload.get("action")
+    if action not in TASK_BULK_ACTIONS:
+        return jsonify({"error": "不支持的批量操作。"}), 400
+    try:
+        task_ids = sorted({int(item) for item in payload.get("task_ids") or []})
+    except (TypeError, ValueError):
+        return jsonify({"error": "任务 ID 不正确。"}), 400
+    if not task_ids:
+        return jsonify({"error": "请先选择任务。"}), 400
+
+    db = get_db()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        changed = apply_bulk_task_action(db, username, action, task_ids, payload)
+        db.commit()
+    except ValueError as exc:
+        db.rollback()
+        return jsonify({"error": str(exc)}), 400
+    except sqlite3.OperationalError as exc:
+        # 调度器或拉取正持有写锁时等待超时，整批已回滚，可稍后重试
+        db.rollback()
+        return jsonify({"error": f"数据库繁忙，请稍后重试（{exc}）。"}), 503, {"Retry-After": "5"}
+    return jsonify({"action": action, "changed": changed})
+
+
+@app.route("/auto/send/export")
+def auto_send_export():
+    username = require_login()
+    if not username:
+        return redirect(url_for("login"))
+
+    export_format = request.args.get("format", "csv")
+    where = ["owner = ?"]
+    params: list = [username]
+    account_id = request.args.get("account_id", "").strip()
+    if account_id:
+        where.append("account_id = ?")
+        params.append(account_id)
+    rows = get_db().execute(
+        f"SELECT {', '.join(TASK_EXPORT_FIELDS)} FROM tg_auto_send_tasks WHERE {' AND '.join(where)} ORDER BY id",
+        params,
+    ).fetchall()
+    filename = f"tghelper-tasks-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    if export_format == "json":
+        body = json.dumps([dict(row) for row in rows], ensure_ascii=False, indent=2)
+        return Response(body, mimetype="application/json", headers={"Content-Disposition": f"attachment; filename={filename}.json"})
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(TASK_EXPORT_FIELDS)
+    writer.writerows([row[field] for field in TASK_EXPORT_FIELDS] for row in rows)
+    # 带 BOM 方便 Excel 正确识别 UTF-8
+    return Response("\ufeff" + buffer.getvalue(), mimetype="text/csv", headers={"Content-Disposition": f"attachment; filename={filename}.csv"})
+
+
+def parse_task_import(upload) -> list[dict]:
+    raw = upload.read().decode("utf-8-sig")
+    if (upload.filename or "").lower().endswith(".json") or raw.lstrip().startswith("["):
+        try:
+            rows = json.loads(raw)
+        except ValueError:
+            raise ValueError("JSON 格式不正确。")
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("JSON 需要是任务对象数组。")
+        return rows
+    return list(csv.DictReader(io.StringIO(raw)))
+
+
+def import_tasks(db: sqlite3.Connection, username: str, rows: list[dict]) -> tuple[int, int]:
+    own_accounts = {row["id"] for row in db.execute("SELECT id FROM tg_accounts WHERE owner = ?", (username,))}
+    own_tasks = {row["id"]: row["message"] for row in db.execute("SELECT id, message FROM tg_auto_send_tasks WHERE owner = ?", (username,))}
+    now_str = datetime.now().isoformat()
+    inserts = []
+    updates = []
+    for line, row in enumerate(rows, start=1):
+        try:
+            account_id = int(row.get("account_id") or 0)
+        except (TypeError, ValueError):
+            account_id = 0
+        if account_id not in own_accounts:
+            raise ValueError(f"第 {line} 行：账号 {row.get('account_id')} 不存在。")
+        dialog_id = str(row.get("dialog_id") or "").strip()
+        message_text = str(row.get("message") or "").strip()
+        if not dialog_id or not message_text:
+            raise ValueError(f"第 {line} 行：会话ID和发送内容不能为空。")
+        try:
+            task_id = int(row.get("id") or 0)
+        except (TypeError, ValueError):
+            task_id = 0
+        try:
+            validate_message_template(message_text, own_tasks.get(task_id))
+        except ValueError as exc:
+            raise ValueError(f"第 {line} 行：{exc}")
+        try:
+            time_of_day, jitter_value = parse_task_schedule(str(row.get("time_of_day") or ""), row.get("jitter_seconds"))
+        except ValueError as exc:
+            raise ValueError(f"第 {line} 行：{exc}")
+        # 留空按默认启用，无法识别的取值报错，避免表格里漏填的一列把任务全部停用
+        enabled_value = row.get("enabled")
+        enabled_text = "" if enabled_value is None else str(enabled_value).strip().lower()
+        if enabled_text in ("", "1", "true", "yes", "y", "on", "是"):
+            enabled = 1
+        elif enabled_text in ("0", "false", "no", "n", "off", "否"):
+            enabled = 0
+        else:
+            raise ValueError(f"第 {line} 行：启用状态 {enabled_value} 无法识别，请填写 1 或 0。")
+        next_run = schedule_next_run(86400, jitter_value, "daily", time_of_day)
+        if task_id in own_tasks:
+            updates.append((account_id, dialog_id, message_text, time_of_day, jitter_value, enabled, next_run, now_str, task_id, username))
+        else:
+            inserts.append((username, account_id, dialog_id, message_text, 86400, jitter_value, "daily", time_of_day, enabled, next_run, now_str, now_str))
+
+    db.executemany(
+        """
+        INSERT INTO tg_auto_send_tasks (owner, account_id, dialog_id, message, interval_seconds, jitter_seconds, schedule_type, time_of_day, enabled, next_run_at, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        inserts,
+    )
+    db.executemany(
+        """
+        UPDATE tg_auto_send_tasks
+        SET account_id = ?, dialog_id = ?, message = ?, time_of_day = ?, jitter_seconds = ?, interval_seconds = 86400,
+            schedule_type = 'daily', enabled = ?, next_run_at = ?, updated_at = ?
+        WHERE id = ? AND owner = ?
+        """,
+        updates,
+    )
+    return len(inserts), len(updates)
+
+
+@app.route("/auto/send/import", methods=["POST"])
+def auto_send_import():
+    username = require_login()
+    if not username:
+        return redirect(url_for("login"))
+
+    token = request.form.get("token")
+    account_id = request.form.get("account_id")
+    upload = request.files.get("file")
+    db = get_db()
+    try:
+        if not upload or not upload.filename:
+            raise ValueError("请选择要导入的 CSV 或 JSON 文件。")
+        rows = parse_task_import(upload)
+        db.execute("BEGIN IMMEDIATE")
+        inserted, updated = import_tasks(db, username, rows)
+        db.commit()
+    except (ValueError, UnicodeDecodeError, csv.Error, sqlite3.OperationalError) as exc:
+        db.rollback()
+        if isinstance(exc, sqlite3.OperationalError):
+            error = f"数据库繁忙，导入未生效，请稍后重试（{exc}）。"
+        elif isinstance(exc, (UnicodeDecodeError, csv.Error)):
+            error = f"文件无法解析：{exc.__class__.__name__}"
+        else:
+            error = str(exc)
+        return redirect(
+            url_for("auto_send_manage", token=token, account_id=account_id, error=error)
+            if token
+            else url_for("auto_send_manage", account_id=account_id, error=error)
+        )
+    msg = f"已导入：新建 {inserted} 个任务，更新 {updated} 个任务。"
+    return redirect(
+        url_for("auto_send_manage", token=token, account_id=account_id, message=msg)
+        if token
+        else url_for("auto_send_manage", account_id=account_id, message=msg)
+    )
+
+
 @app.route("/auto/send/run/<int:task_id>", methods=["POST"])
 def auto_send_run(task_id: int):
     username = require_login()
@@ -1455,37 +4592,20 @@ def auto_send_run(task_id: int):
 
     token = request.form.get("token")
     account_id = request.form.get("account_id")
+    wants_json = request.accept_mimetypes.best == "application/json"
     db = get_db()
-    task = db.execute(
-        """
-        SELECT t.id, t.dialog_id, t.message, a.session_text
-        FROM tg_auto_send_tasks t
-        JOIN tg_accounts a ON a.id = t.account_id
-        WHERE t.id = ? AND t.owner = ?
-        """,
-        (task_id, username),
-    ).fetchone()
+    task = db.execute("SELECT id FROM tg_auto_send_tasks WHERE id = ? AND owner = ?", (task_id, username)).fetchone()
 
     if not task:
+        if wants_json:
+            return jsonify({"error": "任务不存在。"}), 404
         return redirect(url_for("auto_send_manage", token=token, error="任务不存在。") if token else url_for("auto_send_manage", error="任务不存在。"))
 
-    try:
-        reply = run_async(send_and_fetch_reply(task["session_text"], task["dialog_id"], task["message"]))
-        db.execute(
-            "UPDATE tg_auto_send_tasks SET last_run_at = ?, last_result = ?, last_reply = ?, updated_at = ? WHERE id = ?",
-            (datetime.now().isoformat(), f"sent [{utc8_now_text()}]", reply, datetime.now().isoformat(), task_id),
-        )
-        db.commit()
-        msg = "已发送。"
-    except Exception as exc:
-        detail = f"{exc.__class__.__name__}: {exc}" if str(exc) else exc.__class__.__name__
-        db.execute(
-            "UPDATE tg_auto_send_tasks SET last_run_at = ?, last_result = ?, updated_at = ? WHERE id = ?",
-            (datetime.now().isoformat(), f"failed [{utc8_now_text()}]: {detail}", datetime.now().isoformat(), task_id),
-        )
-        db.commit()
-        msg = "发送失败。"
-
+    # 只投递到发送线程池，立即返回；结果写回任务并可通过 /auto/send/jobs/<id> 查询
+    job = enqueue_send_job(task_id, username)
+    if wants_json:
+        return jsonify({"job": job.to_dict()}), 202
+    msg = "已加入发送队列，稍后刷新查看结果。"
     return redirect(
         url_for("auto_send_manage", token=token, account_id=account_id, message=msg)
         if token
@@ -1493,6 +4613,60 @@ def auto_send_run(task_id: int):
     )
 
 
+@app.route("/auto/send/jobs/<job_id>")
+def auto_send_job_status(job_id: str):
+    username = require_login()
+    if not username:
+        return jsonify({"error": "unauthorized"}), 401
+    job = get_send_job(job_id, username)
+    if not job:
+        return jsonify({"error": "not found"}), 404
+    return jsonify({"job": job.to_dict()})
+
+
+@app.route("/auto/send/events")
+def auto_send_events():
+    username = require_login()
+    if not username:
+        return jsonify({"error": "unauthorized"}), 401
+    last_event_id = request.headers.get("Last-Event-ID", "").strip()
+    events = TASK_EVENTS.subscribe(username, int(last_event_id) if last_event_id.isdigit() else None)
+    if events is None:
+        return jsonify({"error": "too many event streams"}), 503, {"Retry-After": "10"}
+
+    def stream():
+        deadline = time.monotonic() + TASK_EVENT_STREAM_SECONDS
+        try:
+            yield "retry: 3000\n\n"
+            while time.monotonic() < deadline:
+                try:
+                    item = events.get(timeout=TASK_EVENT_HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if item is None:
+                    break
+                yield format_task_event(*item)
+        finally:
+            TASK_EVENTS.unsubscribe(events)
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN:
+        allowed = request.headers.get("Authorization", "") == f"Bearer {METRICS_TOKEN}"
+    else:
+        # 本机反向代理转发的请求来源也是回环地址，带转发头时不按本机访问放行
+        forwarded = any(request.headers.get(name) for name in ("X-Forwarded-For", "X-Real-IP", "Forwarded"))
+        local = request.remote_addr in ("127.0.0.1", "::1") and not forwarded
+        allowed = local or bool(require_login())
+    if not allowed:
+        return Response("forbidden\n", status=403, mimetype="text/plain")
+    return Response(METRICS.render(dispatcher_metric_series(get_db())), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/tg/login/start", methods=["POST"])
 def tg_login_start():
     username = require_login()
@@ -1512,7 +4686,7 @@ def tg_login_start():
     db = get_db()
     cur = db.execute(
         "INSERT INTO tg_login_flows (owner, phone, account_name, session_text, phone_code_hash, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-        (username, phone, account_name or None, session_text, phone_code_hash, datetime.utcnow().isoformat()),
+        (username, phone, account_name or None, encrypt_session(session_text), phone_code_hash, datetime.utcnow().isoformat()),
     )
     db.commit()
     flow_id = cur.lastrowid
@@ -1548,6 +4722,10 @@ def tg_login_verify():
 
     code = request.form.get("code", "").strip()
     password = request.form.get("password", "").strip() or None
+    try:
+        flow_session_text = decrypt_session(flow["session_text"])
+    except RuntimeError:
+        return redirect(url_for("accounts", token=token, error="登录流程已失效，请重新发送验证码。") if token else url_for("accounts", error="登录流程已失效，请重新发送验证码。"))
     if not code:
         return redirect(
             url_for("tg_login_verify", flow_id=flow_id, token=token, error="请输入验证码。")
@@ -1558,7 +4736,7 @@ def tg_login_verify():
     ok, error, display_name, final_session = run_async(
         complete_tg_login(
             phone=flow["phone"],
-            session_text=flow["session_text"],
+            session_text=flow_session_text,
             phone_code_hash=flow["phone_code_hash"],
             code=code,
             password=password,
@@ -1572,16 +4750,17 @@ def tg_login_verify():
         )
 
     account_name = flow["account_name"] or display_name or flow["phone"]
-    final_session_text = final_session or flow["session_text"]
+    final_session_text = final_session or flow_session_text
     cur = db.execute(
-        "INSERT INTO tg_accounts (owner, account_name, session_text, created_at) VALUES (?, ?, ?, ?)",
-        (username, account_name, final_session_text, datetime.utcnow().isoformat()),
+        "INSERT INTO tg_accounts (owner, account_name, session_text, created_at) VALUES (?, ?, '', ?)",
+        (username, account_name, datetime.utcnow().isoformat()),
     )
     account_id = cur.lastrowid
+    save_account_session(db, account_id, final_session_text)
     db.execute("DELETE FROM tg_login_flows WHERE id = ? AND owner = ?", (flow_id, username))
     db.commit()
     if account_id:
-        refresh_dialogs_for_account(account_id, final_session_text)
+        refresh_dialogs_for_account(account_id)
     return redirect(url_for("accounts", token=token) if token else url_for("accounts"))
 
 
@@ -1598,13 +4777,13 @@ def tg_refresh_dialogs():
 
     db = get_db()
     account = db.execute(
-        "SELECT id, session_text FROM tg_accounts WHERE id = ? AND owner = ?",
+        "SELECT id FROM tg_accounts WHERE id = ? AND owner = ?",
         (account_id, username),
     ).fetchone()
     if not account:
         return redirect(url_for("accounts", token=token, error="账号不存在。") if token else url_for("accounts", error="账号不存在。"))
 
-    refresh_dialogs_for_account(account["id"], account["session_text"])
+    refresh_dialogs_for_account(account["id"])
     return redirect(
         url_for("accounts", token=token, account_id=account_id)
         if token
@@ -1643,14 +4822,221 @@ def tg_save_sign_task():
     )
 
 
+class PooledRequestHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle(self) -> None:
+        self.requests_served = 0
+        super().handle()
+
+    def handle_one_request(self) -> None:
+        # 等待下一个 keep-alive 请求时使用较短的空闲超时，避免空连接长期占用工作线程
+        self.connection.settimeout(SERVE_KEEPALIVE_TIMEOUT if self.requests_served else SERVE_REQUEST_TIMEOUT)
+        super().handle_one_request()
+        self.requests_served += 1
+        if self.server.draining:
+            self.close_connection = True
+
+    def parse_request(self) -> bool:
+        self.connection.settimeout(SERVE_REQUEST_TIMEOUT)
+        return super().parse_request()
+
+    def run_wsgi(self) -> None:
+        # Werkzeug 自带的实现每个响应都会关闭连接，这里按 HTTP/1.1 保持连接：
+        # 请求体用 LimitedStream 包装并在响应后读尽，响应没有 Content-Length 时改用 chunked；
+        # HTTP/1.0 客户端不认识 chunked，此时不分块，改为发完后关闭连接来结束响应体。
+        # 读尽请求体后，同一连接上流水线发送的后续请求留在 rfile 缓冲中，由下一轮 handle_one_request 依次应答
+        http11 = self.request_version == "HTTP/1.1"
+        if http11 and self.headers.get("Expect", "").lower().strip() == "100-continue":
+            self.wfile.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        environ = self.make_environ()
+        self.environ = environ
+        request_body = None
+        if environ.get("wsgi.input_terminated"):
+            self.close_connection = True
+        else:
+            try:
+                content_length = max(int(environ.get("CONTENT_LENGTH") or 0), 0)
+            except ValueError:
+                content_length = 0
+                self.close_connection = True
+            request_body = LimitedStream(self.rfile, content_length)
+            environ["wsgi.input"] = request_body
+
+        state = {"status": None, "headers": None, "sent": False, "chunked": False}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and state["sent"]:
+                raise exc_info[1].with_traceback(exc_info[2])
+            state["status"] = status
+            state["headers"] = headers
+            return write
+
+        def write(data: bytes) -> None:
+            if not state["sent"]:
+                code_text, _, reason = state["status"].partition(" ")
+                code = int(code_text)
+                self.send_response(code, reason)
+                header_keys = set()
+                for key, value in state["headers"]:
+                    header_keys.add(key.lower())
+                    self.send_header(key, value)
+                no_body = self.command == "HEAD" or code < 200 or code in (204, 304)
+                if "content-length" not in header_keys and not no_body:
+                    if http11:
+                        state["chunked"] = True
+                        self.send_header("Transfer-Encoding", "chunked")
+                    else:
+                        self.close_connection = True
+                if self.close_connection or self.server.draining:
+                    self.close_connection = True
+                    self.send_header("Connection", "close")
+                self.end_headers()
+                state["sent"] = True
+            if not data or self.command == "HEAD":
+                return
+            if state["chunked"]:
+                self.wfile.write(f"{len(data):X}\r\n".encode("latin-1") + data + b"\r\n")
+            else:
+                self.wfile.write(data)
+            self.wfile.flush()
+
+        application_iter = self.server.app(environ, start_response)
+        try:
+            for data in application_iter:
+                write(data)
+            if not state["sent"]:
+                write(b"")
+            if state["chunked"]:
+                self.wfile.write(b"0\r\n\r\n")
+        except Exception:
+            self.close_connection = True
+            raise
+        finally:
+            if hasattr(application_iter, "close"):
+                application_iter.close()
+        if request_body is not None and not self.close_connection:
+            request_body.exhaust()
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    # 固定线程池处理请求；线程全忙时不再 accept，新连接在内核队列中排队
+    multithread = True
+    request_queue_size = 128
+
+    def __init__(self, host: str, port: int, wsgi_app, threads: int):
+        super().__init__(host, port, wsgi_app, handler=PooledRequestHandler)
+        self.draining = False
+        self._slots = threading.BoundedSemaphore(threads)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+
+    def process_request(self, request, client_address) -> None:
+        self._slots.acquire()
+        self._executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def drain(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+def wait_with_timeout(target, timeout: float) -> bool:
+    worker = threading.Thread(target=target, daemon=True)
+    worker.start()
+    worker.join(timeout)
+    return not worker.is_alive()
+
+
+def start_background_services() -> None:
+    if DISPATCH_ROLE not in DISPATCH_ROLES:
+        raise SystemExit(f"TGHELPER_ROLE={DISPATCH_ROLE} 无效，可选：{'、'.join(DISPATCH_ROLES)}")
+    with app.app_context():
+        init_db()
+        load_api_config()
+        configure_scheduler_jobs()
+    if not SCHEDULER.running:
+        SCHEDULER.start()
+
+
+def shutdown_background_services(deadline: float) -> None:
+    # 先停调度器并等待正在发送的任务（定时与手动触发）结束，再取消后台备份任务
+    if SCHEDULER.running and not wait_with_timeout(lambda: SCHEDULER.shutdown(wait=True), max(deadline - time.monotonic(), 0)):
+        app.logger.warning("等待自动发送任务结束超时，强制退出。")
+    if DISPATCH_ROLE in ("all", "dispatcher"):
+        unregister_dispatcher()
+    if not wait_with_timeout(lambda: SEND_EXECUTOR.shutdown(wait=True), max(deadline - time.monotonic(), 0)):
+        app.logger.warning("等待手动发送任务结束超时，强制退出。")
+    db_job = get_db_job()
+    if db_job and db_job.status == "running":
+        db_job.cancel()
+        while db_job.status == "running" and time.monotonic() < deadline:
+            time.sleep(0.2)
+    CLOUDFLARE_CLIENT.close()
+
+
+def serve_dispatcher() -> None:
+    # 只运行自动发送调度、不监听端口的进程；可与网页进程（TGHELPER_ROLE=web）及其他调度进程共用同一个数据库文件
+    stopping = threading.Event()
+
+    def request_stop(signum, _frame) -> None:
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    start_background_services()
+    print(f"TgHelper 调度进程已启动：{DISPATCH_WORKER_ID}")
+    while not stopping.wait(1):
+        pass
+    if SCHEDULER.running:
+        SCHEDULER.pause()
+    shutdown_background_services(time.monotonic() + SERVE_SHUTDOWN_TIMEOUT)
+
+
+def serve_production(host: str = SERVE_HOST, port: int = SERVE_PORT, threads: int = SERVE_THREADS) -> None:
+    server = PooledWSGIServer(host, port, app, threads)
+    stopping = threading.Event()
+
+    def request_stop(signum, _frame) -> None:
+        if stopping.is_set():
+            return
+        stopping.set()
+        server.draining = True
+        TASK_EVENTS.close()
+        # shutdown() 会等待 serve_forever 退出，不能在信号处理所在的主线程里直接调用
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    start_background_services()
+    print(f"TgHelper 已启动：http://{host}:{port}（{threads} 个工作线程）")
+    try:
+        server.serve_forever()
+    finally:
+        deadline = time.monotonic() + SERVE_SHUTDOWN_TIMEOUT
+        if SCHEDULER.running:
+            SCHEDULER.pause()
+        server.server_close()
+        if not wait_with_timeout(server.drain, SERVE_SHUTDOWN_TIMEOUT):
+            app.logger.warning("等待进行中的请求结束超时，强制退出。")
+        shutdown_background_services(deadline)
+
+
 if __name__ == "__main__":
     is_dev = os.environ.get("TGHELPER_DEV") == "1"
-    if not is_dev or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
-        with app.app_context():
-            init_db()
-            load_api_config()
-            configure_scheduler_jobs()
-        if not SCHEDULER.running:
-            SCHEDULER.start()
-
-    app.run(host="0.0.0.0", port=15018, debug=is_dev, use_reloader=is_dev)
+    if DISPATCH_ROLE == "dispatcher":
+        serve_dispatcher()
+    elif is_dev:
+        if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            start_background_services()
+        app.run(host=SERVE_HOST, port=SERVE_PORT, debug=True, use_reloader=True)
+    else:
+        serve_production()
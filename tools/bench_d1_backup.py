@@ -0,0 +1,105 @@
+import argparse
+import json
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import TgHelper  # noqa: E402
+from d1_standin import (  # noqa: E402
+    STANDIN_ACCOUNT_ID,
+    STANDIN_DATABASE_ID,
+    add_fault_arguments,
+    faults_from_args,
+    standin_api_base,
+    start_standin_server,
+)
+
+
+def init_local_db(db_path: Path) -> None:
+    TgHelper.DB_PATH = db_path
+    with TgHelper.app.app_context():
+        TgHelper.init_db()
+
+
+def seed_local_db(db_path: Path, dialog_rows: int) -> None:
+    init_local_db(db_path)
+    conn = sqlite3.connect(db_path)
+    now = datetime.now().isoformat()
+    conn.execute(
+        "INSERT INTO tg_accounts (owner, account_name, session_text, created_at) VALUES (?, ?, ?, ?)",
+        ("bench", "bench", "x" * 360, now),
+    )
+    conn.executemany(
+        "INSERT INTO tg_dialogs (account_id, dialog_id, title, username, updated_at) VALUES (?, ?, ?, ?, ?)",
+        ((1, str(-1000000000000 - i), f"会话 {i} 'quoted'", f"user_{i}", now) for i in range(dialog_rows)),
+    )
+    conn.commit()
+    conn.close()
+
+
+def timed(standin, operation) -> dict:
+    standin.reset_stats()
+    started = time.perf_counter()
+    ok, message = operation()
+    elapsed = time.perf_counter() - started
+    return {
+        "ok": ok,
+        "message": message,
+        "seconds": round(elapsed, 3),
+        "requests": standin.stats["requests"],
+        "injected_errors": standin.stats["injected_errors"],
+        "bytes_in": standin.stats["bytes_in"],
+    }
+
+
+def run_size(rows: int, args: argparse.Namespace) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        local_path = Path(tmp) / "local.db"
+        pulled_path = Path(tmp) / "pulled.db"
+        seed_local_db(local_path, rows)
+        init_local_db(pulled_path)
+        server, standin = start_standin_server(str(Path(tmp) / "d1.db"), faults=faults_from_args(args))
+        TgHelper.CF_API_BASE = standin_api_base(server)
+        try:
+            conn = sqlite3.connect(local_path)
+            conn.row_factory = sqlite3.Row
+            backup = timed(
+                standin, lambda: TgHelper.backup_local_to_d1("bench-token", STANDIN_ACCOUNT_ID, STANDIN_DATABASE_ID, conn, full=True)
+            )
+            conn.close()
+
+            conn = sqlite3.connect(pulled_path)
+            conn.row_factory = sqlite3.Row
+            pull = timed(standin, lambda: TgHelper.pull_d1_to_local("bench-token", STANDIN_ACCOUNT_ID, STANDIN_DATABASE_ID, conn))
+            pulled_rows = conn.execute("SELECT COUNT(1) FROM tg_dialogs").fetchone()[0]
+            conn.close()
+        finally:
+            TgHelper.CLOUDFLARE_CLIENT.close()
+            server.shutdown()
+            server.server_close()
+            standin.conn.close()
+
+    for result in (backup, pull):
+        result["rows_per_second"] = round(rows / result["seconds"], 1) if result["seconds"] else None
+    return {"rows": rows, "backup": backup, "pull": pull, "pulled_rows_match": pulled_rows == rows}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="备份/拉取到本地 D1 替身的吞吐测试")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="逗号分隔的 tg_dialogs 行数")
+    parser.add_argument("--rows", type=int, default=None, help="只测试单个行数（覆盖 --sizes）")
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    sizes = [args.rows] if args.rows else [int(item) for item in args.sizes.split(",") if item.strip()]
+    for rows in sizes:
+        print(json.dumps(run_size(rows, args), ensure_ascii=False), flush=True)
+
+
+if __name__ == "__main__":
+    main()
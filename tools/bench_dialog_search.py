@@ -0,0 +1,67 @@
+import argparse
+import json
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import TgHelper  # noqa: E402
+
+WORDS = ["签到", "福利", "频道", "群组", "机器人", "crypto", "daily", "news", "market", "airdrop", "讨论", "通知"]
+
+
+def seed_dialogs(db_path: Path, rows: int) -> None:
+    TgHelper.DB_PATH = db_path
+    with TgHelper.app.app_context():
+        TgHelper.init_db()
+    conn = sqlite3.connect(db_path)
+    now = datetime.now().isoformat()
+    conn.execute(
+        "INSERT INTO tg_accounts (owner, account_name, session_text, created_at) VALUES (?, ?, ?, ?)",
+        ("bench", "bench", "x", now),
+    )
+    rng = random.Random(7)
+    conn.executemany(
+        "INSERT INTO tg_dialogs (account_id, dialog_id, title, username, updated_at) VALUES (?, ?, ?, ?, ?)",
+        (
+            (1, str(-1000000000000 - i), f"{rng.choice(WORDS)}{rng.choice(WORDS)} {i}", f"user_{rng.choice(WORDS)}_{i}", now)
+            for i in range(rows)
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="会话搜索延迟测试")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    queries = ["签到福", "crypto", "mark", "12345", "user_new", "机器人 daily", "福利"]
+    with tempfile.TemporaryDirectory() as tmp:
+        seed_dialogs(Path(tmp) / "local.db", args.rows)
+        client = TgHelper.app.test_client()
+        with client.session_transaction() as sess:
+            sess["user"] = "bench"
+        results = []
+        for query in queries:
+            timings = []
+            count = 0
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                resp = client.get("/api/dialogs/search", query_string={"account_id": 1, "q": query, "limit": 20})
+                timings.append((time.perf_counter() - started) * 1000)
+                count = len(resp.get_json()["items"])
+            timings.sort()
+            results.append({"q": query, "hits": count, "p50_ms": round(timings[len(timings) // 2], 2), "max_ms": round(timings[-1], 2)})
+    print(json.dumps({"rows": args.rows, "results": results}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import argparse
+import json
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import TgHelper  # noqa: E402
+from fake_telegram import (  # noqa: E402
+    FakeTelegramNetwork,
+    add_fake_telegram_arguments,
+    fake_config_from_args,
+    install_fake_telegram,
+)
+
+DB_TIME = {"seconds": 0.0, "statements": 0}
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            DB_TIME["seconds"] += time.perf_counter() - started
+            DB_TIME["statements"] += 1
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            DB_TIME["seconds"] += time.perf_counter() - started
+
+
+class TimedConnection(sqlite3.Connection):
+    def execute(self, *args):
+        return self.cursor(TimedCursor).execute(*args)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            DB_TIME["seconds"] += time.perf_counter() - started
+
+
+def install_db_timer() -> None:
+    # 只替换 TgHelper 模块看到的 sqlite3.connect，调度器里的查询与提交都计入数据库耗时
+    shim = types.SimpleNamespace(**{name: getattr(sqlite3, name) for name in dir(sqlite3) if not name.startswith("__")})
+    shim.connect = lambda *args, **kwargs: sqlite3.connect(*args, factory=TimedConnection, **kwargs)
+    TgHelper.sqlite3 = shim
+
+
+def seed_tasks(db_path: Path, network: FakeTelegramNetwork, tasks: int, accounts: int, start: datetime, spread: float) -> dict[int, datetime]:
+    TgHelper.DB_PATH = db_path
+    with TgHelper.app.app_context():
+        TgHelper.init_db()
+    conn = sqlite3.connect(db_path)
+    now = datetime.now().isoformat()
+    dialogs_by_account: dict[int, list[int]] = {account: [] for account in range(1, accounts + 1)}
+    scheduled: dict[int, datetime] = {}
+    rows = []
+    for index in range(tasks):
+        account = index % accounts + 1
+        dialog_id = -1000000000000 - index
+        due = start + timedelta(seconds=spread * index / tasks)
+        dialogs_by_account[account].append(dialog_id)
+        scheduled[dialog_id] = due
+        rows.append(("bench", account, str(dialog_id), f"bench {index}", 86400, 0, "daily", "09:00", 1, due.isoformat(), now, now))
+    conn.executemany(
+        "INSERT INTO tg_accounts (id, owner, account_name, session_text, created_at) VALUES (?, ?, ?, '', ?)",
+        [(account, "bench", f"bench {account}", now) for account in dialogs_by_account],
+    )
+    for account in dialogs_by_account:
+        TgHelper.save_account_session(conn, account, f"bench-session-{account}")
+    conn.executemany(
+        """
+        INSERT INTO tg_auto_send_tasks (owner, account_id, dialog_id, message, interval_seconds, jitter_seconds, schedule_type,
+                                        time_of_day, enabled, next_run_at, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows,
+    )
+    conn.commit()
+    conn.close()
+    for account, dialog_ids in dialogs_by_account.items():
+        # 目标会话放在会话列表末尾，resolve_dialog_target 需要扫完整个列表
+        network.add_account(f"bench-session-{account}", dialog_ids)
+    return scheduled
+
+
+def count_finished(db_path: Path) -> tuple[int, int]:
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute(
+            "SELECT SUM(last_result LIKE 'sent%'), SUM(last_result LIKE 'failed%') FROM tg_auto_send_tasks"
+        ).fetchone()
+        return row[0] or 0, row[1] or 0
+    finally:
+        conn.close()
+
+
+def percentile(values: list[float], fraction: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+def git_commit() -> str | None:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).resolve().parent, capture_output=True, text=True, timeout=5
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip() or None
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    network = FakeTelegramNetwork(fake_config_from_args(args))
+    restore = install_fake_telegram(TgHelper, network)
+    install_db_timer()
+    TgHelper.SEND_REPLY_WAIT = args.reply_wait
+    TgHelper.load_api_config = lambda: None
+    TgHelper.app.config["TELEGRAM_API_ID"] = "1"
+    TgHelper.app.config["TELEGRAM_API_HASH"] = "bench"
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = Path(tmp) / "bench.db"
+            start = datetime.now()
+            scheduled = seed_tasks(db_path, network, args.tasks, args.accounts, start, args.spread_seconds)
+            DB_TIME.update(seconds=0.0, statements=0)
+
+            # 按调度器的固定间隔触发；上一轮超时运行时与 APScheduler 一样跳到下一个整点间隔
+            started = time.perf_counter()
+            tick_durations = []
+            sent = failed = 0
+            while time.perf_counter() - started < args.timeout:
+                tick_started = time.perf_counter()
+                TgHelper.process_auto_send_due_tasks()
+                tick_durations.append(time.perf_counter() - tick_started)
+                sent, failed = count_finished(db_path)
+                if sent + failed >= args.tasks:
+                    break
+                elapsed = time.perf_counter() - started
+                time.sleep(args.tick - elapsed % args.tick)
+            wall = time.perf_counter() - started
+    finally:
+        restore()
+
+    lags = [
+        (sent_at - scheduled[target].timestamp()) * 1000
+        for _session, target, sent_at in network.sends
+        if target in scheduled
+    ]
+    return {
+        "benchmark": "scheduler",
+        "commit": git_commit(),
+        "recorded_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "params": {
+            "tasks": args.tasks,
+            "accounts": args.accounts,
+            "spread_seconds": args.spread_seconds,
+            "tick": args.tick,
+            "reply_wait": args.reply_wait,
+            **network.config.to_dict(),
+        },
+        "sent": sent,
+        "failed": failed,
+        "completed": sent + failed >= args.tasks,
+        "wall_seconds": round(wall, 3),
+        "sends_per_second": round((sent + failed) / wall, 2) if wall else None,
+        "lag_ms": {
+            "p50": round(percentile(lags, 0.5), 1) if lags else None,
+            "p90": round(percentile(lags, 0.9), 1) if lags else None,
+            "p99": round(percentile(lags, 0.99), 1) if lags else None,
+            "max": round(max(lags), 1) if lags else None,
+        },
+        "db_seconds": round(DB_TIME["seconds"], 3),
+        "db_statements": DB_TIME["statements"],
+        "db_ms_per_send": round(DB_TIME["seconds"] * 1000 / (sent + failed), 3) if sent + failed else None,
+        "ticks": len(tick_durations),
+        "tick_seconds_max": round(max(tick_durations), 3) if tick_durations else None,
+        "telegram": dict(network.stats),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="自动发送调度吞吐测试（使用进程内 Telegram 替身）")
+    parser.add_argument("--tasks", type=int, default=500, help="任务数")
+    parser.add_argument("--accounts", type=int, default=10, help="账号数，任务按顺序轮流分配")
+    parser.add_argument("--spread-seconds", type=float, default=0, help="任务到期时间在多少秒内均匀分布，0 表示同时到期")
+    parser.add_argument("--tick", type=float, default=5, help="调度间隔秒数（与线上 CronTrigger 一致）")
+    parser.add_argument("--reply-wait", type=float, default=0, help="发送后等待回复的秒数（线上为 2）")
+    parser.add_argument("--timeout", type=float, default=600, help="最长运行秒数")
+    parser.add_argument("--output", default=None, help="把结果以 JSON Lines 追加写入该文件，便于跨版本对比")
+    add_fake_telegram_arguments(parser)
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    line = json.dumps(result, ensure_ascii=False)
+    print(line, flush=True)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as handle:
+            handle.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import argparse
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# 本地 D1 替身：在 SQLite 文件上模拟 Cloudflare D1 REST 接口，供备份/拉取调试与压测使用
+STANDIN_ACCOUNT_ID = "local-account"
+STANDIN_DATABASE_ID = "local-d1"
+
+DATABASE_PATH_RE = re.compile(r"^/client/v4/accounts/([^/]+)/d1/database/?$")
+QUERY_PATH_RE = re.compile(r"^/client/v4/accounts/([^/]+)/d1/database/([^/]+)/query/?$")
+CONTROL_PATH = "/__standin"
+
+
+def split_sql_statements(sql: str) -> list[str]:
+    statements = []
+    buffer = ""
+    for part in sql.split(";"):
+        buffer += part + ";"
+        if sqlite3.complete_statement(buffer):
+            if buffer.strip(" ;\r\n\t"):
+                statements.append(buffer)
+            buffer = ""
+    if buffer.strip(" ;\r\n\t"):
+        statements.append(buffer)
+    return statements
+
+
+class FaultConfig:
+    # 注入的延迟与错误；错误在执行 SQL 之前返回，客户端重试不会重复写入
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0, error_statuses: list[int] | None = None, retry_after: str | None = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses or [500]
+        self.retry_after = retry_after
+        self.fail_next: list[int] = []
+
+    def update(self, data: dict) -> None:
+        for key in ("latency_ms", "jitter_ms", "error_rate"):
+            if key in data:
+                setattr(self, key, float(data[key]))
+        if "error_statuses" in data:
+            self.error_statuses = [int(item) for item in data["error_statuses"]] or [500]
+        if "retry_after" in data:
+            self.retry_after = str(data["retry_after"]) if data["retry_after"] is not None else None
+        if "fail_next" in data:
+            self.fail_next.extend(int(item) for item in data["fail_next"])
+
+    def to_dict(self) -> dict:
+        return {
+            "latency_ms": self.latency_ms,
+            "jitter_ms": self.jitter_ms,
+            "error_rate": self.error_rate,
+            "error_statuses": self.error_statuses,
+            "retry_after": self.retry_after,
+            "fail_next": list(self.fail_next),
+        }
+
+
+class D1StandIn:
+    def __init__(self, db_path: str, db_name: str = "TgHelper", faults: FaultConfig | None = None):
+        self.db_name = db_name
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self.faults = faults or FaultConfig()
+        self.stats = {"requests": 0, "queries": 0, "statements": 0, "bytes_in": 0, "injected_errors": 0}
+
+    def reset_stats(self) -> None:
+        with self.lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+    def count(self, key: str, amount: int = 1) -> None:
+        with self.lock:
+            self.stats[key] += amount
+
+    def inject_fault(self) -> int | None:
+        # 返回需要模拟的 HTTP 状态码（0 表示直接断开连接），None 表示正常处理
+        faults = self.faults
+        delay = faults.latency_ms + random.uniform(0, faults.jitter_ms) if faults.jitter_ms else faults.latency_ms
+        if delay > 0:
+            time.sleep(delay / 1000)
+        with self.lock:
+            if faults.fail_next:
+                status = faults.fail_next.pop(0)
+            elif faults.error_rate and random.random() < faults.error_rate:
+                status = random.choice(faults.error_statuses)
+            else:
+                return None
+            self.stats["injected_errors"] += 1
+        return status
+
+    def database_info(self) -> dict:
+        return {"uuid": STANDIN_DATABASE_ID, "name": self.db_name, "created_at": "1970-01-01T00:00:00Z"}
+
+    def run_query(self, sql: str, params: list | None) -> tuple[int, dict]:
+        statements = split_sql_statements(sql)
+        results = []
+        with self.lock:
+            self.stats["queries"] += 1
+            try:
+                for statement in statements:
+                    started = time.perf_counter()
+                    if params and len(statements) == 1:
+                        cur = self.conn.execute(statement, params)
+                    else:
+                        cur = self.conn.execute(statement)
+                    rows = [dict(row) for row in cur.fetchall()] if cur.description else []
+                    results.append(
+                        {
+                            "results": rows,
+                            "success": True,
+                            "meta": {
+                                "changes": max(cur.rowcount, 0),
+                                "rows_read": len(rows),
+                                "duration": (time.perf_counter() - started) * 1000,
+                            },
+                        }
+                    )
+                    self.stats["statements"] += 1
+                self.conn.commit()
+            except sqlite3.Error as exc:
+                self.conn.rollback()
+                return 400, {"success": False, "errors": [{"code": 7500, "message": f"{exc}: SQLITE_ERROR"}], "messages": [], "result": []}
+        return 200, {"success": True, "errors": [], "messages": [], "result": results}
+
+
+def make_handler(standin: D1StandIn):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status: int, payload: dict) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_json(self) -> dict:
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            standin.count("bytes_in", len(raw))
+            return json.loads(raw.decode("utf-8")) if raw else {}
+
+        def send_fault(self, status: int) -> None:
+            if status == 0:
+                self.close_connection = True
+                self.connection.close()
+                return
+            body = json.dumps({"success": False, "errors": [{"code": 10000 + status, "message": f"injected HTTP {status}"}]}).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if status == 429 and standin.faults.retry_after is not None:
+                self.send_header("Retry-After", standin.faults.retry_after)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path.rstrip("/") == CONTROL_PATH:
+                self.send_json(200, {"faults": standin.faults.to_dict(), "stats": dict(standin.stats)})
+                return
+            standin.count("requests")
+            status = standin.inject_fault()
+            if status is not None:
+                self.send_fault(status)
+                return
+            if path.rstrip("/") == "/client/v4/accounts":
+                self.send_json(200, {"success": True, "errors": [], "result": [{"id": STANDIN_ACCOUNT_ID, "name": "local"}]})
+                return
+            if DATABASE_PATH_RE.match(path):
+                self.send_json(200, {"success": True, "errors": [], "result": [standin.database_info()]})
+                return
+            self.send_json(404, {"success": False, "errors": [{"message": "not found"}]})
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            try:
+                payload = self.read_json()
+            except ValueError:
+                self.send_json(400, {"success": False, "errors": [{"message": "invalid json"}]})
+                return
+            if path.rstrip("/") == CONTROL_PATH:
+                # 运行中调整故障注入，例如 {"latency_ms": 80, "error_rate": 0.05, "fail_next": [429, 0]}
+                if payload.get("reset_stats"):
+                    standin.reset_stats()
+                try:
+                    standin.faults.update(payload)
+                except (TypeError, ValueError):
+                    self.send_json(400, {"success": False, "errors": [{"message": "invalid fault config"}]})
+                    return
+                self.send_json(200, {"faults": standin.faults.to_dict(), "stats": dict(standin.stats)})
+                return
+            standin.count("requests")
+            status = standin.inject_fault()
+            if status is not None:
+                self.send_fault(status)
+                return
+            if DATABASE_PATH_RE.match(path):
+                self.send_json(200, {"success": True, "errors": [], "result": standin.database_info()})
+                return
+            match = QUERY_PATH_RE.match(path)
+            if match and match.group(2) != STANDIN_DATABASE_ID:
+                self.send_json(404, {"success": False, "errors": [{"code": 7404, "message": "database not found"}]})
+                return
+            if match:
+                status, result = standin.run_query(payload.get("sql") or "", payload.get("params"))
+                self.send_json(status, result)
+                return
+            self.send_json(404, {"success": False, "errors": [{"message": "not found"}]})
+
+    return Handler
+
+
+def start_standin_server(
+    db_path: str, host: str = "127.0.0.1", port: int = 0, faults: FaultConfig | None = None
+) -> tuple[ThreadingHTTPServer, D1StandIn]:
+    standin = D1StandIn(db_path, faults=faults)
+    server = ThreadingHTTPServer((host, port), make_handler(standin))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, standin
+
+
+def standin_api_base(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/client/v4"
+
+
+def add_fault_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency-ms", type=float, default=0, help="每个请求附加的固定延迟")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="在固定延迟之上随机增加的延迟")
+    parser.add_argument("--error-rate", type=float, default=0, help="随机返回错误的概率（0~1）")
+    parser.add_argument("--error-status", default="500", help="随机错误使用的状态码，逗号分隔；0 表示直接断开连接")
+    parser.add_argument("--retry-after", default=None, help="注入 429 时返回的 Retry-After 秒数")
+
+
+def faults_from_args(args: argparse.Namespace) -> FaultConfig:
+    return FaultConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        error_statuses=[int(item) for item in args.error_status.split(",") if item.strip()],
+        retry_after=args.retry_after,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="本地 D1 替身服务")
+    parser.add_argument("--db", default="d1_standin.db")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18787)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    standin = D1StandIn(args.db, faults=faults_from_args(args))
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(standin))
+    print(f"D1 替身已启动：TGHELPER_CF_API_BASE=http://{args.host}:{args.port}/client/v4")
+    print(f"故障注入控制：GET/POST http://{args.host}:{args.port}{CONTROL_PATH}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import asyncio
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from telethon.errors import FloodWaitError
+
+# 进程内的 Telegram 替身：替换 TgHelper 中的 TelegramClient/StringSession，按配置模拟每次 RPC 的延迟与错误，
+# 并记录每次发送的时间，供调度吞吐测试使用
+FAKE_REPLY_TEXT = "ok"
+
+
+class FakeTelegramConfig:
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0, flood_rate: float = 0, flood_seconds: int = 30):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+
+    def to_dict(self) -> dict:
+        return {
+            "latency_ms": self.latency_ms,
+            "jitter_ms": self.jitter_ms,
+            "error_rate": self.error_rate,
+            "flood_rate": self.flood_rate,
+            "flood_seconds": self.flood_seconds,
+        }
+
+
+class FakeEntity:
+    def __init__(self, entity_id: int, username: str | None = None):
+        self.id = entity_id
+        self.username = username
+
+
+class FakeDialog:
+    def __init__(self, dialog_id: int, name: str):
+        self.id = dialog_id
+        self.name = name
+        self.entity = FakeEntity(dialog_id, f"dialog_{abs(dialog_id)}")
+
+
+class FakeMessage:
+    def __init__(self, text: str, out: bool):
+        self.message = text
+        self.out = out
+        self.date = datetime.now(timezone.utc)
+
+
+class FakeTelegramNetwork:
+    # 会话文本 -> 该账号的会话列表；sends 记录 (会话文本, 会话 ID, 发送时间)
+    def __init__(self, config: FakeTelegramConfig | None = None, seed: int = 7):
+        self.config = config or FakeTelegramConfig()
+        self.dialogs: dict[str, list[FakeDialog]] = {}
+        self.sends: list[tuple[str, int, float]] = []
+        self.stats = {"connects": 0, "rpcs": 0, "errors": 0, "flood_waits": 0}
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+
+    def add_account(self, session_text: str, dialog_ids: list[int]) -> None:
+        self.dialogs[session_text] = [FakeDialog(dialog_id, f"会话 {dialog_id}") for dialog_id in dialog_ids]
+
+    def count(self, key: str) -> None:
+        with self.lock:
+            self.stats[key] += 1
+
+    async def rpc(self, may_fail: bool = False) -> None:
+        config = self.config
+        with self.lock:
+            self.stats["rpcs"] += 1
+            delay = config.latency_ms + (self.rng.uniform(0, config.jitter_ms) if config.jitter_ms else 0)
+            roll = self.rng.random() if may_fail else 1.0
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if roll < config.flood_rate:
+            self.count("flood_waits")
+            raise FloodWaitError(request=None, capture=config.flood_seconds)
+        if roll < config.flood_rate + config.error_rate:
+            self.count("errors")
+            raise ConnectionError("fake telegram: injected error")
+
+    def client_class(self):
+        network = self
+
+        class FakeTelegramClient:
+            def __init__(self, session, api_id=None, api_hash=None, **_kwargs):
+                self.session_text = session
+                self.connected = False
+
+            async def connect(self) -> None:
+                network.count("connects")
+                await network.rpc()
+                self.connected = True
+
+            async def disconnect(self) -> None:
+                self.connected = False
+
+            async def iter_dialogs(self, limit: int | None = None):
+                await network.rpc()
+                for dialog in network.dialogs.get(self.session_text, [])[:limit]:
+                    yield dialog
+
+            async def send_message(self, target, message: str) -> FakeMessage:
+                await network.rpc(may_fail=True)
+                target_id = target.id if isinstance(target, FakeEntity) else target
+                with network.lock:
+                    network.sends.append((self.session_text, target_id, time.time()))
+                return FakeMessage(message, out=True)
+
+            async def get_messages(self, target, limit: int = 1) -> list[FakeMessage]:
+                await network.rpc()
+                return [FakeMessage(FAKE_REPLY_TEXT, out=False)]
+
+        return FakeTelegramClient
+
+
+def install_fake_telegram(module, network: FakeTelegramNetwork):
+    # 会话文本直接作为 session 传给假客户端；返回恢复原实现的函数
+    original = (module.TelegramClient, module.StringSession)
+    module.TelegramClient = network.client_class()
+    module.StringSession = lambda session_text: session_text
+
+    def restore() -> None:
+        module.TelegramClient, module.StringSession = original
+
+    return restore
+
+
+def add_fake_telegram_arguments(parser) -> None:
+    parser.add_argument("--latency-ms", type=float, default=20, help="每次 Telegram RPC 的固定延迟")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="在固定延迟之上随机增加的延迟")
+    parser.add_argument("--error-rate", type=float, default=0, help="发送时随机报错（连接错误）的概率")
+    parser.add_argument("--flood-rate", type=float, default=0, help="发送时随机返回 FloodWait 的概率")
+
+
+def fake_config_from_args(args) -> FakeTelegramConfig:
+    return FakeTelegramConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate, flood_rate=args.flood_rate)
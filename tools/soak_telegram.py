@@ -0,0 +1,256 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import TgHelper  # noqa: E402
+from bench_scheduler import git_commit, percentile  # noqa: E402
+from telegram_standin import (  # noqa: E402
+    STANDIN_LOGIN_CODE,
+    TelegramStandIn,
+    add_standin_arguments,
+    install_telegram_standin,
+    standin_config_from_args,
+)
+
+SOAK_USER = "soak"
+
+
+def rss_mb() -> float:
+    # 优先读取当前 RSS；/proc 不可用时退回到峰值 RSS（Linux 上单位为 KB）
+    try:
+        with open("/proc/self/status", encoding="ascii") as handle:
+            for line in handle:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def open_fds() -> int | None:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def slope_per_hour(points: list[tuple[float, float]]) -> float | None:
+    # 最小二乘斜率，换算为每小时的变化量
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    denominator = sum((x - mean_x) ** 2 for x, _ in points)
+    if not denominator:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / denominator * 3600
+
+
+def login_accounts(client, accounts: int) -> None:
+    # 走真实的 /tg/login/start 与 /tg/login/verify，验证成功后路由会顺带刷新会话列表
+    for index in range(accounts):
+        phone = f"+1555{index:07d}"
+        response = client.post("/tg/login/start", data={"phone": phone, "account_name": f"soak {index}"})
+        location = response.headers.get("Location", "")
+        if "flow_id=" not in location:
+            raise RuntimeError(f"发送验证码失败：{location}")
+        flow_id = location.split("flow_id=")[1].split("&")[0]
+        response = client.post("/tg/login/verify", data={"flow_id": flow_id, "code": STANDIN_LOGIN_CODE})
+        if "error=" in response.headers.get("Location", ""):
+            raise RuntimeError(f"登录失败：{response.headers['Location']}")
+
+
+def seed_tasks(db_path: Path, tasks: int, interval: int) -> int:
+    conn = sqlite3.connect(db_path)
+    try:
+        dialogs = conn.execute("SELECT account_id, dialog_id FROM tg_dialogs ORDER BY account_id, dialog_id").fetchall()
+        if not dialogs:
+            raise RuntimeError("没有可用的会话，登录或刷新会话失败")
+        now = datetime.now()
+        rows = []
+        for index in range(tasks):
+            account_id, dialog_id = dialogs[index % len(dialogs)]
+            # 首次运行时间在一个周期内错开，避免所有任务挤在同一次调度
+            due = datetime.fromtimestamp(now.timestamp() + interval * index / tasks).isoformat()
+            rows.append((SOAK_USER, account_id, dialog_id, f"soak {index}", interval, 0, "interval", None, 1, due, now.isoformat(), now.isoformat()))
+        conn.executemany(
+            """
+            INSERT INTO tg_auto_send_tasks (owner, account_id, dialog_id, message, interval_seconds, jitter_seconds, schedule_type,
+                                            time_of_day, enabled, next_run_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+        conn.commit()
+        return len(dialogs)
+    finally:
+        conn.close()
+
+
+def window_sends(db_path: Path, since: str) -> dict:
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("SELECT ok, total_seconds FROM tg_auto_send_runs WHERE started_at >= ?", (since,)).fetchall()
+    finally:
+        conn.close()
+    totals = [row[1] * 1000 for row in rows]
+    return {
+        "sends": len(rows),
+        "failed": sum(1 for row in rows if not row[0]),
+        "send_ms_p50": round(percentile(totals, 0.5), 1) if totals else None,
+        "send_ms_p95": round(percentile(totals, 0.95), 1) if totals else None,
+    }
+
+
+def take_sample(client, db_path: Path, started: float, since: str, trace: bool) -> dict:
+    request_started = time.perf_counter()
+    response = client.get("/api/tasks?limit=50")
+    web_ms = (time.perf_counter() - request_started) * 1000
+    sample = {
+        "elapsed_seconds": round(time.monotonic() - started, 1),
+        "rss_mb": round(rss_mb(), 2),
+        "threads": threading.active_count(),
+        "fds": open_fds(),
+        "web_status": response.status_code,
+        "web_ms": round(web_ms, 1),
+        **window_sends(db_path, since),
+    }
+    if trace:
+        sample["traced_mb"] = round(tracemalloc.get_traced_memory()[0] / 1024 / 1024, 2)
+    return sample
+
+
+def drift(samples: list[dict], key: str) -> dict:
+    # 比较前三分之一与后三分之一采样的中位数
+    values = [sample[key] for sample in samples if sample.get(key) is not None]
+    if len(values) < 3:
+        return {"first": None, "last": None, "change_pct": None}
+    third = len(values) // 3
+    first = percentile(values[:third], 0.5)
+    last = percentile(values[-third:], 0.5)
+    return {"first": first, "last": last, "change_pct": round((last - first) * 100 / first, 1) if first else None}
+
+
+def run_soak(args: argparse.Namespace, emit) -> dict:
+    standin = TelegramStandIn(standin_config_from_args(args))
+    restore = install_telegram_standin(TgHelper, standin)
+    TgHelper.SEND_REPLY_WAIT = args.reply_wait
+    if args.tracemalloc:
+        tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = Path(tmp) / "soak.db"
+            TgHelper.DB_PATH = db_path
+            with TgHelper.app.app_context():
+                TgHelper.init_db()
+                db = TgHelper.get_db()
+                db.executemany(
+                    "INSERT OR REPLACE INTO app_settings (key, value) VALUES (?, ?)",
+                    [("telegram_api_id", "1"), ("telegram_api_hash", "standin")],
+                )
+                db.commit()
+
+            client = TgHelper.app.test_client()
+            client.post("/register", data={"username": SOAK_USER, "password": "soak", "confirm": "soak"})
+            login_accounts(client, args.accounts)
+            dialogs = seed_tasks(db_path, args.tasks, args.interval)
+            TgHelper.start_background_services()
+
+            started = time.monotonic()
+            deadline = started + args.duration_minutes * 60
+            samples = []
+            try:
+                while time.monotonic() < deadline:
+                    since = datetime.now().isoformat()
+                    time.sleep(min(args.sample_seconds, max(deadline - time.monotonic(), 0)))
+                    sample = take_sample(client, db_path, started, since, args.tracemalloc)
+                    samples.append(sample)
+                    emit({"sample": sample})
+            finally:
+                TgHelper.shutdown_background_services(time.monotonic() + 30)
+    finally:
+        restore()
+        if args.tracemalloc:
+            tracemalloc.stop()
+
+    # 第一个采样周期包含导入、登录与连接池预热，不计入内存增长
+    steady = samples[1:] if len(samples) > 2 else samples
+    rss_slope = slope_per_hour([(sample["elapsed_seconds"], sample["rss_mb"]) for sample in steady])
+    return {
+        "benchmark": "soak",
+        "commit": git_commit(),
+        "recorded_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "params": {
+            "duration_minutes": args.duration_minutes,
+            "accounts": args.accounts,
+            "dialogs": dialogs,
+            "tasks": args.tasks,
+            "interval": args.interval,
+            "reply_wait": args.reply_wait,
+            **standin.config.to_dict(),
+        },
+        "samples": len(samples),
+        "sends": sum(sample["sends"] for sample in samples),
+        "failed": sum(sample["failed"] for sample in samples),
+        "web_errors": sum(1 for sample in samples if sample["web_status"] != 200),
+        "memory": {
+            "rss_start_mb": steady[0]["rss_mb"] if steady else None,
+            "rss_end_mb": steady[-1]["rss_mb"] if steady else None,
+            "rss_max_mb": max(sample["rss_mb"] for sample in samples) if samples else None,
+            "rss_mb_per_hour": round(rss_slope, 2) if rss_slope is not None else None,
+            "threads_end": samples[-1]["threads"] if samples else None,
+            "fds_end": samples[-1]["fds"] if samples else None,
+        },
+        "latency_drift": {
+            "send_ms_p50": drift(samples, "send_ms_p50"),
+            "send_ms_p95": drift(samples, "send_ms_p95"),
+            "web_ms": drift(samples, "web_ms"),
+        },
+        "telegram": dict(standin.stats),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="使用本地 Telegram 替身长时间运行调度与 Web 服务，报告内存增长与延迟漂移")
+    parser.add_argument("--duration-minutes", type=float, default=60, help="运行时长（分钟）")
+    parser.add_argument("--sample-seconds", type=float, default=60, help="采样间隔秒数")
+    parser.add_argument("--accounts", type=int, default=3, help="通过登录流程创建的账号数")
+    parser.add_argument("--tasks", type=int, default=60, help="自动发送任务数，轮流分配到各账号的会话")
+    parser.add_argument("--interval", type=int, default=60, help="每个任务的发送间隔秒数")
+    parser.add_argument("--reply-wait", type=float, default=2, help="发送后等待回复的秒数（线上为 2）")
+    parser.add_argument("--tracemalloc", action="store_true", help="同时记录 Python 堆内存（有额外开销）")
+    parser.add_argument("--output", default=None, help="把采样与结果以 JSON Lines 追加写入该文件")
+    add_standin_arguments(parser)
+    args = parser.parse_args()
+
+    output = open(args.output, "a", encoding="utf-8") if args.output else None
+
+    def emit(record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False)
+        print(line, flush=True)
+        if output:
+            output.write(line + "\n")
+            output.flush()
+
+    try:
+        emit(run_soak(args, emit))
+    finally:
+        if output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
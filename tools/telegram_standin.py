@@ -0,0 +1,341 @@
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from telethon import TelegramClient, errors, functions, types
+from telethon.crypto import AuthKey
+from telethon.tl.tlobject import TLRequest
+
+# 本地 Telegram 替身：替换 TelegramClient 底层的 MTProtoSender，TL 请求不经过网络与加密，
+# 由进程内的 TelegramStandIn 按真实的 TL 类型作答。其上的 Telethon 代码（请求重试、FloodWait 休眠、
+# 实体缓存、iter_dialogs/get_messages 分页、send_code_request/sign_in 登录流程）全部照常运行。
+STANDIN_LOGIN_CODE = "12345"
+STANDIN_BOT_ID_BASE = 7000000000
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class StandInConfig:
+    def __init__(
+        self,
+        latency_ms: float = 0,
+        jitter_ms: float = 0,
+        connect_ms: float = 0,
+        reply_delay_ms: float = 500,
+        reply_rate: float = 1.0,
+        flood_rate: float = 0,
+        flood_seconds: int = 2,
+        bots: int = 50,
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.connect_ms = connect_ms
+        self.reply_delay_ms = reply_delay_ms
+        self.reply_rate = reply_rate
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.bots = bots
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+class StandInAccount:
+    def __init__(self, user_id: int, phone: str, bots: list[types.User]):
+        self.user = types.User(
+            id=user_id,
+            is_self=True,
+            access_hash=random.getrandbits(63),
+            first_name=f"standin {phone[-4:]}",
+            username=f"standin_{phone[-6:]}",
+            phone=phone,
+        )
+        self.bots = {bot.id: bot for bot in bots}
+        # 私聊消息 ID 在账号内全局递增；history 为 (消息, 可见时间)，机器人回复在延迟之后才可见
+        self.message_ids = itertools.count(1)
+        self.history: dict[int, list[tuple[types.Message, float]]] = {}
+        for bot in bots:
+            self.add_message(bot.id, f"欢迎使用 {bot.first_name}", out=False, visible_at=0)
+
+    def add_message(self, bot_id: int, text: str, out: bool, visible_at: float) -> types.Message:
+        message = types.Message(
+            id=next(self.message_ids),
+            peer_id=types.PeerUser(bot_id),
+            date=datetime.fromtimestamp(max(visible_at, time.time()), timezone.utc),
+            message=text,
+            out=out,
+            from_id=types.PeerUser(self.user.id if out else bot_id),
+        )
+        self.history.setdefault(bot_id, []).append((message, visible_at))
+        # 只保留最近的消息，长时间压测时内存不随发送次数增长
+        if len(self.history[bot_id]) > 50:
+            del self.history[bot_id][:-50]
+        return message
+
+    def visible_history(self, bot_id: int, limit: int) -> list[types.Message]:
+        now = time.time()
+        visible = [message for message, visible_at in self.history.get(bot_id, []) if visible_at <= now]
+        return list(reversed(visible))[:limit]
+
+
+class TelegramStandIn:
+    def __init__(self, config: StandInConfig | None = None, seed: int = 7):
+        self.config = config or StandInConfig()
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.user_ids = itertools.count(1000001)
+        self.accounts_by_phone: dict[str, StandInAccount] = {}
+        self.accounts_by_key: dict[int, StandInAccount] = {}
+        self.pending_codes: dict[str, str] = {}
+        self.pts = 1
+        self.bots = [
+            types.User(
+                id=STANDIN_BOT_ID_BASE + index,
+                bot=True,
+                access_hash=random.getrandbits(63),
+                first_name=f"测试机器人 {index}",
+                username=f"standin_{index}_bot",
+                bot_info_version=1,
+            )
+            for index in range(self.config.bots)
+        ]
+        self.stats = {"connects": 0, "requests": 0, "sends": 0, "replies": 0, "flood_waits": 0, "unsupported": 0}
+
+    def latency(self) -> float:
+        config = self.config
+        with self.lock:
+            jitter = self.rng.uniform(0, config.jitter_ms) if config.jitter_ms else 0
+        return (config.latency_ms + jitter) / 1000
+
+    def count(self, key: str) -> None:
+        with self.lock:
+            self.stats[key] += 1
+
+    def handle(self, key_id: int | None, request):
+        while isinstance(request, (functions.InvokeWithLayerRequest, functions.InitConnectionRequest, functions.InvokeWithoutUpdatesRequest)):
+            request = request.query
+        self.count("requests")
+        with self.lock:
+            account = self.accounts_by_key.get(key_id)
+            return self.dispatch(account, key_id, request)
+
+    def dispatch(self, account: StandInAccount | None, key_id: int | None, request):
+        now = utc_now()
+        if isinstance(request, functions.help.GetConfigRequest):
+            return None
+        if isinstance(request, functions.PingRequest):
+            return types.Pong(msg_id=0, ping_id=request.ping_id)
+        if isinstance(request, functions.auth.SendCodeRequest):
+            phone_code_hash = os.urandom(8).hex()
+            self.pending_codes[request.phone_number] = phone_code_hash
+            return types.auth.SentCode(type=types.auth.SentCodeTypeApp(length=len(STANDIN_LOGIN_CODE)), phone_code_hash=phone_code_hash)
+        if isinstance(request, functions.auth.SignInRequest):
+            if self.pending_codes.get(request.phone_number) != request.phone_code_hash:
+                raise errors.PhoneCodeExpiredError(request=request)
+            if request.phone_code != STANDIN_LOGIN_CODE:
+                raise errors.PhoneCodeInvalidError(request=request)
+            del self.pending_codes[request.phone_number]
+            account = self.accounts_by_phone.get(request.phone_number)
+            if account is None:
+                account = self.accounts_by_phone[request.phone_number] = StandInAccount(next(self.user_ids), request.phone_number, self.bots)
+            self.accounts_by_key[key_id] = account
+            return types.auth.Authorization(user=account.user)
+        if account is None:
+            raise errors.AuthKeyUnregisteredError(request=request)
+
+        if isinstance(request, functions.users.GetUsersRequest):
+            return [account.user for item in request.id if isinstance(item, types.InputUserSelf)]
+        if isinstance(request, functions.updates.GetStateRequest):
+            return types.updates.State(pts=self.pts, qts=0, date=now, seq=0, unread_count=0)
+        if isinstance(request, functions.updates.GetDifferenceRequest):
+            return types.updates.DifferenceEmpty(date=now, seq=0)
+        if isinstance(request, functions.messages.GetDialogsRequest):
+            # 按最近一条消息倒序返回全部机器人会话，不分页
+            dialogs, messages = [], []
+            for bot_id in account.bots:
+                top = account.visible_history(bot_id, 1)
+                if not top:
+                    continue
+                messages.append(top[0])
+                dialogs.append(
+                    types.Dialog(
+                        peer=types.PeerUser(bot_id),
+                        top_message=top[0].id,
+                        read_inbox_max_id=top[0].id,
+                        read_outbox_max_id=top[0].id,
+                        unread_count=0,
+                        unread_mentions_count=0,
+                        unread_reactions_count=0,
+                        notify_settings=types.PeerNotifySettings(),
+                    )
+                )
+            order = sorted(range(len(dialogs)), key=lambda index: messages[index].id, reverse=True)[: request.limit]
+            return types.messages.Dialogs(
+                dialogs=[dialogs[index] for index in order],
+                messages=[messages[index] for index in order],
+                chats=[],
+                users=[account.bots[dialogs[index].peer.user_id] for index in order],
+            )
+        if isinstance(request, functions.messages.SendMessageRequest):
+            bot_id = getattr(request.peer, "user_id", None)
+            if bot_id not in account.bots:
+                raise errors.PeerIdInvalidError(request=request)
+            if self.config.flood_rate and self.rng.random() < self.config.flood_rate:
+                self.stats["flood_waits"] += 1
+                raise errors.FloodWaitError(request=request, capture=self.config.flood_seconds)
+            self.stats["sends"] += 1
+            self.pts += 1
+            sent = account.add_message(bot_id, request.message, out=True, visible_at=time.time())
+            if self.rng.random() < self.config.reply_rate:
+                self.stats["replies"] += 1
+                account.add_message(bot_id, f"收到：{request.message[:40]}", out=False, visible_at=time.time() + self.config.reply_delay_ms / 1000)
+            return types.UpdateShortSentMessage(id=sent.id, pts=self.pts, pts_count=1, date=sent.date, out=True)
+        if isinstance(request, functions.messages.GetHistoryRequest):
+            bot_id = getattr(request.peer, "user_id", None)
+            if bot_id not in account.bots:
+                raise errors.PeerIdInvalidError(request=request)
+            return types.messages.Messages(messages=account.visible_history(bot_id, request.limit), chats=[], users=[account.bots[bot_id], account.user])
+
+        self.stats["unsupported"] += 1
+        raise errors.BadRequestError(request=request, message=f"STANDIN_UNSUPPORTED_{request.__class__.__name__.upper()}")
+
+
+class StandInSender:
+    # 与 MTProtoSender 相同的接口：connect/disconnect/send 返回 Future；断开、延迟与错误都在这一层模拟
+    def __init__(self, standin: TelegramStandIn, auth_key):
+        self.standin = standin
+        self.auth_key = auth_key or AuthKey(None)
+        self._connection = None
+        self._connected = False
+        self._disconnected = asyncio.get_running_loop().create_future()
+        self._disconnected.set_result(None)
+
+    async def connect(self, connection) -> bool:
+        if self._connected:
+            return False
+        self.standin.count("connects")
+        if self.standin.config.connect_ms:
+            await asyncio.sleep(self.standin.config.connect_ms / 1000)
+        if self.auth_key.key is None:
+            # 代替 DH 密钥交换：随机生成授权密钥，登录成功后与账号绑定
+            self.auth_key.key = os.urandom(256)
+        self._connection = connection
+        self._connected = True
+        self._disconnected = asyncio.get_running_loop().create_future()
+        return True
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def _transport_connected(self) -> bool:
+        return self._connected
+
+    def _keepalive_ping(self, ping_id: int) -> None:
+        pass
+
+    async def disconnect(self) -> None:
+        self._connected = False
+        if not self._disconnected.done():
+            self._disconnected.set_result(None)
+
+    @property
+    def disconnected(self):
+        return asyncio.shield(self._disconnected)
+
+    def send(self, request, ordered: bool = False):
+        if not self._connected:
+            raise ConnectionError("Cannot send requests while disconnected")
+        if isinstance(request, (list, tuple)):
+            return [self.send(item, ordered) for item in request]
+        if not isinstance(request, TLRequest):
+            raise TypeError("request must be a TLRequest")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def respond() -> None:
+            if future.done():
+                return
+            try:
+                result = self.standin.handle(self.auth_key.key_id, request)
+            except Exception as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+        loop.call_later(self.standin.latency(), respond)
+        return future
+
+
+def standin_client_class(standin: TelegramStandIn):
+    class StandInTelegramClient(TelegramClient):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._sender = StandInSender(standin, self.session.auth_key)
+
+    return StandInTelegramClient
+
+
+def install_telegram_standin(module, standin: TelegramStandIn):
+    # 替换目标模块（TgHelper）里的 TelegramClient；StringSession 保持原样，会话文本可以正常保存与恢复
+    original = module.TelegramClient
+    module.TelegramClient = standin_client_class(standin)
+
+    def restore() -> None:
+        module.TelegramClient = original
+
+    return restore
+
+
+def add_standin_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency-ms", type=float, default=30, help="每个 TL 请求的固定延迟")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="在固定延迟之上随机增加的延迟")
+    parser.add_argument("--connect-ms", type=float, default=50, help="建立连接的延迟")
+    parser.add_argument("--reply-delay-ms", type=float, default=500, help="机器人收到消息后多久回复")
+    parser.add_argument("--reply-rate", type=float, default=1.0, help="机器人回复的概率")
+    parser.add_argument("--flood-rate", type=float, default=0, help="发送消息时返回 FloodWait 的概率")
+    parser.add_argument("--flood-seconds", type=int, default=2, help="FloodWait 的秒数（不超过 60 时由 Telethon 自动等待重试）")
+    parser.add_argument("--bots", type=int, default=50, help="每个账号的机器人会话数")
+
+
+def standin_config_from_args(args: argparse.Namespace) -> StandInConfig:
+    return StandInConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        connect_ms=args.connect_ms,
+        reply_delay_ms=args.reply_delay_ms,
+        reply_rate=args.reply_rate,
+        flood_rate=args.flood_rate,
+        flood_seconds=args.flood_seconds,
+        bots=args.bots,
+    )
+
+
+def main() -> None:
+    # 以替身运行完整服务，便于手动走一遍登录、刷新会话、发送与查看回复
+    parser = argparse.ArgumentParser(description="使用本地 Telegram 替身运行 TgHelper")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=15018)
+    add_standin_arguments(parser)
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import TgHelper
+
+    install_telegram_standin(TgHelper, TelegramStandIn(standin_config_from_args(args)))
+    os.environ.setdefault("TELEGRAM_API_ID", "1")
+    os.environ.setdefault("TELEGRAM_API_HASH", "standin")
+    print(f"Telegram 替身已启用：任意手机号均可登录，验证码固定为 {STANDIN_LOGIN_CODE}")
+    TgHelper.serve_production(args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()